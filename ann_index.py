@@ -0,0 +1,220 @@
+"""
+Per-folder columnar index of the features of the SAM annotations.
+
+Selecting the pages of a file (sam_annotation_utils.select_scam_results) only
+needs the geometry of each mask, not the mask itself. The index keeps that
+geometry for all the masks of a folder in a few NumPy arrays, in a .npz file
+next to scam.json (scam_ann_index.npz), so that running scam again with other
+options doesn't download and decode the pickles.
+
+Columns, one row per mask (in the order of the pickle, the rows of an image are
+offsets[i]:offsets[i+1]): contour_area, bbox (x, y, w, h), min_area_rect (cx, cy,
+w, h, angle, normalized as in AnnotationInfo), squarishness, nb_edges_touched,
+touches_top_bottom, touches_left_right, predicted_iou, stability_score. One row
+per image: img_paths, pickle_paths, width, height, rotation, offsets. The geometry
+depends on the rotation of the file, an image whose rotation was changed since the
+index was built is not in the index anymore (its pickle is used).
+
+The index is written by preprocess, it can be built for existing folders with:
+
+    python ann_index.py FOLDER_PATH [FOLDER_PATH...]
+"""
+import argparse
+import io
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from sam_annotation_utils import AnnotationGeometry, get_ann_infos
+from sam_masks import load_sam_annotations
+from storage import get_storage
+from utils import get_scam_json
+
+ANN_INDEX_NAME = "scam_ann_index.npz"
+ANN_INDEX_VERSION = 1
+
+_MASK_COLUMNS = {
+    "contour_area": np.float64,
+    "bbox": np.int32,
+    "min_area_rect": np.float64,
+    "squarishness": np.float64,
+    "nb_edges_touched": np.int8,
+    "touches_top_bottom": np.bool_,
+    "touches_left_right": np.bool_,
+    "predicted_iou": np.float32,
+    "stability_score": np.float32,
+}
+
+def get_ann_index_key(folder_path):
+    return folder_path + ANN_INDEX_NAME
+
+def get_image_features(file_info, sam_ann_list):
+    """
+    returns the features of the SAM annotations of a file of scam.json, a dict of
+    lists with one value per annotation for each column of the index
+    """
+    features = {column: [] for column in _MASK_COLUMNS}
+    for sam_ann, ann in zip(sam_ann_list, get_ann_infos(file_info, sam_ann_list)):
+        (cx, cy), (w, h), angle = ann.minAreaRect
+        features["contour_area"].append(ann.contour_area)
+        features["bbox"].append(list(ann.bbox))
+        features["min_area_rect"].append([cx, cy, w, h, angle])
+        features["squarishness"].append(ann.squarishness())
+        features["nb_edges_touched"].append(ann.nb_edges_touched())
+        features["touches_top_bottom"].append(ann.touches_top_bottom())
+        features["touches_left_right"].append(ann.touches_left_right())
+        features["predicted_iou"].append(sam_ann.get("predicted_iou", np.nan))
+        features["stability_score"].append(sam_ann.get("stability_score", np.nan))
+    return features
+
+def build_ann_index(files, features_by_path):
+    """
+    returns the arrays of the index of the files of scam.json, features_by_path
+    is {img_path: get_image_features()}, files without features are not indexed
+    """
+    index = {column: [] for column in _MASK_COLUMNS}
+    img_paths, pickle_paths, widths, heights, rotations, offsets = [], [], [], [], [], [0]
+    for file_info in files:
+        features = features_by_path.get(file_info["img_path"])
+        if features is None:
+            continue
+        img_paths.append(file_info["img_path"])
+        pickle_paths.append(file_info.get("pickle_path") or "")
+        widths.append(file_info["width"])
+        heights.append(file_info["height"])
+        rotations.append(file_info.get("rotation", 0))
+        for column in _MASK_COLUMNS:
+            index[column].extend(features[column])
+        offsets.append(len(index["contour_area"]))
+    arrays = {column: np.array(index[column], dtype=dtype) for column, dtype in _MASK_COLUMNS.items()}
+    arrays["bbox"] = arrays["bbox"].reshape(-1, 4)
+    arrays["min_area_rect"] = arrays["min_area_rect"].reshape(-1, 5)
+    arrays.update({
+        "version": np.array(ANN_INDEX_VERSION),
+        "img_paths": np.array(img_paths, dtype=str),
+        "pickle_paths": np.array(pickle_paths, dtype=str),
+        "width": np.array(widths, dtype=np.int32),
+        "height": np.array(heights, dtype=np.int32),
+        "rotation": np.array(rotations, dtype=np.int32),
+        "offsets": np.array(offsets, dtype=np.int64),
+    })
+    return arrays
+
+def save_ann_index(folder_path, arrays, storage):
+    out = io.BytesIO()
+    np.savez_compressed(out, **arrays)
+    storage.put(get_ann_index_key(folder_path), out.getvalue())
+
+class AnnIndex:
+    """
+    The index of a folder, see load_ann_index()
+    """
+
+    def __init__(self, arrays):
+        self.arrays = arrays
+        self.rows = {img_path: i for i, img_path in enumerate(arrays["img_paths"].tolist())}
+
+    def has(self, file_info):
+        """
+        True if the annotations of the file in its current state are in the index
+        """
+        i = self.rows.get(file_info["img_path"])
+        if i is None:
+            return False
+        a = self.arrays
+        return (int(a["width"][i]) == file_info["width"] and int(a["height"][i]) == file_info["height"]
+                and int(a["rotation"][i]) == file_info.get("rotation", 0)
+                and a["pickle_paths"][i] == (file_info.get("pickle_path") or ""))
+
+    def get_rows(self, file_info):
+        """
+        returns the slice of the rows of the annotations of a file, None if the file is not in the index
+        """
+        if not self.has(file_info):
+            return None
+        i = self.rows[file_info["img_path"]]
+        return slice(int(self.arrays["offsets"][i]), int(self.arrays["offsets"][i+1]))
+
+    def get_annotations(self, file_info, min_area_ratio=None):
+        """
+        returns the AnnotationGeometry of the annotations of a file, None if the file
+        is not in the index. With min_area_ratio, only the annotations with a larger
+        area ratio are returned.
+        """
+        rows = self.get_rows(file_info)
+        if rows is None:
+            return None
+        a = self.arrays
+        areas = a["contour_area"][rows]
+        keep = np.arange(len(areas))
+        if min_area_ratio is not None:
+            keep = np.flatnonzero(areas / float(file_info["width"] * file_info["height"]) >= min_area_ratio)
+        img_w, img_h = file_info["width"], file_info["height"]
+        if file_info.get("rotation", 0) in (90, 270, -90):
+            img_w, img_h = img_h, img_w
+        bboxes = a["bbox"][rows][keep].tolist()
+        rects = a["min_area_rect"][rows][keep].tolist()
+        return [AnnotationGeometry(area, ((cx, cy), (w, h), angle), tuple(bbox), img_w, img_h)
+                for area, bbox, (cx, cy, w, h, angle) in zip(areas[keep].tolist(), bboxes, rects)]
+
+def load_ann_index(folder_path, storage):
+    """
+    returns the AnnIndex of a folder, None if there is none or if it is of another version
+    """
+    blob = storage.get(get_ann_index_key(folder_path))
+    if blob is None:
+        return None
+    blob.seek(0)
+    try:
+        with np.load(blob, allow_pickle=False) as npz:
+            arrays = {name: npz[name] for name in npz.files}
+    except (ValueError, OSError) as e:
+        logging.warning("invalid %s: %s", get_ann_index_key(folder_path), e)
+        return None
+    if int(arrays["version"]) != ANN_INDEX_VERSION:
+        return None
+    return AnnIndex(arrays)
+
+def backfill_folder(folder_path, storage, max_workers=4):
+    """
+    builds the index of a folder from its scam.json and pickles
+    """
+    scam_json = get_scam_json(folder_path, storage=storage)
+    if scam_json is None:
+        logging.error("cannot read %sscam.json", folder_path)
+        return None
+    features_by_path = {}
+
+    def _features(file_info):
+        blob = storage.get(file_info["pickle_path"])
+        if blob is None:
+            logging.warning("missing pickle %s", file_info["pickle_path"])
+            return
+        blob.seek(0)
+        sam_anns = load_sam_annotations(blob.read())
+        features_by_path[file_info["img_path"]] = get_image_features(file_info, sam_anns)
+
+    files = [file_info for file_info in scam_json["files"] if file_info.get("pickle_path")]
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        list(pool.map(_features, files))
+    arrays = build_ann_index(scam_json["files"], features_by_path)
+    save_ann_index(folder_path, arrays, storage)
+    logging.info("indexed %d annotations of %d images in %s", len(arrays["contour_area"]), len(arrays["img_paths"]), folder_path)
+    return arrays
+
+def main():
+    parser = argparse.ArgumentParser(description="build the annotation index (%s) of folders from their pickles" % ANN_INDEX_NAME)
+    parser.add_argument("folders", nargs="+", help="folder paths, as in the csv of scam_preprocess.py")
+    parser.add_argument("--storage", default="s3", help="where scam.json and the pickles are, see storage.py (default: s3)")
+    parser.add_argument("--workers", type=int, default=4, metavar="N", help="number of pickles read in parallel (default: 4)")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    storage = get_storage(args.storage)
+    for folder_path in args.folders:
+        if not folder_path.endswith("/"):
+            folder_path += "/"
+        backfill_folder(folder_path, storage, max_workers=args.workers)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""
+Compares the thread and process executors of scam_postprocess on the same folder.
+
+The sources and scam.json are first copied into memory storages so that
+the runs measure the derivation and not the network, each run writes into
+its own memory storage and the outputs of the runs are compared.
+
+    python bench_postprocess.py Sarah-Library/W3KG108/images/W3KG108-I3KG433/ --workers 8
+"""
+import argparse
+import json
+import logging
+import os
+import time
+
+from PIL import Image
+
+from scam_postprocess import DEFAULT_POSTPROCESS_OPTIONS, get_src_prefix, postprocess_folder
+from storage import get_storage
+from utils import get_scam_json, get_sha256
+
+
+def load_folder(folder_path, src_storage, json_storage):
+    """
+    copies scam.json and the sources of a folder into the memory storages
+    mem://bench_json and mem://bench_src, returns scam.json
+    """
+    scam_json = get_scam_json(folder_path, storage=get_storage(json_storage))
+    if scam_json is None:
+        raise ValueError("cannot read %sscam.json" % folder_path)
+    options = dict(DEFAULT_POSTPROCESS_OPTIONS, src_storage=src_storage)
+    src = get_storage(scam_json.get("source_url") or "s3") if src_storage == "auto" else get_storage(src_storage)
+    src_prefix = get_src_prefix(scam_json, options)
+    mem_src = get_storage("mem://bench_src")
+    for file_info in scam_json["files"]:
+        blob = src.get(src_prefix+file_info["img_path"])
+        if blob is not None:
+            mem_src.put(folder_path+file_info["img_path"], blob.read())
+    # the sources are now under the folder path
+    scam_json.pop("source_url", None)
+    get_storage("mem://bench_json").put(folder_path+"scam.json", json.dumps(scam_json).encode("utf-8"))
+    return scam_json
+
+
+def run(folder_path, executor, workers, options):
+    postprocess_options = dict(DEFAULT_POSTPROCESS_OPTIONS, **options)
+    postprocess_options.update({
+        "executor": executor,
+        "src_storage": "mem://bench_src",
+        "dst_storage": "mem://bench_dst_"+executor,
+        "json_storage": "mem://bench_json",
+    })
+    start = time.monotonic()
+    postprocess_folder(folder_path, postprocess_options, workers=workers)
+    duration = time.monotonic() - start
+    scam_log = json.loads(get_storage("mem://bench_json").get("scam_logs/"+folder_path+"scam_log.json").read())
+    dst = get_storage("mem://bench_dst_"+executor)
+    # the pixels are compared, libtiff does not always write the same padding bytes
+    outputs = {obj["Key"]: get_sha256(Image.open(dst.get(obj["Key"])).tobytes()) for obj in dst.list("")}
+    return {
+        "executor": executor,
+        "workers": workers,
+        "duration": round(duration, 3),
+        "pages": len(outputs),
+        "pages_per_s": round(len(outputs) / duration, 3) if duration else None,
+        "errors": sum(1 for entry in scam_log["output_files"] if "error" in entry),
+    }, outputs, [(entry["original_file_info"]["img_path"], entry.get("page_in_file"), entry.get("output_img_path")) for entry in scam_log["output_files"]]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="compare the thread and process executors of scam_postprocess on a folder")
+    parser.add_argument("folder", help="folder path, as in the csv of scam_postprocess.py")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), metavar="N", help="number of threads or processes (default: number of cpus)")
+    parser.add_argument("--src-storage", default="auto", help="where the sources are read, see the src_storage option (default: auto)")
+    parser.add_argument("--json-storage", default="s3", help="where scam.json is read (default: s3)")
+    parser.add_argument("--compress", action="store_true", help="output JPEG instead of TIFF")
+    parser.add_argument("--repeat", type=int, default=1, metavar="N", help="number of runs of each executor (default: 1)")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    folder_path = args.folder if args.folder.endswith("/") else args.folder+"/"
+    load_folder(folder_path, args.src_storage, args.json_storage)
+    options = {"compress_output": args.compress}
+    results = []
+    outputs = {}
+    for _ in range(args.repeat):
+        for executor in ("thread", "process"):
+            res, outputs[executor], log_order = run(folder_path, executor, args.workers, options)
+            res["log_sha256"] = get_sha256(json.dumps(log_order).encode("utf-8"))
+            results.append(res)
+            logging.warning("%s: %s", executor, json.dumps(res))
+    print(json.dumps({
+        "folder": folder_path,
+        "runs": results,
+        "same_outputs": outputs["thread"] == outputs["process"],
+        "same_log_order": len({res["log_sha256"] for res in results}) == 1,
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
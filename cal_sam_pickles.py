@@ -12,8 +12,9 @@ import numpy as np
 import torch
 from segment_anything import sam_model_registry, SamAutomaticMaskGenerator, SamPredictor
 import pickle
-from utils import s3_img_key_to_s3_pickle_key, MAX_SIZE, POINTS_PER_SIDE, upload_to_s3, gets3blob, S3, BUCKET_NAME, list_img_keys, get_gzip_picked_bytes, s3key_exists
+from utils import s3_img_key_to_s3_pickle_key, MAX_SIZE, POINTS_PER_SIDE, upload_to_s3, gets3blob, S3, BUCKET_NAME, list_img_keys, get_gzip_picked_bytes, s3key_exists, list_existing_keys
 from img_utils import apply_exif_rotation
+from sam_annotation_utils import filter_sam_annotations
 
 sam_checkpoint = "sam_vit_h_4b8939.pth"
 model_type = "vit_h"
@@ -46,7 +47,11 @@ def get_mask_generator(points_per_side=8):
     #    min_mask_region_area=1000,  # Requires open-cv to run post-processing
     )
 
-def get_sam_output(img, max_size=1024, points_per_side=8):
+def get_sam_output(img, max_size=1024, points_per_side=8, min_area_ratio=None, max_masks=None, nms_iou=None):
+    """
+    returns the SAM annotations of img, without the ones that the page selection would
+    discard (see filter_sam_annotations())
+    """
     if img.mode != "RGB":
         img = img.convert('RGB')
     ratio = max(max_size/img.width, max_size/img.height)
@@ -54,11 +59,19 @@ def get_sam_output(img, max_size=1024, points_per_side=8):
     new_height = int(img.height * ratio)
     img = img.resize((new_width, new_height), Image.LANCZOS)
     img = np.array(img)
-    return get_mask_generator(points_per_side).generate(img)
+    sam_res = get_mask_generator(points_per_side).generate(img)
+    return filter_sam_annotations(sam_res, min_area_ratio=min_area_ratio, max_masks=max_masks, nms_iou=nms_iou)
 
-def calc_sam_pickles(img_s3_path):
+def calc_sam_pickles(img_s3_path, existing_keys=None):
+    """
+    existing_keys is an optional collection of the pickle keys already on S3,
+    if absent the existence of the pickle is checked with a HEAD request
+    """
     picke_s3_path = s3_img_key_to_s3_pickle_key(img_s3_path)
-    if s3key_exists(picke_s3_path):
+    if existing_keys is not None:
+        if picke_s3_path in existing_keys:
+            return
+    elif s3key_exists(picke_s3_path):
         return
     print("apply SAM on %s -> %s" % (img_s3_path, picke_s3_path))
     img = Image.open(gets3blob(img_s3_path))
@@ -68,8 +81,13 @@ def calc_sam_pickles(img_s3_path):
     upload_to_s3(gzipped_pickled_bytes, picke_s3_path)
     
 def calc_all_sam_pickles(s3_prefix):
-    for img_s3_path in list_img_keys(s3_prefix):
-        calc_sam_pickles(img_s3_path)
+    img_s3_paths = list(list_img_keys(s3_prefix))
+    # one listing per pickle folder instead of one HEAD request per image
+    existing_keys = {}
+    for pickle_dir in set(s3_img_key_to_s3_pickle_key(p).rsplit("/", 1)[0] + "/" for p in img_s3_paths):
+        existing_keys.update(list_existing_keys(pickle_dir))
+    for img_s3_path in img_s3_paths:
+        calc_sam_pickles(img_s3_path, existing_keys)
 
 if __name__ == "__main__":
     calc_all_sam_pickles("ER/W1ER120/sources/W1ER120-I1ER790/")
\ No newline at end of file
@@ -0,0 +1,112 @@
+"""
+White patch analysis on raw files, vectorized with numpy.
+
+The statistics of the patch are computed on slices of the raw data or of
+a single demosaiced image, shared between the white balance and the
+exposure estimations (see get_factors_from_raw), or without a full
+demosaicing (see get_factors_from_cfa).
+"""
+import numpy as np
+import rawpy
+
+
+def _crop(array, bbox):
+    x, y, w, h = bbox
+    return array[y:y+h, x:x+w]
+
+def get_median_cam_rgb_per_c(raw, bbox, nb_channels=4):
+    """
+    returns the median camera RGB value (through the tone curve) of each channel
+    of the bayer pattern in bbox (x, y, w, h) of the visible raw image, nan for
+    a channel that is not in the pattern
+    """
+    values = np.asarray(raw.tone_curve)[_crop(raw.raw_image_visible, bbox)]
+    colors = _crop(raw.raw_colors_visible, bbox)
+    medians = []
+    for c in range(nb_channels):
+        channel = values[colors == c]
+        medians.append(float(np.median(channel)) if channel.size else float("nan"))
+    return medians
+
+def cam_rgb_to_nrgb_per_c(raw, median_cam_rgb_per_c):
+    """
+    normalizes camera RGB values (one per channel) in [0:1], see raw_utils.cam_rgb_to_nrgb
+    """
+    tone_curve = np.asarray(raw.tone_curve)
+    cblack = np.asarray(raw.black_level_per_channel[:len(median_cam_rgb_per_c)], dtype=np.float64)
+    cam_rgb = np.maximum(0, np.asarray(median_cam_rgb_per_c, dtype=np.float64) - cblack)
+    adjusted_max = tone_curve[raw.white_level - cblack.astype(np.int64)]
+    return (cam_rgb / adjusted_max).tolist()
+
+def get_median_cam_nrgb(raw, bbox):
+    """
+    given a RawPy object and a bbox (x, y, w, h), return the median normalized camera
+    rgb value for each color channel, for instance [0.12, 0.34, 0.18, 0.35]
+    """
+    return cam_rgb_to_nrgb_per_c(raw, get_median_cam_rgb_per_c(raw, bbox))
+
+def get_factors_from_cfa(raw, bbox, target_lnsrgb_mean=0.89):
+    """
+    returns (wb_factors, exposure factor) from the white patch in bbox (x, y, w, h)
+    without a full demosaicing: the white balance from the medians of the channels of
+    the bayer pattern, the exposure from a half size postprocessing (each 2x2 block of
+    the pattern gives a pixel), scaled by libraw as the full size one. libraw replaces
+    the tone curve of raw when it postprocesses, raw must not have been postprocessed.
+    """
+    medians = get_median_cam_nrgb(raw, bbox)
+    if np.isnan(medians[3]):
+        # 3 colors pattern, the second green is the first one
+        medians[3] = medians[1]
+    highest_median = max(medians)
+    wb_factors = [highest_median / m for m in medians]
+    half = raw.postprocess(output_color=rawpy.ColorSpace.sRGB, gamma=(1, 1), user_wb=wb_factors,
+                           no_auto_bright=True, user_flip=0, output_bps=8, half_size=True)
+    x, y, w, h = bbox
+    med_lrgb = np.median(half[y//2:(y+h+1)//2, x//2:(x+w+1)//2])
+    return wb_factors, target_lnsrgb_mean * 255 / med_lrgb
+
+def demosaic_linear(raw, demosaic_algorithm=None):
+    """
+    returns the demosaiced image in the camera color space, linear, without white balance
+    nor brightness adjustment (16 bits, 65535 is the white level)
+    """
+    return raw.postprocess(output_color=rawpy.ColorSpace.raw, gamma=(1, 1), output_bps=16,
+                           user_wb=[1.0, 1.0, 1.0, 1.0], no_auto_bright=True, user_flip=0,
+                           demosaic_algorithm=demosaic_algorithm)
+
+def get_median_cam_rgb(linear_patch):
+    """
+    returns the medians of the channels of a demosaiced patch as 4 channels (with green twice),
+    on the 8-bit scale
+    """
+    med_r, med_g, med_b = (float(np.median(linear_patch[..., c])) / 257 for c in range(3))
+    return [med_r, med_g, med_b, med_g]
+
+def get_exposure_factor(raw, linear_patch, wb_factors, target_lnrgb=0.89):
+    """
+    returns the exposure factor so that the median of the patch, white balanced with
+    wb_factors and converted to linear sRGB, is target_lnrgb. This is the computation
+    that libraw does with user_wb=wb_factors and output_color=sRGB, restricted to the patch.
+    """
+    # libraw normalizes the white balance factors so that the lowest is 1
+    wb = np.asarray(wb_factors[:3], dtype=np.float64) / min(wb_factors)
+    rgb = linear_patch.reshape(-1, 3).astype(np.float64) * wb
+    rgb_cam = np.asarray(raw.color_matrix, dtype=np.float64)[:, :3]
+    lrgb = np.clip(rgb @ rgb_cam.T, 0, 65535)
+    # 8-bit output of libraw
+    med_lrgb = np.median(np.floor(lrgb / 256))
+    return target_lnrgb * 255 / med_lrgb
+
+def get_factors_from_raw(raw, bbox, target_lnsrgb_mean=0.89, linear=None):
+    """
+    returns (wb_factors, exposure factor) from the white patch in bbox (x, y, w, h),
+    see raw_utils.get_factors_from_raw. linear is the result of demosaic_linear(raw),
+    computed if not given.
+    """
+    if linear is None:
+        linear = demosaic_linear(raw)
+    linear_patch = _crop(linear, bbox)
+    medians = get_median_cam_rgb(linear_patch)
+    highest_median = max(medians)
+    wb_factors = [highest_median / m for m in medians]
+    return wb_factors, get_exposure_factor(raw, linear_patch, wb_factors, target_lnsrgb_mean)
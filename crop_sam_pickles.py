@@ -1,4 +1,4 @@
-from utils import s3_img_key_to_s3_pickle_key, MAX_SIZE, upload_to_s3, gets3blob, S3, BUCKET_NAME, list_img_keys
+from utils import s3_img_key_to_s3_pickle_key, MAX_SIZE, upload_to_s3, gets3blob, S3, BUCKET_NAME, list_img_keys, TRANSFER_CONFIG, s3_call
 from img_utils import extract_encode_img, apply_icc, apply_exif_rotation
 from sam_annotation_utils import get_image_ann_list
 from PIL import Image
@@ -54,8 +54,8 @@ def debug_pickled(img_s3_path):
     print(pickle_s3_path)
     pickle_fname = "debug/"+to_local(pickle_s3_path)
     if not os.path.isfile(img_fname) or not os.path.isfile(pickle_fname):
-        S3.download_file(BUCKET_NAME, img_s3_path, img_fname)
-        S3.download_file(BUCKET_NAME, pickle_s3_path, pickle_fname)
+        s3_call(S3.download_file, BUCKET_NAME, img_s3_path, img_fname, Config=TRANSFER_CONFIG)
+        s3_call(S3.download_file, BUCKET_NAME, pickle_s3_path, pickle_fname, Config=TRANSFER_CONFIG)
     img_orig = Image.open(img_fname)
     img_orig = apply_icc(img_orig)
     img_orig = apply_exif_rotation(img_orig)
@@ -0,0 +1,186 @@
+import os
+import mmap
+import logging
+import threading
+from hashlib import sha256
+
+class DiskCache:
+    """
+    Persistent on-disk cache of S3 objects, keyed by bucket, key and ETag.
+
+    Each object is stored in cache_dir/xx/<sha256(bucket/key)>_<etag>, a new ETag
+    for the same key replaces the previous file. The mtime of the files is used
+    for LRU eviction so that the cache can be shared between processes and
+    survives between runs. Hits are served as read-only mmap objects, which
+    behave like files (read, seek, tell) and expose the buffer protocol
+    without copying the data in memory.
+    """
+
+    def __init__(self, cache_dir, max_bytes=50*1024*1024*1024, min_size=1024*1024):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        # small objects (scam.json, thumbnails) are not worth a disk access
+        self.min_size = min_size
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        self._size = sum(size for _, size, _ in self._scan())
+        self.reset_stats()
+
+    def reset_stats(self):
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
+            self.bytes_saved = 0
+            self.bytes_written = 0
+            self.evictions = 0
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 3) if total else None,
+                "bytes_saved": self.bytes_saved,
+                "bytes_written": self.bytes_written,
+                "evictions": self.evictions,
+                "size": self._size,
+            }
+
+    def _scan(self):
+        """
+        yields (path, size, mtime) for all the files in the cache
+        """
+        for subdir in os.scandir(self.cache_dir):
+            if not subdir.is_dir():
+                continue
+            for entry in os.scandir(subdir.path):
+                if entry.name.endswith(".tmp"):
+                    continue
+                try:
+                    st = entry.stat()
+                except FileNotFoundError:
+                    continue
+                yield entry.path, st.st_size, st.st_mtime
+
+    def _key_prefix(self, bucket, s3_key):
+        key_hash = sha256((bucket+"/"+s3_key).encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, key_hash[:2]), key_hash+"_"
+
+    def _find(self, bucket, s3_key):
+        """
+        returns (path, etag) of the cached version of the object, or (None, None)
+        """
+        dirname, prefix = self._key_prefix(bucket, s3_key)
+        try:
+            names = os.listdir(dirname)
+        except FileNotFoundError:
+            return None, None
+        for name in names:
+            if name.startswith(prefix) and not name.endswith(".tmp"):
+                return os.path.join(dirname, name), '"%s"' % name[len(prefix):]
+        return None, None
+
+    def get_etag(self, bucket, s3_key):
+        """
+        returns the ETag of the cached version of an object, or None
+        """
+        return self._find(bucket, s3_key)[1]
+
+    def open(self, bucket, s3_key, etag):
+        """
+        returns a read-only mmap of the cached object, or None if it is not
+        (or no longer) in the cache
+        """
+        path, cached_etag = self._find(bucket, s3_key)
+        if path is None or cached_etag != etag:
+            with self._lock:
+                self.misses += 1
+            return None
+        try:
+            with open(path, "rb") as f:
+                size = os.fstat(f.fileno()).st_size
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size > 0 else None
+            # refresh the position of the file in the LRU
+            os.utime(path)
+        except (FileNotFoundError, ValueError):
+            # evicted by another process in the meantime
+            with self._lock:
+                self.misses += 1
+            return None
+        if mm is None:
+            return None
+        with self._lock:
+            self.hits += 1
+            self.bytes_saved += size
+        return mm
+
+    def record_miss(self):
+        with self._lock:
+            self.misses += 1
+
+    def put(self, bucket, s3_key, etag, data):
+        """
+        stores data (bytes or any buffer) as the version etag of the object
+        """
+        size = len(data)
+        if size < self.min_size or size > self.max_bytes or not etag:
+            return
+        old_path, _ = self._find(bucket, s3_key)
+        dirname, prefix = self._key_prefix(bucket, s3_key)
+        os.makedirs(dirname, exist_ok=True)
+        path = os.path.join(dirname, prefix+etag.strip('"'))
+        tmp_path = "%s.%d.%d.tmp" % (path, os.getpid(), threading.get_ident())
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            with self._lock:
+                # the same version can already be there (two misses on the same key), it is replaced
+                try:
+                    replaced = os.path.getsize(path)
+                except FileNotFoundError:
+                    replaced = 0
+                os.replace(tmp_path, path)
+                self._size -= replaced
+        except OSError as e:
+            logging.warning("could not write %s in the disk cache: %s", s3_key, e)
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            return
+        removed = 0
+        if old_path is not None and old_path != path:
+            removed = self._remove(old_path)
+        with self._lock:
+            self.bytes_written += size
+            self._size += size - removed
+            need_eviction = self._size > self.max_bytes
+        if need_eviction:
+            self.evict()
+
+    def _remove(self, path):
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+            return size
+        except FileNotFoundError:
+            return 0
+
+    def evict(self):
+        """
+        removes the least recently used files until the cache is 10% below max_bytes
+        """
+        entries = sorted(self._scan(), key=lambda e: e[2])
+        total = sum(size for _, size, _ in entries)
+        target = int(self.max_bytes * 0.9)
+        evicted = 0
+        for path, size, _ in entries:
+            if total <= target:
+                break
+            total -= self._remove(path)
+            evicted += 1
+        with self._lock:
+            self._size = total
+            self.evictions += evicted
+        logging.info("evicted %d files from the disk cache, now %d bytes", evicted, total)
@@ -1,6 +1,7 @@
-from utils import S3, BUCKET_NAME, list_obj_keys, is_img
+from utils import S3, BUCKET_NAME, list_obj_keys, is_img, TRANSFER_CONFIG, s3_call
 from img_utils import encode_img
 from image_decode import decode_blob_to_pil, get_image_size_from_blob
+from image_probe import probe_file, ProbeError
 from openpecha.buda.api import get_buda_scan_info
 import shutil
 import sys
@@ -49,7 +50,7 @@ def download_archive_folder_into(s3prefix, dst_dir, nb_intro_pages, ilname, pref
             dest_fname = dst_dir+prefix+"_"+obj_key_afterprefix
         if not os.path.exists(os.path.dirname(dest_fname)):
             os.makedirs(os.path.dirname(dest_fname))
-        S3.download_file(bucket, obj_key, dest_fname)
+        s3_call(S3.download_file, bucket, obj_key, dest_fname, Config=TRANSFER_CONFIG)
         fnum += 1
     # return the number of image files downloaded
     return fnum - 1
@@ -68,7 +69,7 @@ def download_folder_into(s3prefix, dst_dir, bucket=BUCKET_NAME):
         dest_fname = dst_dir+obj_key_afterprefix
         if not os.path.exists(os.path.dirname(dest_fname)):
             os.makedirs(os.path.dirname(dest_fname))
-        S3.download_file(bucket, obj_key, dest_fname)
+        s3_call(S3.download_file, bucket, obj_key, dest_fname, Config=TRANSFER_CONFIG)
 
 def get_nbintropages(wlname, ilname):
     global WINFOS_CACHE
@@ -88,6 +89,12 @@ def get_nbintropages(wlname, ilname):
 # -------------------------
 
 def _get_image_max_dim(path):
+    # read only the headers when possible
+    try:
+        probe = probe_file(path)
+        return max(probe["width"], probe["height"])
+    except (ProbeError, OSError) as e:
+        logging.debug("could not probe %s: %s", path, e)
     # Prefer libvips so JPEG-XL archives work (Pillow often cannot open .jxl)
     with open(path, "rb") as f:
         data = f.read()
@@ -1,5 +1,6 @@
 import io
 import logging
+import mmap
 
 import numpy as np
 from PIL import Image
@@ -10,6 +11,9 @@ logger = logging.getLogger(__name__)
 
 
 def _blob_bytes(blob):
+    if isinstance(blob, mmap.mmap):
+        # served by the disk cache, libvips can read it without a copy
+        return blob
     blob.seek(0)
     if hasattr(blob, "getvalue"):
         data = blob.getvalue()
@@ -20,6 +24,28 @@ def _blob_bytes(blob):
     return data
 
 
+def _vips_from_blob_bytes(data, **kwargs):
+    """
+    new_from_buffer() on the result of _blob_bytes, mmaps are read in place
+    """
+    import pyvips
+
+    if isinstance(data, mmap.mmap):
+        return pyvips.Image.new_from_source(pyvips.Source.new_from_memory(data), "", **kwargs)
+    return pyvips.Image.new_from_buffer(data, "", **kwargs)
+
+
+def _vips_thumbnail_blob_bytes(data, width, **kwargs):
+    """
+    thumbnail_buffer() on the result of _blob_bytes, mmaps are read in place
+    """
+    import pyvips
+
+    if isinstance(data, mmap.mmap):
+        return pyvips.Image.thumbnail_source(pyvips.Source.new_from_memory(data), width, **kwargs)
+    return pyvips.Image.thumbnail_buffer(data, width, **kwargs)
+
+
 def get_image_size_from_blob(blob, img_path=None):
     """Return (width, height) without fully decoding pixel data when possible."""
     if img_path and is_likely_raw(img_path):
@@ -29,8 +55,7 @@ def get_image_size_from_blob(blob, img_path=None):
 
     data = _blob_bytes(blob)
     try:
-        import pyvips
-        img = pyvips.Image.new_from_buffer(data, "", access="sequential")
+        img = _vips_from_blob_bytes(data, access="sequential")
         return img.width, img.height
     except Exception:
         logger.debug("vips header read failed, falling back to PIL", exc_info=True)
@@ -42,6 +67,9 @@ def get_image_size_from_blob(blob, img_path=None):
 def _vips_image_to_pil(vips_img):
     import pyvips
 
+    if vips_img.format == "ushort":
+        # 16-bit images (TIFF), the arrays below are 8-bit
+        vips_img = (vips_img >> 8).cast("uchar")
     if vips_img.bands == 1:
         arr = np.ndarray(
             buffer=vips_img.write_to_memory(),
@@ -89,21 +117,162 @@ def decode_blob_to_pil(blob, max_dimension=None, img_path=None):
     """
     if img_path and is_likely_raw(img_path):
         blob.seek(0)
-        return Image.open(blob)
+        img = Image.open(blob)
+        if max_dimension is not None:
+            # only reduces the decoding (see raw_utils.RawImageFile.draft), the size can still be larger
+            img.draft("RGB", (max_dimension, max_dimension))
+        return img
 
     data = _blob_bytes(blob)
     try:
         import pyvips
 
         if max_dimension is not None:
-            vips_img = pyvips.Image.thumbnail_buffer(
+            vips_img = _vips_thumbnail_blob_bytes(
                 data, max_dimension, size=pyvips.Size.DOWN
             )
         else:
-            vips_img = pyvips.Image.new_from_buffer(data, "", access="sequential")
+            vips_img = _vips_from_blob_bytes(data, access="sequential")
         return _vips_image_to_pil(vips_img)
     except Exception as e:
         # WARNING so callers (e.g. scam_postprocess) can capture this in scam_log.json
         logger.warning("vips decode failed (%s), falling back to PIL", e)
 
     return _decode_with_pil(io.BytesIO(data), max_dimension=max_dimension)
+
+
+# EXIF orientation -> counter-clockwise angle to give to PIL's rotate(), as in
+# img_utils.apply_exif_rotation (mirrored orientations are ignored)
+ORIENTATION_ROTATIONS = {3: 180, 6: 270, 8: 90}
+
+DEFAULT_PYRAMID_SIZES = {"sam": 1024, "thumbnail": 512}
+
+
+class ImagePyramid:
+    """
+    The levels of an image decoded once: "original" (if kept) and one level per
+    named size, each no larger than the size on its longest side.
+
+    Levels are stored as decoded (not rotated), rotation is the angle given by
+    the EXIF orientation and get() returns oriented levels by default.
+    """
+
+    def __init__(self, original_size, rotation, levels):
+        self.original_size = original_size
+        self.rotation = rotation
+        self.levels = levels
+
+    @property
+    def width(self):
+        return self.original_size[0]
+
+    @property
+    def height(self):
+        return self.original_size[1]
+
+    def get(self, name, oriented=True):
+        img = self.levels[name]
+        if oriented and self.rotation:
+            img = img.rotate(self.rotation, expand=True)
+        return img
+
+
+def _fit_size(width, height, max_dimension):
+    # same rounding as the thumbnails of scam_preprocess
+    ratio = min(max_dimension / width, max_dimension / height)
+    if ratio >= 1.0:
+        return width, height
+    return int(width * ratio), int(height * ratio)
+
+
+def _build_levels(img, sizes, levels):
+    """
+    adds a level for each size, largest first, each level being downscaled from the previous one
+    """
+    for name, max_dimension in sorted(sizes.items(), key=lambda item: -item[1]):
+        size = _fit_size(img.width, img.height, max_dimension)
+        if size != img.size:
+            # reducing_gap does a fast integer reduction before the lanczos filter for large ratios
+            img = img.resize(size, Image.LANCZOS, reducing_gap=3.0)
+        levels[name] = img
+    return levels
+
+
+def _pil_rotation(img):
+    try:
+        exif = img.getexif()
+    except Exception:
+        return 0
+    return ORIENTATION_ROTATIONS.get(exif.get(0x0112), 0)
+
+
+def _vips_rotation(vips_img):
+    if vips_img.get_typeof("orientation") == 0:
+        return 0
+    return ORIENTATION_ROTATIONS.get(vips_img.get("orientation"), 0)
+
+
+def _decode_pyramid_with_pil(data, sizes, keep_original):
+    img = Image.open(io.BytesIO(data))
+    rotation = _pil_rotation(img)
+    original_size = img.size
+    if not keep_original and sizes and img.format == "JPEG":
+        # let libjpeg decode at a reduced scale (no smaller than the largest level)
+        largest = max(sizes.values())
+        img.draft(img.mode, _fit_size(img.width, img.height, largest))
+    img.load()
+    levels = {"original": img} if keep_original else {}
+    return ImagePyramid(original_size, rotation, _build_levels(img, sizes, levels))
+
+
+def decode_pyramid(blob, img_path=None, sizes=DEFAULT_PYRAMID_SIZES, keep_original=False):
+    """
+    Decode image bytes once into an ImagePyramid.
+
+    When the original is not kept, non-RAW files are decoded by libvips with
+    shrink-on-load at the largest size and the smaller levels are downscaled
+    from it. The original is decoded with Pillow (which keeps the ICC profile
+    and the EXIF data), libvips is used as a fallback for formats Pillow
+    cannot read. RAW files are demosaiced once, or decoded from their preview
+    when the original is not kept (see raw_utils.RawImageFile).
+    """
+    if img_path and is_likely_raw(img_path):
+        blob.seek(0)
+        img = Image.open(blob)
+        original_size = img.size
+        if not keep_original and sizes:
+            # embedded preview or half size decode instead of a full demosaic
+            largest = max(sizes.values())
+            img.draft("RGB", (largest, largest))
+        img.load()
+        levels = {"original": img} if keep_original else {}
+        # RawImageFile doesn't apply (nor read) the orientation
+        return ImagePyramid(original_size, 0, _build_levels(img, sizes, levels))
+
+    data = _blob_bytes(blob)
+    if keep_original or not sizes:
+        try:
+            return _decode_pyramid_with_pil(data, sizes, keep_original)
+        except Exception as e:
+            logger.warning("PIL decode failed (%s), trying vips", e)
+    try:
+        import pyvips
+
+        header = _vips_from_blob_bytes(data, access="sequential")
+        original_size = (header.width, header.height)
+        rotation = _vips_rotation(header)
+        if keep_original or not sizes:
+            img = _vips_image_to_pil(header)
+            levels = {"original": img} if keep_original else {}
+        else:
+            vips_img = _vips_thumbnail_blob_bytes(
+                data, max(sizes.values()), size=pyvips.Size.DOWN, no_rotate=True
+            )
+            img = _vips_image_to_pil(vips_img)
+            levels = {}
+        return ImagePyramid(original_size, rotation, _build_levels(img, sizes, levels))
+    except Exception as e:
+        # WARNING so callers (e.g. scam_postprocess) can capture this in scam_log.json
+        logger.warning("vips decode failed (%s), falling back to PIL", e)
+
+    return _decode_pyramid_with_pil(data, sizes, keep_original)
@@ -0,0 +1,499 @@
+"""
+Image metadata from the file headers only, without decoding (or downloading) the pixels.
+
+The parsers read through a block reader that fetches only the blocks they need, so
+that probing an S3 object costs one ranged GET of 64KB in the common case and a few
+more when the metadata is not at the beginning of the file (TIFF files often have
+their IFD at the end).
+
+Supported: JPEG, TIFF (and BigTIFF), JPEG-XL and TIFF-based RAW files (CR2, NEF, ARW, DNG).
+For RAW files the dimensions are the ones of the largest image in the file, which can
+differ by a few pixels from the output of the demosaicing.
+"""
+import json
+import logging
+import struct
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import botocore
+
+from raw_utils import is_likely_raw
+import utils
+from utils import BUCKET_NAME, is_img, s3_call
+from storage import S3Storage
+
+PROBE_SIDECAR_NAME = "scam_probe.json"
+
+class ProbeError(Exception):
+    """Raised when the header cannot be parsed (unsupported or invalid file)."""
+
+
+class BlockReader:
+    """
+    Random access on a file through a fetch(start, end) function, fetching and keeping
+    aligned blocks. Contiguous missing blocks are fetched in one call.
+    """
+
+    def __init__(self, fetch, block_size=64*1024, max_bytes=4*1024*1024):
+        self._fetch = fetch
+        self.block_size = block_size
+        self.max_bytes = max_bytes
+        self._blocks = {}
+        self._eof = None
+        self.fetched_bytes = 0
+        self.nb_fetches = 0
+
+    def _fetch_blocks(self, first, last):
+        start = first * self.block_size
+        end = (last + 1) * self.block_size
+        if self.fetched_bytes + (end - start) > self.max_bytes:
+            raise ProbeError("header larger than %d bytes" % self.max_bytes)
+        data = self._fetch(start, end)
+        self.nb_fetches += 1
+        self.fetched_bytes += len(data)
+        if len(data) < end - start:
+            self._eof = start + len(data)
+        for b in range(first, last + 1):
+            self._blocks[b] = data[(b - first) * self.block_size:(b - first + 1) * self.block_size]
+
+    def read_at_most(self, offset, size):
+        """
+        returns size bytes at offset, or less at the end of the file
+        """
+        if offset < 0 or size < 0:
+            raise ProbeError("invalid offset")
+        if size == 0:
+            return b""
+        first = offset // self.block_size
+        last = (offset + size - 1) // self.block_size
+        b = first
+        while b <= last:
+            if b in self._blocks or (self._eof is not None and b * self.block_size >= self._eof):
+                b += 1
+                continue
+            run_end = b
+            while run_end + 1 <= last and run_end + 1 not in self._blocks:
+                run_end += 1
+            self._fetch_blocks(b, run_end)
+            b = run_end + 1
+        data = b"".join(self._blocks.get(b, b"") for b in range(first, last + 1))
+        return data[offset - first * self.block_size:][:size]
+
+    def read(self, offset, size):
+        data = self.read_at_most(offset, size)
+        if len(data) < size:
+            raise ProbeError("unexpected end of file")
+        return data
+
+
+# TIFF
+
+TIFF_TYPE_FORMATS = {1: "B", 2: "c", 3: "H", 4: "I", 5: "II", 6: "b", 7: "B", 8: "h", 9: "i", 10: "ii", 11: "f", 12: "d", 13: "I", 16: "Q", 17: "q", 18: "Q"}
+
+TAG_NEW_SUBFILE_TYPE = 0xFE
+TAG_WIDTH = 0x100
+TAG_HEIGHT = 0x101
+TAG_BITS_PER_SAMPLE = 0x102
+TAG_ORIENTATION = 0x112
+TAG_SUB_IFDS = 0x14A
+TAG_EXIF_IFD = 0x8769
+TAG_ICC = 0x8773
+TAG_EXPOSURE_TIME = 0x829A
+TAG_DNG_DEFAULT_CROP_SIZE = 0xC620
+
+class _TiffParser:
+    def __init__(self, reader, base):
+        self.reader = reader
+        self.base = base
+        order = reader.read(base, 2)
+        if order == b"II":
+            self.endian = "<"
+        elif order == b"MM":
+            self.endian = ">"
+        else:
+            raise ProbeError("invalid TIFF byte order")
+        magic = struct.unpack(self.endian + "H", reader.read(base + 2, 2))[0]
+        self.big = magic == 43
+        if self.big:
+            self.first_ifd = struct.unpack(self.endian + "Q", reader.read(base + 8, 8))[0]
+        else:
+            # 42 for TIFF, some RAW formats use other values
+            self.first_ifd = struct.unpack(self.endian + "I", reader.read(base + 4, 4))[0]
+
+    def read_ifd(self, offset):
+        """
+        returns ({tag: (type, count, raw value or offset bytes)}, next IFD offset)
+        """
+        if self.big:
+            nb_entries_fmt, offset_fmt = "Q", "Q"
+        else:
+            nb_entries_fmt, offset_fmt = "H", "I"
+        # an entry is tag (2 bytes), type (2 bytes), count and value, count and value have the size of an offset
+        offset_size = struct.calcsize(offset_fmt)
+        entry_size = 4 + 2 * offset_size
+        nb_entries_size = struct.calcsize(nb_entries_fmt)
+        nb_entries = struct.unpack(self.endian + nb_entries_fmt, self.reader.read(self.base + offset, nb_entries_size))[0]
+        if nb_entries > 4096:
+            raise ProbeError("invalid TIFF IFD")
+        data = self.reader.read(self.base + offset + nb_entries_size, nb_entries * entry_size + offset_size)
+        entries = {}
+        for i in range(nb_entries):
+            e = data[i * entry_size:(i + 1) * entry_size]
+            tag, typ, count = struct.unpack(self.endian + "HH" + offset_fmt, e[:4 + offset_size])
+            entries[tag] = (typ, count, e[4 + offset_size:])
+        next_ifd = struct.unpack(self.endian + offset_fmt, data[nb_entries * entry_size:])[0]
+        return entries, next_ifd
+
+    def values(self, entry, max_count=64):
+        typ, count, value = entry
+        fmt = TIFF_TYPE_FORMATS.get(typ)
+        if fmt is None:
+            return []
+        item_size = struct.calcsize(self.endian + fmt)
+        # whether the value is inline depends on the full count
+        inline = item_size * count <= (8 if self.big else 4)
+        count = min(count, max_count)
+        size = item_size * count
+        inline_size = 8 if self.big else 4
+        if inline:
+            data = value[:size]
+        else:
+            offset = struct.unpack(self.endian + ("Q" if self.big else "I"), value[:inline_size])[0]
+            data = self.reader.read(self.base + offset, size)
+        vals = struct.unpack(self.endian + fmt * count, data)
+        if typ in (5, 10):
+            return [vals[i] / vals[i + 1] if vals[i + 1] else None for i in range(0, len(vals), 2)]
+        return list(vals)
+
+    def value(self, entries, tag):
+        if tag not in entries:
+            return None
+        vals = self.values(entries[tag], max_count=1)
+        return vals[0] if vals else None
+
+
+def _probe_tiff_ifds(parser, res):
+    """
+    fills res with the data of IFD0 and the largest image in the IFD chain and its sub IFDs
+    """
+    ifds = []
+    offset = parser.first_ifd
+    ifd0 = None
+    while offset and len(ifds) < 16:
+        entries, offset = parser.read_ifd(offset)
+        if ifd0 is None:
+            ifd0 = entries
+        ifds.append(entries)
+        if TAG_SUB_IFDS in entries:
+            for sub_offset in parser.values(entries[TAG_SUB_IFDS], max_count=8):
+                ifds.append(parser.read_ifd(sub_offset)[0])
+    if ifd0 is None:
+        raise ProbeError("no IFD in TIFF")
+    res["orientation"] = parser.value(ifd0, TAG_ORIENTATION)
+    res["has_icc"] = TAG_ICC in ifd0
+    if TAG_EXIF_IFD in ifd0:
+        exif_ifd = parser.read_ifd(parser.value(ifd0, TAG_EXIF_IFD))[0]
+        res["exposure_time"] = parser.value(exif_ifd, TAG_EXPOSURE_TIME)
+    return ifd0, ifds
+
+def _ifd_dims(parser, entries):
+    w = parser.value(entries, TAG_WIDTH)
+    h = parser.value(entries, TAG_HEIGHT)
+    if TAG_DNG_DEFAULT_CROP_SIZE in entries:
+        crop = parser.values(entries[TAG_DNG_DEFAULT_CROP_SIZE])
+        if len(crop) == 2:
+            w, h = int(crop[0]), int(crop[1])
+    return w, h
+
+def _probe_tiff(reader, res, raw=False):
+    parser = _TiffParser(reader, 0)
+    ifd0, ifds = _probe_tiff_ifds(parser, res)
+    main = ifd0
+    if raw:
+        # the raw data is not necessarily in IFD0 (NEF and DNG have a thumbnail there)
+        best_area = -1
+        for entries in ifds:
+            w, h = _ifd_dims(parser, entries)
+            if w and h and w * h > best_area:
+                best_area = w * h
+                main = entries
+    res["width"], res["height"] = _ifd_dims(parser, main)
+    bps = parser.values(main[TAG_BITS_PER_SAMPLE], max_count=1) if TAG_BITS_PER_SAMPLE in main else [1]
+    res["bit_depth"] = bps[0] if bps else None
+    if not res["width"] or not res["height"]:
+        raise ProbeError("no image dimensions in TIFF")
+
+
+# JPEG
+
+def _probe_exif(reader, base, res):
+    parser = _TiffParser(reader, base)
+    _probe_tiff_ifds(parser, res)
+
+def _probe_jpeg(reader, res):
+    res["has_icc"] = False
+    pos = 2
+    while True:
+        marker = reader.read(pos, 2)
+        if marker[0] != 0xFF:
+            raise ProbeError("invalid JPEG marker at %d" % pos)
+        m = marker[1]
+        if m == 0xFF:
+            # fill byte
+            pos += 1
+            continue
+        if m in (0xD8, 0x01) or 0xD0 <= m <= 0xD7:
+            pos += 2
+            continue
+        if m in (0xD9, 0xDA):
+            raise ProbeError("no SOF marker in JPEG")
+        length = struct.unpack(">H", reader.read(pos + 2, 2))[0]
+        if m == 0xE1 and length >= 8 and reader.read(pos + 4, 6) == b"Exif\0\0":
+            try:
+                _probe_exif(reader, pos + 10, res)
+            except ProbeError as e:
+                logging.debug("invalid Exif data: %s", e)
+        elif m == 0xE2 and length >= 14 and reader.read(pos + 4, 12) == b"ICC_PROFILE\0":
+            res["has_icc"] = True
+        elif 0xC0 <= m <= 0xCF and m not in (0xC4, 0xC8, 0xCC):
+            precision, h, w, _ = struct.unpack(">BHHB", reader.read(pos + 4, 6))
+            res["width"], res["height"], res["bit_depth"] = w, h, precision
+            return
+        pos += 2 + length
+
+
+# JPEG-XL
+
+class _BitReader:
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+    def u(self, n):
+        v = 0
+        for i in range(n):
+            byte_idx = self.pos >> 3
+            if byte_idx >= len(self.data):
+                raise ProbeError("truncated JPEG-XL header")
+            v |= ((self.data[byte_idx] >> (self.pos & 7)) & 1) << i
+            self.pos += 1
+        return v
+
+    def u32(self, *dists):
+        # each distribution is (offset, nb bits)
+        offset, nbits = dists[self.u(2)]
+        return offset + self.u(nbits)
+
+JXL_RATIOS = {1: (1, 1), 2: (12, 10), 3: (4, 3), 4: (3, 2), 5: (16, 9), 6: (5, 4), 7: (2, 1)}
+JXL_SIZE_DISTS = ((1, 9), (1, 13), (1, 18), (1, 30))
+
+def _jxl_size_header(br):
+    div8 = br.u(1)
+    if div8:
+        height = 8 * (1 + br.u(5))
+    else:
+        height = br.u32(*JXL_SIZE_DISTS)
+    ratio = br.u(3)
+    if ratio == 0:
+        if div8:
+            width = 8 * (1 + br.u(5))
+        else:
+            width = br.u32(*JXL_SIZE_DISTS)
+    else:
+        num, den = JXL_RATIOS[ratio]
+        width = height * num // den
+    return width, height
+
+def _jxl_codestream_start(reader):
+    """
+    returns the bytes at the beginning of the codestream, handling the ISOBMFF container
+    """
+    if reader.read(0, 2) == b"\xff\x0a":
+        return reader.read_at_most(0, 256)
+    pos = 0
+    for _ in range(64):
+        size, box_type = struct.unpack(">I4s", reader.read(pos, 8))
+        header_size = 8
+        if size == 1:
+            size = struct.unpack(">Q", reader.read(pos + 8, 8))[0]
+            header_size = 16
+        if box_type in (b"jxlc", b"jxlp"):
+            start = pos + header_size + (4 if box_type == b"jxlp" else 0)
+            end = pos + size if size else start + 256
+            return reader.read_at_most(start, min(256, end - start))
+        if size == 0:
+            break
+        pos += size
+    raise ProbeError("no codestream in JPEG-XL container")
+
+def _probe_jxl(reader, res):
+    br = _BitReader(_jxl_codestream_start(reader))
+    if br.u(16) != 0x0AFF:
+        raise ProbeError("invalid JPEG-XL signature")
+    res["width"], res["height"] = _jxl_size_header(br)
+    res["orientation"] = 1
+    if br.u(1):
+        # all default: 8 bits, sRGB
+        res["bit_depth"] = 8
+        res["has_icc"] = False
+        return
+    if br.u(1):
+        # extra fields
+        res["orientation"] = 1 + br.u(3)
+        if br.u(1):
+            _jxl_size_header(br) # intrinsic size
+        if br.u(1) or br.u(1):
+            # preview or animation headers, not worth parsing for the bit depth
+            return
+    float_sample = br.u(1)
+    if not float_sample:
+        res["bit_depth"] = br.u32((8, 0), (10, 0), (12, 0), (1, 6))
+    else:
+        res["bit_depth"] = br.u32((32, 0), (16, 0), (24, 0), (1, 6))
+        br.u(4)
+    br.u(1) # modular_16bit_buffers
+    if br.u32((0, 0), (1, 0), (2, 4), (1, 12)) != 0:
+        # extra channels, too complex to skip
+        return
+    br.u(1) # xyb_encoded
+    if br.u(1):
+        res["has_icc"] = False
+    else:
+        res["has_icc"] = bool(br.u(1))
+
+
+def probe_reader(reader, img_path=None):
+    """
+    returns a dict with format, width, height, orientation, exposure_time, has_icc and bit_depth,
+    the values that can't be found are None
+    """
+    res = {
+        "format": None,
+        "width": None,
+        "height": None,
+        "orientation": None,
+        "exposure_time": None,
+        "has_icc": None,
+        "bit_depth": None,
+    }
+    head = reader.read_at_most(0, 12)
+    raw = img_path is not None and is_likely_raw(img_path)
+    try:
+        if head[:3] == b"\xff\xd8\xff":
+            res["format"] = "jpeg"
+            _probe_jpeg(reader, res)
+        elif head[:2] in (b"II", b"MM"):
+            res["format"] = "raw" if raw else "tiff"
+            _probe_tiff(reader, res, raw=raw)
+        elif head[:2] == b"\xff\x0a" or head[4:12] == b"JXL \x0d\x0a\x87\x0a":
+            res["format"] = "jxl"
+            _probe_jxl(reader, res)
+        else:
+            # CR3 (ISOBMFF) and others
+            raise ProbeError("unsupported format")
+    except (struct.error, KeyError, TypeError, IndexError) as e:
+        raise ProbeError("invalid header: %s" % e)
+    return res
+
+
+def probe_blob(blob, img_path=None):
+    """
+    probe an in-memory blob (BytesIO, mmap or bytes)
+    """
+    data = blob.getbuffer() if hasattr(blob, "getbuffer") else memoryview(blob)
+    try:
+        return probe_reader(BlockReader(lambda start, end: bytes(data[start:end]), max_bytes=len(data) + 64*1024), img_path)
+    finally:
+        data.release()
+
+def probe_file(path, block_size=64*1024):
+    """
+    probe a local file, only reading the blocks containing the metadata
+    """
+    with open(path, "rb") as f:
+        def fetch(start, end):
+            f.seek(start)
+            return f.read(end - start)
+        return probe_reader(BlockReader(fetch, block_size=block_size), path)
+
+def _get_range(client, bucket, s3_key, start, end):
+    response = client.get_object(Bucket=bucket, Key=s3_key, Range="bytes=%d-%d" % (start, end - 1))
+    return response['Body'].read()
+
+def probe_s3(s3_key, bucket=BUCKET_NAME, client=None, block_size=64*1024):
+    """
+    probe an S3 object with ranged GETs
+    """
+    if client is None:
+        client = utils.S3
+    def fetch(start, end):
+        try:
+            return s3_call(_get_range, client, bucket, s3_key, start, end)
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] == 'InvalidRange':
+                return b""
+            raise
+    return probe_reader(BlockReader(fetch, block_size=block_size), s3_key)
+
+
+def probe_storage(storage, key, block_size=64*1024):
+    """
+    probe an object of a storage (see storage.py) with ranged reads
+    """
+    return probe_reader(BlockReader(lambda start, end: storage.get_range(key, start, end), block_size=block_size), key)
+
+
+def get_probe_sidecar_key(folder_path):
+    return folder_path + PROBE_SIDECAR_NAME
+
+def probe_folder(folder_path, bucket=BUCKET_NAME, max_workers=8, src_storage=None, dst_storage=None, src_prefix=None):
+    """
+    returns {img_path: probe result} for all the images of a folder.
+
+    Results are cached in a sidecar file (scam_probe.json) in the folder, with the
+    ETag of each object so that only new or modified files are probed again.
+    Files that can't be probed have an "error" key.
+
+    The images are read from src_storage (under src_prefix, folder_path by default)
+    and the sidecar from dst_storage, both default to the bucket.
+    """
+    if src_prefix is None:
+        src_prefix = folder_path
+    if src_storage is None:
+        src_storage = S3Storage(bucket)
+    if dst_storage is None:
+        dst_storage = S3Storage(bucket)
+    sidecar_key = get_probe_sidecar_key(folder_path)
+    sidecar = {}
+    blob = dst_storage.get(sidecar_key)
+    if blob is not None:
+        blob.seek(0)
+        try:
+            sidecar = json.loads(blob.read().decode("utf-8"))
+        except ValueError:
+            logging.warning("invalid %s, probing again", sidecar_key)
+    etags = {}
+    for obj in src_storage.list(src_prefix):
+        if is_img(obj["Key"]):
+            etags[obj["Key"][len(src_prefix):]] = obj["ETag"]
+    to_probe = [img_path for img_path, etag in etags.items() if img_path not in sidecar or sidecar[img_path].get("etag") != etag]
+    changed = len(to_probe) > 0 or any(img_path not in etags for img_path in sidecar)
+    lock = threading.Lock()
+    def _probe(img_path):
+        try:
+            res = probe_storage(src_storage, src_prefix + img_path)
+        except Exception as e:
+            logging.warning("could not probe %s: %s", src_prefix + img_path, e)
+            res = {"error": str(e)}
+        res["etag"] = etags[img_path]
+        with lock:
+            sidecar[img_path] = res
+    if to_probe:
+        logging.info("probing %d files in %s", len(to_probe), folder_path)
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            list(pool.map(_probe, to_probe))
+    sidecar = {img_path: res for img_path, res in sidecar.items() if img_path in etags}
+    if changed:
+        dst_storage.put(sidecar_key, json.dumps(sidecar, indent=2).encode("utf-8"))
+    return sidecar
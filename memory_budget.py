@@ -0,0 +1,119 @@
+"""
+Admission of jobs against a memory budget.
+
+The postprocessing workers can each hold a decoded image of several GB, a
+MemoryBudget admits the files only while the sum of their estimated working
+sets fits in the budget, and records the peak of the estimates, the peak
+RSS and the time spent waiting for room.
+"""
+import multiprocessing
+import os
+import resource
+import threading
+import time
+
+
+def get_physical_memory():
+    """
+    returns the physical memory of the machine in bytes, None if unknown
+    """
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def _statm_rss(pid="self"):
+    with open("/proc/%s/statm" % pid) as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def get_rss(include_children=True):
+    """
+    returns the current resident memory of the process (and of its child processes,
+    for instance a pool of workers) in bytes. Falls back on the peak RSS where /proc
+    is not available.
+    """
+    try:
+        rss = _statm_rss()
+        if include_children:
+            for child in multiprocessing.active_children():
+                try:
+                    rss += _statm_rss(child.pid)
+                except OSError:
+                    pass
+        return rss
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class MemoryBudget:
+    """
+    Admits jobs against a budget of max_bytes, in the order of the calls to acquire():
+    a job waits until the jobs before it are admitted and its size fits in what is
+    left. A job larger than the budget is admitted when nothing else is running.
+    None means no limit (the sizes are still accounted).
+    """
+
+    def __init__(self, max_bytes=None):
+        self.max_bytes = max_bytes
+        self._cond = threading.Condition()
+        self._next_ticket = 0
+        self._serving = 0
+        self._in_use = 0
+        self._running = 0
+        self.admitted = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+        self.peak_bytes = 0
+        self.peak_rss = 0
+
+    def _fits(self, size):
+        if self._running == 0 or self.max_bytes is None:
+            return True
+        return self._in_use + size <= self.max_bytes
+
+    def acquire(self, size):
+        """
+        blocks until the job of size bytes is admitted, returns the time waited
+        """
+        start = time.monotonic()
+        with self._cond:
+            ticket = self._next_ticket
+            self._next_ticket += 1
+            while ticket != self._serving or not self._fits(size):
+                self._cond.wait()
+            self._serving += 1
+            self._in_use += size
+            self._running += 1
+            self.peak_bytes = max(self.peak_bytes, self._in_use)
+            wait = time.monotonic() - start
+            self.admitted += 1
+            self.wait_time += wait
+            self.max_wait = max(self.max_wait, wait)
+            if wait > 0.001:
+                self.waits += 1
+            # the next ticket may fit too
+            self._cond.notify_all()
+        return wait
+
+    def release(self, size):
+        rss = get_rss()
+        with self._cond:
+            self._in_use -= size
+            self._running -= 1
+            self.peak_rss = max(self.peak_rss, rss)
+            self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            return {
+                "max_bytes": self.max_bytes,
+                "admitted": self.admitted,
+                "waits": self.waits,
+                "wait_time": round(self.wait_time, 3),
+                "max_wait": round(self.max_wait, 3),
+                "peak_bytes": self.peak_bytes,
+                "peak_rss": self.peak_rss,
+            }
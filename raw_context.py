@@ -0,0 +1,99 @@
+"""
+A raw file read once for its whole postprocessing.
+
+For images with a color card, the white patch corrections and the output
+image used to read, parse and decode the file separately. A RawContext
+keeps the blob, the parsed EXIF and the RawPy object: the corrections are
+computed without a full demosaicing (see color_card.get_factors_from_cfa)
+and the output is demosaiced once from the same RawPy object, giving the
+same image as get_np_from_raw.
+"""
+import logging
+import threading
+from collections import OrderedDict
+
+import exifread
+import rawpy
+
+import color_card
+from raw_utils import postprocess_raw
+
+
+class RawContext:
+    """
+    A raw file read once: the blob, its EXIF tags and the RawPy object, shared by
+    the white patch corrections and the rendering of the output image.
+    """
+
+    def __init__(self, blob):
+        self.blob = blob
+        blob.seek(0)
+        self.exif = exifread.process_file(blob, details=False)
+        blob.seek(0)
+        try:
+            self.raw = rawpy.imread(blob)
+        except:
+            raise TypeError("Not a RAW file")
+
+    @property
+    def sizes(self):
+        return self.raw.sizes
+
+    def get_factors(self, bbox, target_lnsrgb_mean=0.89):
+        """
+        returns (wb_factors, exposure factor) from the white patch in bbox, see color_card.get_factors_from_cfa
+        """
+        wb_factors, exp_shift = color_card.get_factors_from_cfa(self.raw, bbox, target_lnsrgb_mean)
+        logging.info("get factors %s, %f from bbox %s" % (str(wb_factors), exp_shift, str(bbox)))
+        return wb_factors, exp_shift
+
+    def render(self, params, use_exif_rotation=False):
+        """
+        returns the output image, same as raw_utils.get_np_from_raw(blob, params, use_exif_rotation)
+        """
+        return postprocess_raw(self.raw, params, use_exif_rotation, self.blob)
+
+    def close(self):
+        self.raw.close()
+
+
+class RawContextCache:
+    """
+    The contexts of the files with a color card, kept from the computation of the
+    corrections until the file is postprocessed. The first max_items contexts are
+    kept (a context holds the blob and the raw data), the files of the next ones
+    are read again when they are postprocessed.
+    """
+
+    def __init__(self, max_items=2):
+        self.max_items = max_items
+        self._contexts = OrderedDict()
+        self._lock = threading.Lock()
+
+    def put(self, img_path, context):
+        """
+        keeps the context, returns False (and closes it) if the cache is full
+        """
+        with self._lock:
+            previous = self._contexts.get(img_path)
+            if previous is not None or len(self._contexts) < self.max_items:
+                self._contexts[img_path] = context
+                if previous is not None and previous is not context:
+                    previous.close()
+                return True
+        context.close()
+        return False
+
+    def __contains__(self, img_path):
+        with self._lock:
+            return img_path in self._contexts
+
+    def pop(self, img_path):
+        with self._lock:
+            return self._contexts.pop(img_path, None)
+
+    def close(self):
+        with self._lock:
+            for context in self._contexts.values():
+                context.close()
+            self._contexts.clear()
@@ -0,0 +1,153 @@
+"""
+RAW demosaicing in a pool of processes.
+
+raw.postprocess() is CPU-bound and a pool of threads does not scale on RAW
+folders. A RawDecodeService demosaics in worker processes; each worker
+writes its result into a multiprocessing.shared_memory block that the main
+process wraps as a numpy array without copying it (see SharedArray). The
+blocks are owned by the main process: the workers only create them, the
+main process unlinks them when the image is derived.
+
+Demosaicing holds a 16-bit image per file (in libraw, then in the output
+buffer), the number of files being demosaiced or waiting to be derived is
+capped by max_buffers.
+"""
+import io
+import logging
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+import rawpy
+
+from raw_utils import postprocess_raw
+
+# arguments of raw.postprocess() for each quality tier, replacing the ones of the corrections
+QUALITY_TIERS = {
+    "draft": {"half_size": True}, # no demosaicing, output at half the resolution
+    "fast": {"demosaic_algorithm": rawpy.DemosaicAlgorithm.LINEAR},
+    "normal": {"demosaic_algorithm": rawpy.DemosaicAlgorithm.AHD},
+    "best": {"demosaic_algorithm": rawpy.DemosaicAlgorithm.AAHD}, # same as the decoding in threads
+}
+
+
+def _demosaic_to_shared_memory(data, params, use_exif_rotation, quality):
+    """
+    runs in a worker process, returns (name, shape, dtype) of the shared memory block
+    with the demosaiced image
+    """
+    fp = io.BytesIO(data)
+    raw = rawpy.imread(fp)
+    try:
+        array = postprocess_raw(raw, params, use_exif_rotation, fp, QUALITY_TIERS[quality])
+    finally:
+        raw.close()
+    if array is None:
+        raise ValueError("could not decode RAW file nor its thumbnail")
+    shm = shared_memory.SharedMemory(create=True, size=max(1, array.nbytes))
+    try:
+        np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[...] = array
+    except:
+        shm.close()
+        shm.unlink()
+        raise
+    shm.close()
+    # the main process unlinks the block, the worker must not do it when it exits
+    resource_tracker.unregister(shm._name, "shared_memory")
+    return shm.name, array.shape, array.dtype.str
+
+
+class SharedArray:
+    """
+    A numpy array in a shared memory block written by a worker process. array
+    is a view on the block, close() frees the block and the buffer slot.
+    """
+
+    def __init__(self, name, shape, dtype, on_close=None):
+        self._shm = shared_memory.SharedMemory(name=name)
+        self.array = np.ndarray(shape, dtype=dtype, buffer=self._shm.buf)
+        self._on_close = on_close
+
+    def close(self):
+        if self._shm is None:
+            return
+        self.array = None
+        try:
+            self._shm.close()
+        except BufferError:
+            # a view on the array is still referenced, the mapping goes away with it
+            logging.debug("shared memory block %s still in use", self._shm.name)
+        self._shm.unlink()
+        self._shm = None
+        if self._on_close is not None:
+            self._on_close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class RawDecodeService:
+    """
+    Demosaics RAW files in a pool of processes. decode() blocks the calling
+    thread until the image is available (so the pool is used by at least as
+    many threads as processes) and returns a SharedArray.
+    """
+
+    def __init__(self, processes, quality="best", max_buffers=None):
+        if quality not in QUALITY_TIERS:
+            raise ValueError("unknown RAW quality %s, must be one of %s" % (quality, ", ".join(QUALITY_TIERS)))
+        self.quality = quality
+        self.max_buffers = max_buffers or 2 * processes
+        self._buffers = threading.BoundedSemaphore(self.max_buffers)
+        # fork is not safe with the S3 and upload threads of the main process
+        self._pool = ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context("spawn"))
+        self._lock = threading.Lock()
+        self.decodes = 0
+        self.errors = 0
+        self.decode_time = 0.0
+        self.buffer_wait_time = 0.0
+
+    def decode(self, blob, params, use_exif_rotation=False):
+        """
+        returns a SharedArray with the image of get_np_from_raw(blob, params, use_exif_rotation)
+        at the quality of the service, to be closed once derived
+        """
+        if isinstance(params, (tuple, list)):
+            # the exif tags of the corrections are not used by the demosaicing
+            params = (params[0], params[1], None)
+        data = blob.getvalue() if isinstance(blob, io.BytesIO) else blob.read()
+        start = time.monotonic()
+        self._buffers.acquire()
+        acquired = time.monotonic()
+        try:
+            name, shape, dtype = self._pool.submit(_demosaic_to_shared_memory, data, params, use_exif_rotation, self.quality).result()
+        except:
+            self._buffers.release()
+            with self._lock:
+                self.errors += 1
+            raise
+        with self._lock:
+            self.decodes += 1
+            self.buffer_wait_time += acquired - start
+            self.decode_time += time.monotonic() - acquired
+        return SharedArray(name, shape, dtype, on_close=self._buffers.release)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "quality": self.quality,
+                "max_buffers": self.max_buffers,
+                "decodes": self.decodes,
+                "errors": self.errors,
+                "decode_time": round(self.decode_time, 3),
+                "buffer_wait_time": round(self.buffer_wait_time, 3),
+            }
+
+    def close(self):
+        self._pool.shutdown()
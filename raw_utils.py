@@ -2,9 +2,9 @@ import rawpy
 from PIL import Image, ImageFile
 import cv2
 import logging
-import statistics
 import io
 import numpy as np
+import color_card
 
 def is_likely_raw(fname):
     """
@@ -37,23 +37,12 @@ def get_median_cam_nrgb(raw, bbox):
 
     For instance if the image has 4 channels, the result could be [0.12, 0.34, 0.18, 0.35]
     """
-    x_0, y_0, w, h = bbox
-    vals_per_c = [[], [], [], []] # initialize for the number of channels
-    for x in range(x_0, x_0+w):
-        for y in range(y_0, y_0+h):
-            c = raw.raw_color(y, x)
-            v = get_visible_cam_rgb(raw, x, y)
-            vals_per_c[c].append(v)
-    median_cam_rgb_per_c = [statistics.median(vs) for vs in vals_per_c]
-    median_cam_nrgb_per_c = []
-    for c, median_cam_rgb in enumerate(median_cam_rgb_per_c):
-        median_cam_nrgb = cam_rgb_to_nrgb(raw, median_cam_rgb, c)
-        median_cam_nrgb_per_c.append(median_cam_nrgb)
-    return median_cam_nrgb_per_c
+    return color_card.get_median_cam_nrgb(raw, bbox)
 
 def get_median_cam_rgb2(raw, bbox):
     """
-    same signature as get_median_cam_nrgb but uses a different technique, copied from
+    same signature as get_median_cam_nrgb but uses a different technique (on 8-bit values,
+    get_factors_from_raw uses the 16-bit version in color_card), copied from
 
     https://github.com/letmaik/rawpy-notebooks/blob/master/colour-negative/colour-negative.ipynb
 
@@ -117,10 +106,8 @@ def get_factors_from_raw(raw, bbox, target_lnsrgb_mean=0.89):
     by default we assume that the target linear normalized sRGB target is 0.89,
     corresponding to the white patch on usual color cards.
     """
-    medians = get_median_cam_rgb2(raw, bbox)
-    logging.info("get medians %s", str(medians))
-    wb_factors = get_wb_factors_from_median_cam_rgb(medians)
-    exp_shift = get_exposure_factor(raw, wb_factors, bbox, target_lnsrgb_mean)
+    # one demosaicing shared by the white balance and exposure estimations
+    wb_factors, exp_shift = color_card.get_factors_from_raw(raw, bbox, target_lnsrgb_mean)
     logging.info("get factors %s, %f from bbox %s" % (str(wb_factors), exp_shift, str(bbox)))
     return wb_factors, exp_shift
 
@@ -148,12 +135,16 @@ def get_np_from_raw(fp, params, use_exif_rotation):
     - "base" to get the untouched matrix (resulting in 16 bit sRGB encoded array, not currently handled by Pillow)
     - a set of two values: a list of 4 floats (channel correction factors) and an int (bps)
     """
-    raw = None
-    array = None
     try:
         raw = rawpy.imread(fp)
     except:
         raise TypeError("Not a RAW file")
+    return postprocess_raw(raw, params, use_exif_rotation, fp)
+
+def get_postprocess_kwargs(params, use_exif_rotation):
+    """
+    returns the arguments of raw.postprocess() for params (see get_np_from_raw)
+    """
     # see https://letmaik.github.io/rawpy/api/rawpy.Params.html
     # no auto_scale is a bit misleading a should always be False, it just casts camera rgb ints into 16 bit in a color space
     postprocess_kwargs = {
@@ -191,6 +182,16 @@ def get_np_from_raw(fp, params, use_exif_rotation):
             postprocess_kwargs["no_auto_bright"] = True
         else:
             postprocess_kwargs["auto_bright_thr"] = 0.0001
+    return postprocess_kwargs
+
+def postprocess_raw(raw, params, use_exif_rotation, fp, overrides=None):
+    """
+    same as get_np_from_raw on an opened RawPy object, fp is only read again if the demosaicing fails.
+    overrides are arguments of raw.postprocess() replacing the ones from params
+    """
+    postprocess_kwargs = get_postprocess_kwargs(params, use_exif_rotation)
+    if overrides:
+        postprocess_kwargs.update(overrides)
     try:
         array = raw.postprocess(**postprocess_kwargs)
     except:
@@ -201,48 +202,120 @@ def get_np_from_raw(fp, params, use_exif_rotation):
     return array
 
 
+def _np_from_thumb(thumb, min_size):
+    if thumb.format == rawpy.ThumbFormat.JPEG:
+        img = Image.open(io.BytesIO(thumb.data))
+        # decode the jpeg at a reduced scale, no smaller than min_size
+        img.draft("RGB", (min_size, min_size))
+        return np.array(img.convert("RGB"))
+    if thumb.format == rawpy.ThumbFormat.BITMAP and thumb.data.ndim == 3:
+        return thumb.data
+    return None
+
+def get_preview_np_from_raw(raw, min_size):
+    """
+    returns an 8-bit RGB array of the raw image, with a longest side of at least
+    min_size, cheaper than a full demosaic, or None if the full demosaic is needed.
+
+    The embedded preview is used when it is large enough and has the same
+    framing and orientation as the sensor image, otherwise the image is
+    decoded at half size (each 2x2 block of the bayer pattern gives a pixel,
+    there is no demosaicing).
+    """
+    width, height = raw.sizes.width, raw.sizes.height
+    try:
+        thumb = raw.extract_thumb()
+    except (rawpy.LibRawNoThumbnailError, rawpy.LibRawUnsupportedThumbnailError):
+        thumb = None
+    except rawpy.LibRawError as e:
+        logging.debug("could not extract the thumbnail: %s", e)
+        thumb = None
+    if thumb is not None:
+        try:
+            array = _np_from_thumb(thumb, min_size)
+        except Exception as e:
+            logging.debug("could not decode the thumbnail: %s", e)
+            array = None
+        if array is not None:
+            t_height, t_width = array.shape[:2]
+            # the previews of some cameras are rotated or cropped differently
+            same_framing = (t_width >= t_height) == (width >= height) and abs(t_width / t_height - width / height) < 0.02 * width / height
+            if same_framing and max(t_width, t_height) >= min_size:
+                return array
+    if max(width, height) // 2 >= min_size:
+        return raw.postprocess(half_size=True, output_bps=8, use_camera_wb=True, user_flip=0)
+    return None
+
+
 class RawImageFile(ImageFile.ImageFile):
+    """
+    Opening only reads the raw data, the demosaicing is done on load(). Calling
+    draft() with a size (as Image.thumbnail() and image_decode do) switches to
+    a preview decode (see get_preview_np_from_raw) when it is large enough.
+
+    This is the 8-bit decoding used for preprocessing, scam_postprocess uses
+    get_np_from_raw for the full quality (AAHD) demosaicing.
+    """
     format = 'RAW'
     format_description = "camera raw image"
 
     def _open(self):
-        array = None
         try:
-            raw = rawpy.imread(self.fp)
-            # we only open in 8-bits in PIL, for pre-processing
-            array = raw.postprocess(output_bps=8, use_camera_wb=True, user_flip=0)
+            self._raw = rawpy.imread(self.fp)
         except:
             raise TypeError("Not a RAW file")
+        self._array = None
+        sizes = self._raw.sizes
+        if sizes.pixel_aspect != 1.0:
+            # libraw stretches these images, the size is only known after the demosaicing
+            self._array = self._demosaic()
+            self._size = (self._array.shape[1], self._array.shape[0])
+        else:
+            # size in pixels (width, height), without applying the orientation
+            self._size = (sizes.width, sizes.height)
+        # we only open in 8-bits in PIL, for pre-processing
+        self._mode = "RGB"
+        # TODO extract exif?
+        self.tile = [ImageFile._Tile('RAW', (0, 0) + self.size, 0, (self,))]
 
-        # size in pixels (width, height)
-        self._size = (array.shape[1], array.shape[0])
+    def _demosaic(self):
+        return self._raw.postprocess(output_bps=8, use_camera_wb=True, user_flip=0)
 
-        # mode setting
-        typekey = (1, 1) + array.shape[2:], array.__array_interface__["typestr"]
+    def draft(self, mode, size):
+        if size is None or self._array is not None or not self.tile:
+            return None
         try:
-            if hasattr(self, "_mode"):
-                # for recent versions of pillow
-                self._mode = Image._fromarray_typemap[typekey][1]
-            else:
-                self.mode = Image._fromarray_typemap[typekey][1]
-        except KeyError as e:
-            raise TypeError("Cannot handle this data type: %s, %s" % typekey) from e
+            array = get_preview_np_from_raw(self._raw, max(size))
+        except Exception as e:
+            logging.warning("could not get the raw preview: %s", e)
+            return None
+        if array is None:
+            return None
+        self._array = array
+        self._size = (array.shape[1], array.shape[0])
+        self.tile = [ImageFile._Tile('RAW', (0, 0) + self.size, 0, (self,))]
+        return self.mode, (0, 0) + self.size
 
-        # TODO extract exif?
+    def get_array(self):
+        if self._array is None:
+            self._array = self._demosaic()
+        return self._array
 
-        offset = self.fp.tell()
-        self.tile = [
-            ('RAW', (0, 0) + self.size, offset, (array, self.mode,))
-        ]
+    def load_end(self):
+        # the raw data is not needed anymore
+        self._array = None
+        self._raw.close()
 
 
 class RawDecoder(ImageFile.PyDecoder):
     _pulls_fd = True
 
     def decode(self, buffer):
-        (data, mode) = self.args[0], self.args[1]
-        raw_decoder = Image._getdecoder(mode, 'raw', (mode, data.strides[0]))
-        raw_decoder.setimage(self.im)
+        data = self.args[0].get_array()
+        if data.shape[0] != self.state.ysize or data.shape[1] != self.state.xsize:
+            raise ValueError("unexpected size of the demosaiced image: %dx%d" % (data.shape[1], data.shape[0]))
+        raw_decoder = Image._getdecoder(self.mode, 'raw', (self.mode, data.strides[0]))
+        raw_decoder.setimage(self.im, self.state.extents())
         return raw_decoder.decode(data)
 
 def register_raw_opener(use_exif_rotation=False):
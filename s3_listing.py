@@ -0,0 +1,228 @@
+import os
+import gzip
+import json
+import time
+import logging
+import threading
+from bisect import bisect_left
+from hashlib import sha256
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+MANIFEST_VERSION = 1
+
+def _call(fn, *args, **kwargs):
+    return fn(*args, **kwargs)
+
+def _list_level(client, bucket, prefix, call=_call):
+    """
+    lists one level of prefix with Delimiter='/', returns (objects, sub-prefixes)
+    """
+    objs = []
+    sub_prefixes = []
+    kwargs = {"Bucket": bucket, "Prefix": prefix, "Delimiter": "/"}
+    while True:
+        response = call(client.list_objects_v2, **kwargs)
+        for obj in response.get("Contents", []):
+            objs.append({
+                "Key": obj["Key"],
+                "Size": obj["Size"],
+                "ETag": obj["ETag"],
+                "LastModified": int(obj["LastModified"].timestamp()),
+            })
+        for cp in response.get("CommonPrefixes", []):
+            sub_prefixes.append(cp["Prefix"])
+        continuation_token = response.get("NextContinuationToken")
+        if not continuation_token:
+            break
+        kwargs["ContinuationToken"] = continuation_token
+    return objs, sub_prefixes
+
+def list_objects(client, bucket, prefix, max_workers=16, call=_call):
+    """
+    lists all the objects under prefix, walking the sub-prefixes (split on '/')
+    concurrently. Returns a list of dicts with Key, Size, ETag and LastModified
+    (in seconds since epoch), sorted by key. The requests are done through
+    call(fn, *args, **kwargs), typically to retry them (see utils.s3_call).
+
+    If prefix doesn't end with '/', objects in sibling folders sharing the same
+    beginning (ex: W1 / W12) are included, as with a simple list_objects_v2.
+    """
+    res = []
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        pending = {pool.submit(_list_level, client, bucket, prefix, call)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                objs, sub_prefixes = future.result()
+                res.extend(objs)
+                for sub_prefix in sub_prefixes:
+                    pending.add(pool.submit(_list_level, client, bucket, sub_prefix, call))
+    res.sort(key=lambda obj: obj["Key"])
+    return res
+
+
+class FolderManifest:
+    """
+    The result of a listing of a prefix, stored in a columnar way (keys relative
+    to the prefix) so that it is compact on disk.
+    """
+
+    def __init__(self, bucket, prefix, objs, date=None):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.date = date if date is not None else time.time()
+        objs = sorted(objs, key=lambda obj: obj["Key"])
+        self.keys = [obj["Key"] for obj in objs]
+        self.sizes = [obj["Size"] for obj in objs]
+        self.etags = [obj["ETag"] for obj in objs]
+        self.mtimes = [obj["LastModified"] for obj in objs]
+
+    def __len__(self):
+        return len(self.keys)
+
+    def age(self):
+        return time.time() - self.date
+
+    def objects(self, prefix=None):
+        """
+        returns the objects (as returned by list_objects) under prefix, which can be
+        a sub-prefix of the prefix of the manifest
+        """
+        if prefix is None:
+            prefix = self.prefix
+        i = bisect_left(self.keys, prefix)
+        res = []
+        while i < len(self.keys) and self.keys[i].startswith(prefix):
+            res.append({
+                "Key": self.keys[i],
+                "Size": self.sizes[i],
+                "ETag": self.etags[i],
+                "LastModified": self.mtimes[i],
+            })
+            i += 1
+        return res
+
+    def diff(self, other):
+        """
+        returns {"added": [...], "removed": [...], "modified": [...]} keys between
+        this (older) manifest and other
+        """
+        old = {k: (e, s) for k, e, s in zip(self.keys, self.etags, self.sizes)}
+        new = {k: (e, s) for k, e, s in zip(other.keys, other.etags, other.sizes)}
+        return {
+            "added": [k for k in other.keys if k not in old],
+            "removed": [k for k in self.keys if k not in new],
+            "modified": [k for k in other.keys if k in old and old[k] != new[k]],
+        }
+
+    def to_json(self):
+        return {
+            "version": MANIFEST_VERSION,
+            "bucket": self.bucket,
+            "prefix": self.prefix,
+            "date": self.date,
+            "keys": [k[len(self.prefix):] for k in self.keys],
+            "sizes": self.sizes,
+            "etags": [e.strip('"') for e in self.etags],
+            "mtimes": self.mtimes,
+        }
+
+    @classmethod
+    def from_json(cls, obj):
+        if obj.get("version") != MANIFEST_VERSION:
+            raise ValueError("unsupported manifest version %s" % obj.get("version"))
+        prefix = obj["prefix"]
+        objs = [{"Key": prefix + k, "Size": s, "ETag": '"%s"' % e, "LastModified": m}
+                for k, s, e, m in zip(obj["keys"], obj["sizes"], obj["etags"], obj["mtimes"])]
+        return cls(obj["bucket"], prefix, objs, date=obj["date"])
+
+
+class ManifestStore:
+    """
+    Manifests saved as gzipped json files in a local directory, one per (bucket, prefix).
+    A listing of a prefix can be served by the manifest of any parent prefix as long
+    as it is more recent than max_age (in seconds).
+    """
+
+    def __init__(self, manifest_dir, max_age=24*3600):
+        self.manifest_dir = manifest_dir
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._loaded = {}
+        os.makedirs(manifest_dir, exist_ok=True)
+
+    def _path(self, bucket, prefix):
+        return os.path.join(self.manifest_dir, sha256((bucket+"/"+prefix).encode("utf-8")).hexdigest()+".json.gz")
+
+    def load(self, bucket, prefix):
+        """
+        returns the saved manifest for exactly (bucket, prefix), or None
+        """
+        path = self._path(bucket, prefix)
+        try:
+            mtime = os.path.getmtime(path)
+        except FileNotFoundError:
+            return None
+        with self._lock:
+            cached = self._loaded.get(path)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+        try:
+            with gzip.open(path, "rt", encoding="utf-8") as f:
+                manifest = FolderManifest.from_json(json.load(f))
+        except (OSError, ValueError, KeyError) as e:
+            logging.warning("invalid manifest %s: %s", path, e)
+            return None
+        with self._lock:
+            self._loaded[path] = (mtime, manifest)
+        return manifest
+
+    def save(self, manifest):
+        path = self._path(manifest.bucket, manifest.prefix)
+        tmp_path = "%s.%d.%d.tmp" % (path, os.getpid(), threading.get_ident())
+        with gzip.open(tmp_path, "wt", encoding="utf-8") as f:
+            json.dump(manifest.to_json(), f, separators=(",", ":"))
+        os.replace(tmp_path, path)
+
+    def find(self, bucket, prefix):
+        """
+        returns a fresh manifest covering prefix (its own or a parent's), or None
+        """
+        candidates = [prefix]
+        pos = prefix.rfind("/", 0, len(prefix) - 1)
+        while pos >= 0:
+            candidates.append(prefix[:pos + 1])
+            pos = prefix.rfind("/", 0, pos)
+        for candidate in candidates:
+            manifest = self.load(bucket, candidate)
+            if manifest is not None and (self.max_age is None or manifest.age() <= self.max_age):
+                return manifest
+        return None
+
+    def refresh(self, client, bucket, prefix, max_workers=16, call=_call):
+        """
+        lists prefix again, saves the new manifest and returns (manifest, diff with
+        the previous manifest or None)
+        """
+        old = self.load(bucket, prefix)
+        manifest = FolderManifest(bucket, prefix, list_objects(client, bucket, prefix, max_workers, call))
+        diff = None
+        if old is not None:
+            diff = old.diff(manifest)
+            logging.info("manifest of %s: %d added, %d removed, %d modified", prefix,
+                         len(diff["added"]), len(diff["removed"]), len(diff["modified"]))
+        self.save(manifest)
+        return manifest, diff
+
+if __name__ == "__main__":
+    # builds or refreshes the manifest of a prefix, ex: python s3_listing.py NLM1/ ~/.cache/scam_manifests/
+    import sys
+    from utils import get_s3_client, BUCKET_NAME
+    logging.basicConfig(level=logging.INFO)
+    if len(sys.argv) < 3:
+        print("usage: python s3_listing.py prefix manifest_dir [bucket]")
+        sys.exit(1)
+    bucket = sys.argv[3] if len(sys.argv) > 3 else BUCKET_NAME
+    start = time.time()
+    manifest, _ = ManifestStore(sys.argv[2]).refresh(get_s3_client(), bucket, sys.argv[1])
+    logging.info("listed %d objects in %.1fs", len(manifest), time.time() - start)
@@ -0,0 +1,168 @@
+import time
+import random
+import logging
+import threading
+
+import botocore
+import botocore.exceptions
+
+THROTTLING_ERROR_CODES = {"SlowDown", "503", "ServiceUnavailable", "Throttling", "ThrottlingException",
+                          "RequestLimitExceeded", "TooManyRequests", "429"}
+TRANSIENT_ERROR_CODES = {"500", "InternalError", "RequestTimeout", "RequestTimeoutException", "502", "504"}
+
+def is_throttling_error(e):
+    return isinstance(e, botocore.exceptions.ClientError) and e.response.get("Error", {}).get("Code") in THROTTLING_ERROR_CODES
+
+def is_retryable_error(e):
+    if is_throttling_error(e):
+        return True
+    if isinstance(e, botocore.exceptions.ClientError):
+        return e.response.get("Error", {}).get("Code") in TRANSIENT_ERROR_CODES
+    # network errors, including the ones happening while reading a response body
+    return isinstance(e, (botocore.exceptions.ConnectionError, botocore.exceptions.HTTPClientError,
+                          botocore.exceptions.IncompleteReadError, botocore.exceptions.ResponseStreamingError,
+                          ConnectionError, TimeoutError))
+
+
+class AIMDLimiter:
+    """
+    Limits the number of concurrent requests with additive increase / multiplicative
+    decrease: the limit is halved when the server throttles us (at most once per
+    cooldown seconds, as many requests fail at the same time) and grows by one
+    after limit successful requests.
+    """
+
+    def __init__(self, max_limit, min_limit=1, cooldown=1.0):
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.cooldown = cooldown
+        self.limit = max_limit
+        self._inflight = 0
+        self._successes = 0
+        self._last_decrease = 0
+        self._cond = threading.Condition()
+
+    def set_max_limit(self, max_limit):
+        with self._cond:
+            self.max_limit = max_limit
+            self.limit = min(max(self.limit, self.min_limit), max_limit)
+            self._cond.notify_all()
+
+    def acquire(self):
+        with self._cond:
+            while self._inflight >= self.limit:
+                self._cond.wait()
+            self._inflight += 1
+
+    def release(self):
+        with self._cond:
+            self._inflight -= 1
+            self._cond.notify()
+
+    def on_success(self):
+        with self._cond:
+            if self.limit >= self.max_limit:
+                return
+            self._successes += 1
+            if self._successes >= self.limit:
+                self._successes = 0
+                self.limit += 1
+                self._cond.notify()
+
+    def on_throttle(self):
+        with self._cond:
+            now = time.monotonic()
+            if now - self._last_decrease < self.cooldown:
+                return
+            self._last_decrease = now
+            self._successes = 0
+            new_limit = max(self.min_limit, self.limit // 2)
+            if new_limit != self.limit:
+                logging.warning("S3 throttling, reducing concurrency from %d to %d", self.limit, new_limit)
+            self.limit = new_limit
+
+
+class RetryStats:
+    """
+    Counters of the requests going through a RetryPolicy, reset for each folder
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.requests = 0
+            self.retries = 0
+            self.throttles = 0
+            self.failures = 0
+            self.min_concurrency = None
+
+    def record(self, requests=0, retries=0, throttles=0, failures=0, concurrency=None):
+        with self._lock:
+            self.requests += requests
+            self.retries += retries
+            self.throttles += throttles
+            self.failures += failures
+            if concurrency is not None and (self.min_concurrency is None or concurrency < self.min_concurrency):
+                self.min_concurrency = concurrency
+
+    def stats(self):
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "retries": self.retries,
+                "throttles": self.throttles,
+                "failures": self.failures,
+                "min_concurrency": self.min_concurrency,
+            }
+
+
+class RetryPolicy:
+    """
+    Calls functions doing S3 requests, retrying throttling and transient errors
+    with exponential backoff and full jitter. Other errors (404, 403, etc.) are
+    raised immediately. The exception raised after the last attempt has an
+    attempts attribute.
+    """
+
+    def __init__(self, max_attempts=8, base_backoff=0.2, max_backoff=20.0, limiter=None, stats=None):
+        self.max_attempts = max_attempts
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.limiter = limiter
+        self.stats = stats if stats is not None else RetryStats()
+
+    def backoff(self, attempt):
+        return random.uniform(0, min(self.max_backoff, self.base_backoff * 2 ** attempt))
+
+    def call(self, fn, *args, **kwargs):
+        attempt = 0
+        while True:
+            attempt += 1
+            if self.limiter is not None:
+                self.limiter.acquire()
+            try:
+                res = fn(*args, **kwargs)
+            except Exception as e:
+                if self.limiter is not None:
+                    self.limiter.release()
+                retryable = is_retryable_error(e)
+                throttled = retryable and is_throttling_error(e)
+                if throttled and self.limiter is not None:
+                    self.limiter.on_throttle()
+                concurrency = self.limiter.limit if self.limiter is not None else None
+                if not retryable or attempt >= self.max_attempts:
+                    self.stats.record(requests=1, throttles=int(throttled), failures=int(retryable), concurrency=concurrency)
+                    e.attempts = attempt
+                    raise
+                self.stats.record(requests=1, retries=1, throttles=int(throttled), concurrency=concurrency)
+                logging.debug("retrying after %s (attempt %d)", e, attempt)
+                time.sleep(self.backoff(attempt))
+                continue
+            if self.limiter is not None:
+                self.limiter.release()
+                self.limiter.on_success()
+            self.stats.record(requests=1)
+            return res
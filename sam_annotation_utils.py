@@ -5,36 +5,34 @@ import statistics
 import copy
 import math
 import json
+import functools
 
 DEBUG = True
 
-class AnnotationInfo:
-    def __init__(self, sam_annotation, original_img_width, original_img_height, rotation=0):
-        self.sam_annotation = sam_annotation
-        self.mask = sam_annotation["segmentation"]
-        self.mask = (255*self.mask.astype(np.uint8)).astype('uint8')  #convert to an unsigned byte
-        if rotation != 0:
-            # rotation is in degrees counter clockwise
-            cv2_rot = cv2.ROTATE_90_COUNTERCLOCKWISE
-            if rotation == 270 or rotation == -90:
-                cv2_rot = cv2.ROTATE_90_CLOCKWISE
-            if rotation == 180:
-                cv2_rot = cv2.ROTATE_180
-            self.mask = cv2.rotate(self.mask, cv2_rot)
-            if rotation == 90 or rotation == 270 or rotation == -90:
-                original_img_width, original_img_height = original_img_height, original_img_width
-        # SAM masks often need some cleanup
-        cv2.erode(self.mask, kernel=np.ones((30, 30)), iterations=1)
-        # resize the mask
-        self.mask = cv2.resize(self.mask, (original_img_width, original_img_height), interpolation = cv2.INTER_NEAREST ).astype('uint8')
-        self.contour, self.contour_area = self.get_largest_contour()
-        # some normalization to make it easier
-        (cx, cy), (w, h), angle = cv2.minAreaRect(self.contour)
-        if angle > 45:
-            angle = angle-90
-            w, h = h, w
-        self.minAreaRect = ((cx, cy), (w, h), angle)
-        self.bbox = cv2.boundingRect(self.contour)
+def get_nearest_spans(src_len, dst_len):
+    """
+    returns (first, last): the first and last destination index of each source index
+    when an axis of src_len pixels is resized to dst_len pixels with cv2.INTER_NEAREST
+    """
+    src_idx = cv2.resize(np.arange(src_len, dtype=np.float32).reshape(1, -1), (dst_len, 1), interpolation=cv2.INTER_NEAREST)[0].astype(np.int64)
+    first = np.searchsorted(src_idx, np.arange(src_len), side="left")
+    last = np.searchsorted(src_idx, np.arange(src_len), side="right") - 1
+    return first, last
+
+# all the masks of an image have the same spans
+_get_nearest_spans_cached = functools.lru_cache(maxsize=16)(get_nearest_spans)
+
+class AnnotationGeometry:
+    """
+    the geometry of an annotation (contour area, minAreaRect and bbox) in the coordinates
+    of the original image of img_w x img_h (after rotation), without its mask
+    """
+    def __init__(self, contour_area, minAreaRect, bbox, img_w, img_h):
+        self.contour_area = contour_area
+        self.minAreaRect = minAreaRect
+        self.bbox = bbox
+        self.img_w = img_w
+        self.img_h = img_h
         self.warns = []
 
     def to_scam_json_obj(self):
@@ -47,51 +45,24 @@ class AnnotationInfo:
     def toJSON(self):
         return json.dumps(self.to_scam_json_obj)
 
-    def debug_mask(self, base_fname):
-        print("write %s" % "debug/"+base_fname+"_mask.png")
-        cv2.imwrite("debug/"+base_fname+"_mask.png", self.mask)
-        contours, _ = cv2.findContours(self.mask, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
-        areas = [cv2.contourArea(c) for c in contours]
-        max_index = np.argmax(areas)
-        color_mask = np.ones((self.mask.shape[0], self.mask.shape[1], 3))
-        cv2.drawContours(color_mask, contours, max_index, (0,255,0))
-        cv2.rectangle(color_mask, (self.bbox[0], self.bbox[1]), (self.bbox[0]+self.bbox[2], self.bbox[1]+self.bbox[3]), (255,0,0), 3)
-        box = cv2.boxPoints(self.minAreaRect)
-        box = np.int0(box)
-        cv2.drawContours(color_mask,[box],0,(0,0,255),2)
-        cv2.imwrite("debug/"+base_fname+"_contours.png", color_mask)
-
     def nb_edges_touched(self, px=20):
         nb_edges = 0
         # crop_box is left, top, right, bottom
         # bbox is [x,y,w,h]
-        # mask.shape is [nb_rows=h,nb_cols=w,nb_channels]
         for i in range(2):
             if self.bbox[i] < px:
                 nb_edges += 1
-        if (abs(self.bbox[0]+self.bbox[2] - self.mask.shape[1]) < px):
+        if (abs(self.bbox[0]+self.bbox[2] - self.img_w) < px):
                 nb_edges += 1
-        if (abs(self.bbox[1]+self.bbox[3] - self.mask.shape[0]) < px):
+        if (abs(self.bbox[1]+self.bbox[3] - self.img_h) < px):
                 nb_edges += 1
         return nb_edges
 
     def touches_top_bottom(self, px=20):
-        #print("top, bottom? %d - %d / 0 - %d" % (self.bbox[1], self.bbox[1]+self.bbox[3], self.mask.shape[0]))
-        return self.bbox[1] < px and abs(self.bbox[1]+self.bbox[3] - self.mask.shape[0]) < px
+        return self.bbox[1] < px and abs(self.bbox[1]+self.bbox[3] - self.img_h) < px
 
     def touches_left_right(self, px=20):
-        #print("top, bottom? %d - %d / 0 - %d" % (self.bbox[1], self.bbox[1]+self.bbox[3], self.mask.shape[0]))
-        return self.bbox[0] < px and abs(self.bbox[0]+self.bbox[2] - self.mask.shape[1]) < px
-
-    def get_largest_contour(self):
-        """ get the largest contour.
-            we can expect that SAM returns masks that are just one contour but it's not
-            always the case so we take the largest one
-        """
-        contours, _ = cv2.findContours(self.mask, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
-        areas = [cv2.contourArea(c) for c in contours]
-        max_index = np.argmax(areas)
-        return contours[max_index], areas[max_index]
+        return self.bbox[0] < px and abs(self.bbox[0]+self.bbox[2] - self.img_w) < px
 
     def squarishness(self):
         """
@@ -116,6 +87,87 @@ class AnnotationInfo:
 
         self.minAreaRect = ((cx, cy), (w, h), angle)
 
+class AnnotationInfo(AnnotationGeometry):
+    def __init__(self, sam_annotation, original_img_width, original_img_height, rotation=0):
+        self.sam_annotation = sam_annotation
+        self.mask = sam_annotation["segmentation"]
+        self.mask = (255*self.mask.astype(np.uint8)).astype('uint8')  #convert to an unsigned byte
+        if rotation != 0:
+            # rotation is in degrees counter clockwise
+            cv2_rot = cv2.ROTATE_90_COUNTERCLOCKWISE
+            if rotation == 270 or rotation == -90:
+                cv2_rot = cv2.ROTATE_90_CLOCKWISE
+            if rotation == 180:
+                cv2_rot = cv2.ROTATE_180
+            self.mask = cv2.rotate(self.mask, cv2_rot)
+            if rotation == 90 or rotation == 270 or rotation == -90:
+                original_img_width, original_img_height = original_img_height, original_img_width
+        # dimensions of the (rotated) original image, the coordinates are in this space
+        self.img_w = original_img_width
+        self.img_h = original_img_height
+        mask_h, mask_w = self.mask.shape
+        if original_img_width >= mask_w and original_img_height >= mask_h:
+            self.contour, self.contour_area = self.get_scaled_largest_contour()
+        else:
+            # the mask is larger than the image, the geometry is computed on the resized mask
+            self.mask = cv2.resize(self.mask, (original_img_width, original_img_height), interpolation = cv2.INTER_NEAREST ).astype('uint8')
+            self.contour, self.contour_area = self.get_largest_contour()
+        # some normalization to make it easier
+        (cx, cy), (w, h), angle = cv2.minAreaRect(self.contour)
+        if angle > 45:
+            angle = angle-90
+            w, h = h, w
+        super().__init__(self.contour_area, ((cx, cy), (w, h), angle), cv2.boundingRect(self.contour), self.img_w, self.img_h)
+
+    def debug_mask(self, base_fname):
+        print("write %s" % "debug/"+base_fname+"_mask.png")
+        mask = cv2.resize(self.mask, (self.img_w, self.img_h), interpolation = cv2.INTER_NEAREST)
+        cv2.imwrite("debug/"+base_fname+"_mask.png", mask)
+        color_mask = np.ones((self.img_h, self.img_w, 3))
+        cv2.drawContours(color_mask, [self.contour], 0, (0,255,0))
+        cv2.rectangle(color_mask, (self.bbox[0], self.bbox[1]), (self.bbox[0]+self.bbox[2], self.bbox[1]+self.bbox[3]), (255,0,0), 3)
+        box = cv2.boxPoints(self.minAreaRect)
+        box = np.int0(box)
+        cv2.drawContours(color_mask,[box],0,(0,0,255),2)
+        cv2.imwrite("debug/"+base_fname+"_contours.png", color_mask)
+
+    def get_largest_contour(self):
+        """ get the largest contour.
+            we can expect that SAM returns masks that are just one contour but it's not
+            always the case so we take the largest one
+        """
+        contours, _ = cv2.findContours(self.mask, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
+        areas = [cv2.contourArea(c) for c in contours]
+        max_index = np.argmax(areas)
+        return contours[max_index], areas[max_index]
+
+    def get_scaled_largest_contour(self):
+        """ get the largest contour in the coordinates of the original image, without
+            resizing the mask to the original resolution.
+
+            The resizing with cv2.INTER_NEAREST repeats each mask pixel over a span of
+            pixels of the original image. The contour is found on the mask upsampled 2x,
+            where each point is in the first or second half of a mask pixel, and is mapped
+            to the first or last pixel of the span of that mask pixel. The bbox and the
+            convex hull (so the minAreaRect) are the ones of the resized mask, the area only
+            differs by a fraction of a pixel at the concave corners.
+        """
+        mask_h, mask_w = self.mask.shape
+        # only the part of the mask with pixels is upsampled
+        x0, y0, w, h = cv2.boundingRect(self.mask)
+        contours = []
+        if w > 0 and h > 0:
+            mask2 = cv2.resize(self.mask[y0:y0+h, x0:x0+w], (2*w, 2*h), interpolation = cv2.INTER_NEAREST)
+            contours, _ = cv2.findContours(mask2, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE, offset=(2*x0, 2*y0))
+        areas = [cv2.contourArea(c) for c in contours]
+        points = contours[np.argmax(areas)][:, 0, :]
+        x_first, x_last = _get_nearest_spans_cached(mask_w, self.img_w)
+        y_first, y_last = _get_nearest_spans_cached(mask_h, self.img_h)
+        x = np.where(points[:, 0] % 2 == 0, x_first[points[:, 0] // 2], x_last[points[:, 0] // 2])
+        y = np.where(points[:, 1] % 2 == 0, y_first[points[:, 1] // 2], y_last[points[:, 1] // 2])
+        contour = np.stack([x, y], axis=1).astype(np.int32).reshape(-1, 1, 2)
+        return contour, cv2.contourArea(contour)
+
 def find_anomalies(data):
     """
     Function to Detection Outlier on one-dimentional datasets
@@ -267,55 +319,13 @@ def get_image_ann_list(sam_ann_list, original_img_width, original_img_height, de
     for sam_ann in sam_ann_list:
         ann_list.append(AnnotationInfo(sam_ann, original_img_width, original_img_height))
     anns_by_area = sorted(ann_list, key=(lambda x: x.contour_area), reverse=True)
-    image_anns = []
-    potential_split_anns = []
-    ref_size = None
     total_area = float(original_img_height * original_img_width)
-    for i, ann in enumerate(anns_by_area):
-        ann_ratio = ann.bbox[2] / float(ann.bbox[3])
-        print_debug("ann %d, bbox %s, aspect ratio %f" % (i, str(ann.bbox), ann_ratio))
-        if DEBUG:
+    if DEBUG:
+        for i, ann in enumerate(anns_by_area):
             ann.debug_mask(debug_base_fname+"_%03d" % i)
-        if ann.contour_area / total_area < min_area_ratio:
-            print_debug("reject annotation with ratio = %f < %f" % (ann.contour_area / total_area, min_area_ratio))
-            break
-        #if ann.nb_edges_touched() > 2:
-        #    print_debug("ann %d touches %d edges, excuding" % (i, ann.nb_edges_touched()))
-        #    continue
-        if direction == "vertical" and ann.touches_top_bottom():
-            #print_debug("ann %d touches top and bottom edges, exclude" % i)
-            continue
-        if direction == "horizontal" and ann.touches_left_right():
-            #print_debug("ann %d touches top and bottom edges, exclude" % i)
-            continue
-        if ann.squarishness() < 0.85:
-            print_debug("ann %d has a squarishness of %f, excuding" % (i, ann.squarishness()))
-            continue
-        if ann_has_duplicate_in(ann, image_anns) or ann_has_duplicate_in(ann, potential_split_anns):
-            print_debug("ann %d is duplicate, excuding" % i)
-            continue
-        if not ref_size:
-            if not expected_ratio_range or (ann_ratio >= expected_ratio_range[0] and ann_ratio <= expected_ratio_range[1]):
-                image_anns.append(ann)
-                ref_size = ann.contour_area
-                print_debug("select ann %d with area ratio %f, aspect ratio %f" % (i, ann.contour_area / total_area, ann_ratio))
-            else:
-                print_debug("reject annotation %d with wrong aspect ratio %f not in [%f, %f]" % (i, ann_ratio, expected_ratio_range[0], expected_ratio_range[1]))
-            continue
-        if ann_included_in(ann, potential_split_anns):
-            print_debug("ann %d included in potential split, excluding" % i)
-            continue
-        diff_factor = 0.4 if len(image_anns) < expected_nb_pages else 0.15
-        print_debug("diff is %f / %f" % (abs(ref_size - ann.contour_area) / ann.contour_area, diff_factor))
-        if abs(ref_size - ann.contour_area) / ref_size < diff_factor and not ann_included_in(ann, image_anns):
-            if not expected_ratio_range or (ann_ratio >= expected_ratio_range[0] and ann_ratio <= expected_ratio_range[1]):
-                image_anns.append(ann)
-                print_debug("select ann %d, aspect ratio %f" % (i, ann_ratio))
-        elif len(image_anns) < expected_nb_pages and len(potential_split_anns) < expected_nb_pages:
-            print_debug("add annotation %d to the potential union detection, aspect ratio %f" % (i, ann_ratio))
-            potential_split_anns.append(ann)
-        #else:
-        #    break
+            if ann.contour_area / total_area < min_area_ratio:
+                break
+    image_anns, potential_split_anns = select_candidates(anns_by_area, total_area, [min_area_ratio, math.inf], direction, None, 0.85, expected_ratio_range, expected_nb_pages)
     image_anns = handle_unions(image_anns, potential_split_anns)
     # we sort according to the split direction:
     image_anns = order_image_annotation(image_anns)
@@ -326,63 +336,157 @@ def get_image_ann_list(sam_ann_list, original_img_width, original_img_height, de
         image_anns = find_cut_borders(image_anns, anns_by_area)
     return image_anns
 
-def add_scam_results(file_info, sam_ann_list, scam_options):
-    ann_list = []
-    for sam_ann in sam_ann_list:
-        ann_list.append(AnnotationInfo(sam_ann, file_info["width"], file_info["height"], file_info["rotation"]))
-    anns_by_area = sorted(ann_list, key=(lambda x: x.contour_area), reverse=True)
-    image_anns = []
-    potential_split_anns = []
+def get_bbox_matrices(anns):
+    """
+    returns (iou, included) for the bboxes of anns: iou[i, j] is the iou of the bboxes of
+    anns i and j (see iou()), included[i, j] is True when ann i is included in ann j (see
+    ann_included_in())
+    """
+    return get_xywh_matrices([ann.bbox for ann in anns])
+
+def get_xywh_matrices(bboxes):
+    """
+    get_bbox_matrices() for a list of (x, y, w, h)
+    """
+    bboxes = np.array(bboxes, dtype=np.int64).reshape(-1, 4)
+    x1, y1, w, h = bboxes.T
+    x2, y2 = x1 + w, y1 + h
+    iw = np.maximum(0, np.minimum(x2[:, None], x2[None, :]) - np.maximum(x1[:, None], x1[None, :]))
+    ih = np.maximum(0, np.minimum(y2[:, None], y2[None, :]) - np.maximum(y1[:, None], y1[None, :]))
+    intersection = iw * ih
+    areas = w * h
+    iou = intersection / (areas[:, None] + areas[None, :] - intersection)
+    included = (areas[:, None] - intersection) / areas[:, None] < 0.1
+    return iou, included
+
+def select_candidates(anns_by_area, total_area, area_ratio_range, direction, squarishness_min, squarishness_min_warn, wh_ratio_range, nb_pages_expected):
+    """
+    the selection of the pages among anns_by_area (sorted by decreasing contour area),
+    returns (image_anns, potential_split_anns).
+
+    The tests that only depend on an annotation (area ratio, edges, squarishness) are
+    computed for all the annotations at once, the duplicate and inclusion tests are
+    lookups in the matrices of get_bbox_matrices(). Annotations with a squarishness
+    under squarishness_min (if not None) get a "squarishness" warning.
+    """
+    n = len(anns_by_area)
+    if n == 0:
+        return [], []
+    bboxes = np.array([ann.bbox for ann in anns_by_area], dtype=np.int64).reshape(-1, 4)
+    areas = np.array([ann.contour_area for ann in anns_by_area], dtype=np.float64)
+    wh_ratios = bboxes[:, 2] / bboxes[:, 3].astype(np.float64)
+    area_ratios = areas / total_area
+    squarishness = np.array([ann.squarishness() for ann in anns_by_area], dtype=np.float64)
+    if direction == "vertical":
+        touches = np.array([ann.touches_top_bottom() for ann in anns_by_area], dtype=bool)
+    elif direction == "horizontal":
+        touches = np.array([ann.touches_left_right() for ann in anns_by_area], dtype=bool)
+    else:
+        touches = np.zeros(n, dtype=bool)
+    if wh_ratio_range:
+        wh_ratio_ok = (wh_ratios >= wh_ratio_range[0]) & (wh_ratios <= wh_ratio_range[1])
+    else:
+        wh_ratio_ok = np.ones(n, dtype=bool)
+    # the annotations are sorted by area, the ones after the first that is too small are ignored
+    too_small = np.flatnonzero(area_ratios < area_ratio_range[0])
+    end = too_small[0] if len(too_small) else n
+    candidates = (area_ratios <= area_ratio_range[1]) & ~touches & (squarishness >= squarishness_min_warn)
+    iou, included = get_bbox_matrices(anns_by_area[:end])
+    image_idx = []
+    split_idx = []
     ref_size = None
-    total_area = float(file_info["height"] * file_info["width"])
-    for i, ann in enumerate(anns_by_area):
-        ann_ratio = ann.bbox[2] / float(ann.bbox[3])
-        print_debug("ann %d, bbox %s, aspect ratio %f" % (i, str(ann.bbox), ann_ratio))
-        area_ratio = ann.contour_area / total_area
-        if area_ratio < scam_options["area_ratio_range"][0]:
-            print_debug("reject annotation with ratio = %f not in [%f, %f]" % (area_ratio, scam_options["area_ratio_range"][0], scam_options["area_ratio_range"][1]))
-            break
-        if  area_ratio > scam_options["area_ratio_range"][1]:
-            print_debug("reject annotation with ratio = %f not in [%f, %f]" % (area_ratio, scam_options["area_ratio_range"][0], scam_options["area_ratio_range"][1]))
-            continue
-        if scam_options["direction"] == "vertical" and ann.touches_top_bottom():
-            print_debug("ann %d touches top and bottom edges, exclude" % i)
-            continue
-        if scam_options["direction"] == "horizontal" and ann.touches_left_right():
-            print_debug("ann %d touches top and bottom edges, exclude" % i)
+    for i in range(end):
+        ann = anns_by_area[i]
+        print_debug("ann %d, bbox %s, aspect ratio %f" % (i, str(ann.bbox), wh_ratios[i]))
+        if not candidates[i]:
+            print_debug("reject annotation %d: area ratio %f, touches edges %s, squarishness %f" % (i, area_ratios[i], touches[i], squarishness[i]))
             continue
-        if ann.squarishness() < scam_options["squarishness_min_warn"]:
-            print_debug("ann %d has a squarishness of %f, excuding" % (i, ann.squarishness()))
-            continue
-        if ann.squarishness() < scam_options["squarishness_min"]:
+        if squarishness_min is not None and squarishness[i] < squarishness_min:
             ann.warns.append("squarishness")
-        if ann_has_duplicate_in(ann, image_anns) or ann_has_duplicate_in(ann, potential_split_anns):
+        selected = image_idx + split_idx
+        if selected and iou[i, selected].max() > 0.8:
             print_debug("ann %d is duplicate, excuding" % i)
             continue
         if not ref_size:
-            if not scam_options["wh_ratio_range"] or (ann_ratio >= scam_options["wh_ratio_range"][0] and ann_ratio <= scam_options["wh_ratio_range"][1]):
-                image_anns.append(ann)
-                ref_size = ann.contour_area
-                print_debug("select ann %d with area ratio %f, aspect ratio %f" % (i, ann.contour_area / total_area, ann_ratio))
+            if wh_ratio_ok[i]:
+                image_idx.append(i)
+                ref_size = areas[i]
+                print_debug("select ann %d with area ratio %f, aspect ratio %f" % (i, area_ratios[i], wh_ratios[i]))
             else:
-                print_debug("reject annotation %d with wrong aspect ratio %f not in [%f, %f]" % (i, ann_ratio, scam_options["wh_ratio_range"][0], scam_options["wh_ratio_range"][1]))
+                print_debug("reject annotation %d with wrong aspect ratio %f" % (i, wh_ratios[i]))
             continue
-        if ann_included_in(ann, potential_split_anns):
+        if split_idx and included[i, split_idx].any():
             print_debug("ann %d included in potential split, excluding" % i)
             continue
-        diff_factor = 0.4 if len(image_anns) < scam_options["nb_pages_expected"] else 0.15
-        print_debug("diff is %f / %f" % (abs(ref_size - ann.contour_area) / ref_size, diff_factor))
-        if abs(ref_size - ann.contour_area) / ref_size < diff_factor and not ann_included_in(ann, image_anns):
-            if not scam_options["wh_ratio_range"] or (ann_ratio >= scam_options["wh_ratio_range"][0] and ann_ratio <= scam_options["wh_ratio_range"][1]):
-                image_anns.append(ann)
-                print_debug("select ann %d, aspect ratio %f" % (i, ann_ratio))
+        diff_factor = 0.4 if len(image_idx) < nb_pages_expected else 0.15
+        print_debug("diff is %f / %f" % (abs(ref_size - areas[i]) / ref_size, diff_factor))
+        if abs(ref_size - areas[i]) / ref_size < diff_factor and not included[i, image_idx].any():
+            if wh_ratio_ok[i]:
+                image_idx.append(i)
+                print_debug("select ann %d, aspect ratio %f" % (i, wh_ratios[i]))
             else:
-                print_debug("reject annotation %d with wrong aspect ratio %f not in [%f, %f]" % (i, ann_ratio, scam_options["wh_ratio_range"][0], scam_options["wh_ratio_range"][1]))
-        elif len(image_anns) < scam_options["nb_pages_expected"] and len(potential_split_anns) < scam_options["nb_pages_expected"]:
-            print_debug("add annotation %d to the potential union detection, aspect ratio %f" % (i, ann_ratio))
-            potential_split_anns.append(ann)
-        #else:
-        #    break
+                print_debug("reject annotation %d with wrong aspect ratio %f" % (i, wh_ratios[i]))
+        elif len(image_idx) < nb_pages_expected and len(split_idx) < nb_pages_expected:
+            print_debug("add annotation %d to the potential union detection, aspect ratio %f" % (i, wh_ratios[i]))
+            split_idx.append(i)
+    return [anns_by_area[i] for i in image_idx], [anns_by_area[i] for i in split_idx]
+
+def filter_sam_annotations(sam_ann_list, min_area_ratio=None, max_masks=None, nms_iou=None):
+    """
+    returns the annotations of SamAutomaticMaskGenerator.generate() that can be selected,
+    in their original order:
+    - the ones with a bbox larger than min_area_ratio of the image (the contour area
+      compared to area_ratio_range by the selection is never larger than the bbox)
+    - at most max_masks, the largest ones
+    - without the ones having a bbox iou above nms_iou with a larger one
+    the parameters left to None are not applied
+    """
+    if not sam_ann_list:
+        return sam_ann_list
+    mask_h, mask_w = sam_ann_list[0]["segmentation"].shape[:2]
+    bboxes = np.array([sam_ann["bbox"] for sam_ann in sam_ann_list], dtype=np.int64).reshape(-1, 4)
+    areas = np.array([sam_ann["area"] for sam_ann in sam_ann_list], dtype=np.int64)
+    order = np.argsort(-areas, kind="stable")
+    if min_area_ratio is not None:
+        order = order[bboxes[order, 2] * bboxes[order, 3] >= min_area_ratio * mask_w * mask_h]
+    if nms_iou is not None and len(order):
+        iou = get_xywh_matrices(bboxes[order])[0]
+        kept = []
+        for i in range(len(order)):
+            if kept and iou[i, kept].max() > nms_iou:
+                continue
+            kept.append(i)
+            if max_masks is not None and len(kept) >= max_masks:
+                break
+        order = order[kept]
+    if max_masks is not None:
+        order = order[:max_masks]
+    if len(order) < len(sam_ann_list):
+        logging.debug("kept %d of %d SAM annotations", len(order), len(sam_ann_list))
+    return [sam_ann_list[i] for i in sorted(order.tolist())]
+
+def get_ann_infos(file_info, sam_ann_list):
+    """
+    returns the AnnotationInfo of the SAM annotations of a file of scam.json
+    """
+    ann_list = []
+    for sam_ann in sam_ann_list:
+        ann_list.append(AnnotationInfo(sam_ann, file_info["width"], file_info["height"], file_info["rotation"]))
+    return ann_list
+
+def add_scam_results(file_info, sam_ann_list, scam_options):
+    select_scam_results(file_info, get_ann_infos(file_info, sam_ann_list), scam_options)
+
+def select_scam_results(file_info, ann_list, scam_options):
+    """
+    selects the pages of a file of scam.json among ann_list (AnnotationGeometry of the
+    SAM annotations, see get_ann_infos and ann_index.py) and sets file_info["pages"]
+    """
+    anns_by_area = sorted(ann_list, key=(lambda x: x.contour_area), reverse=True)
+    total_area = float(file_info["height"] * file_info["width"])
+    image_anns, potential_split_anns = select_candidates(anns_by_area, total_area, scam_options["area_ratio_range"], scam_options["direction"],
+                                                         scam_options["squarishness_min"], scam_options["squarishness_min_warn"],
+                                                         scam_options["wh_ratio_range"], scam_options["nb_pages_expected"])
     image_anns = handle_unions(image_anns, potential_split_anns)
     image_anns = order_image_annotation(image_anns)
     for i, image_ann in enumerate(image_anns):
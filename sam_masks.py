@@ -0,0 +1,301 @@
+"""
+Compact container for the output of SamAutomaticMaskGenerator.generate().
+
+The gzipped pickles of the SAM results hold one byte per pixel for each mask,
+are slow to decompress and unsafe to unpickle. The container (.samz) holds:
+
+    magic (8 bytes) "SCAMSAM\\0", version (uint16), codec (uint8), padding (uint8),
+    size of the header (uint32), all little endian
+    header: compressed JSON {"masks": [metadata of each mask]}, the metadata are the
+      keys of the SAM output except segmentation (area, bbox, predicted_iou,
+      point_coords, stability_score, crop_box) plus "shape" (height and width of the
+      mask), "crop" (x, y, w, h of its pixels), "offset" and "size" (of its data)
+    data: for each mask, the compressed run lengths of the mask in its crop
+
+The run lengths are encoded as in the compressed RLE of COCO: in row order,
+starting with a run of 0, each run is stored as the difference with the run two
+positions before, as a zigzag LEB128 varint. The masks of SAM have a few runs per
+row that change little from one row to the next, this is much smaller than the
+bits of the mask.
+
+The codec is zstd when the zstandard module is installed and zlib otherwise.
+The masks are decoded one at a time when they are accessed (see SamMasks).
+
+load_sam_annotations() reads both the container and the legacy gzipped pickles.
+The pickles of existing folders can be converted with:
+
+    python sam_masks.py FOLDER_PATH [FOLDER_PATH...]
+
+which writes the containers under sam_masks/, updates the paths in scam.json and
+in the annotation index and reports the gains in size and loading time (run it
+when the folders are not being edited in the web interface).
+"""
+import argparse
+import gzip
+import json
+import logging
+import pickle
+import struct
+import time
+import zlib
+from collections.abc import Sequence
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+SAM_MASKS_MAGIC = b"SCAMSAM\0"
+SAM_MASKS_VERSION = 1
+CODEC_ZLIB = 1
+CODEC_ZSTD = 2
+_HEADER = struct.Struct("<8sHBxI")
+
+
+def _compress(data, codec):
+    if codec == CODEC_ZSTD:
+        return zstandard.ZstdCompressor(level=3).compress(data)
+    return zlib.compress(data, 6)
+
+def _decompress(data, codec):
+    if codec == CODEC_ZSTD:
+        if zstandard is None:
+            raise ValueError("the SAM masks are compressed with zstd, the zstandard module is required")
+        return zstandard.ZstdDecompressor().decompress(data)
+    return zlib.decompress(data)
+
+def _to_json_value(value):
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, (list, tuple)):
+        return [_to_json_value(v) for v in value]
+    return value
+
+def encode_runs(mask):
+    """
+    returns the bytes of the run lengths of a 2d boolean array
+    """
+    flat = mask.ravel()
+    changes = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    bounds = np.concatenate([[0], changes, [flat.size]])
+    runs = np.diff(bounds).astype(np.int64)
+    if flat.size and flat[0]:
+        runs = np.concatenate([[0], runs])
+    deltas = runs.copy()
+    deltas[2:] -= runs[:-2]
+    values = ((deltas << 1) ^ (deltas >> 63)).astype(np.uint64)
+    # LEB128: 7 bits per byte, the high bit is set on all the bytes but the last
+    nb_bytes = np.ones(len(values), dtype=np.int64)
+    for k in range(1, 10):
+        nb_bytes += values >= (np.uint64(1) << np.uint64(7*k))
+    ends = np.cumsum(nb_bytes)
+    out = np.zeros(int(ends[-1]) if len(ends) else 0, dtype=np.uint8)
+    starts = ends - nb_bytes
+    for k in range(int(nb_bytes.max()) if len(nb_bytes) else 0):
+        has = nb_bytes > k
+        byte = (values[has] >> np.uint64(7*k)) & np.uint64(0x7f)
+        out[starts[has] + k] = byte.astype(np.uint8) | np.where(nb_bytes[has] > k + 1, 0x80, 0).astype(np.uint8)
+    return out.tobytes()
+
+def decode_runs(data, shape):
+    """
+    returns the 2d boolean array of the given shape from the bytes of encode_runs()
+    """
+    b = np.frombuffer(data, dtype=np.uint8)
+    last = (b & 0x80) == 0
+    ends = np.flatnonzero(last)
+    starts = np.concatenate([[0], ends[:-1] + 1])
+    position = np.arange(len(b)) - np.repeat(starts, ends - starts + 1)
+    values = np.add.reduceat((b & 0x7f).astype(np.uint64) << (np.uint64(7) * position.astype(np.uint64)), starts) if len(b) else np.zeros(0, dtype=np.uint64)
+    values = values.astype(np.int64)
+    deltas = (values >> 1) ^ -(values & 1)
+    runs = np.empty_like(deltas)
+    runs[0::2] = np.cumsum(deltas[0::2])
+    runs[1::2] = np.cumsum(deltas[1::2])
+    return np.repeat(np.arange(len(runs)) % 2 == 1, runs).reshape(shape)
+
+def get_sam_masks_path(folder_path, img_path):
+    return "sam_masks/"+folder_path+img_path+"_sam.samz"
+
+def encode_sam_masks(sam_res, codec=None):
+    """
+    returns the bytes of the container of sam_res (the output of generate()), codec
+    is CODEC_ZSTD or CODEC_ZLIB, by default zstd if available
+    """
+    if codec is None:
+        codec = CODEC_ZSTD if zstandard is not None else CODEC_ZLIB
+    masks = []
+    chunks = []
+    offset = 0
+    for sam_ann in sam_res:
+        mask = np.asarray(sam_ann["segmentation"], dtype=bool)
+        x, y, w, h = cv2.boundingRect(mask.astype(np.uint8))
+        chunk = _compress(encode_runs(mask[y:y+h, x:x+w]), codec)
+        metadata = {key: _to_json_value(value) for key, value in sam_ann.items() if key != "segmentation"}
+        metadata.update({"shape": list(mask.shape), "crop": [x, y, w, h], "offset": offset, "size": len(chunk)})
+        masks.append(metadata)
+        chunks.append(chunk)
+        offset += len(chunk)
+    header = _compress(json.dumps({"masks": masks}).encode("utf-8"), codec)
+    return b"".join([_HEADER.pack(SAM_MASKS_MAGIC, SAM_MASKS_VERSION, codec, len(header)), header] + chunks)
+
+def is_sam_masks(data):
+    return data[:len(SAM_MASKS_MAGIC)] == SAM_MASKS_MAGIC
+
+
+class SamMasks(Sequence):
+    """
+    The annotations of a container, as a sequence of dicts like the ones of generate().
+    The mask of an annotation (its "segmentation") is decoded when it is accessed,
+    metadata(i) gives the other keys without decoding the mask.
+    """
+
+    def __init__(self, data):
+        magic, version, codec, header_size = _HEADER.unpack_from(data)
+        if magic != SAM_MASKS_MAGIC:
+            raise ValueError("not a SAM masks container")
+        if version > SAM_MASKS_VERSION:
+            raise ValueError("unsupported SAM masks container version %d" % version)
+        self.codec = codec
+        self._data = memoryview(data)
+        self._data_start = _HEADER.size + header_size
+        self._masks = json.loads(_decompress(bytes(self._data[_HEADER.size:self._data_start]), codec))["masks"]
+
+    def __len__(self):
+        return len(self._masks)
+
+    def metadata(self, i):
+        """
+        returns the keys of the annotation i except segmentation
+        """
+        return {key: value for key, value in self._masks[i].items() if key not in ("shape", "crop", "offset", "size")}
+
+    def mask(self, i):
+        """
+        returns the mask of the annotation i, a boolean array
+        """
+        entry = self._masks[i]
+        x, y, w, h = entry["crop"]
+        start = self._data_start + entry["offset"]
+        mask = np.zeros(entry["shape"], dtype=bool)
+        mask[y:y+h, x:x+w] = decode_runs(_decompress(bytes(self._data[start:start+entry["size"]]), self.codec), (h, w))
+        return mask
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        res = self.metadata(i)
+        res["segmentation"] = self.mask(i)
+        return res
+
+
+def load_sam_annotations(data):
+    """
+    returns the SAM annotations in data, a SamMasks for a container or the list of
+    a legacy gzipped pickle
+    """
+    if is_sam_masks(data):
+        return SamMasks(data)
+    return pickle.loads(gzip.decompress(data))
+
+def convert_folder(folder_path, storage, max_workers=4, dry_run=False):
+    """
+    converts the gzipped pickles of a folder into containers, updates scam.json and
+    the annotation index, returns the stats of the conversion
+    """
+    # imported here so that reading the containers doesn't need boto3 and
+    # ann_index reads the pickles with load_sam_annotations
+    from ann_index import get_ann_index_key, load_ann_index, save_ann_index
+    from utils import get_scam_json, save_scam_json
+    scam_json = get_scam_json(folder_path, storage=storage)
+    if scam_json is None:
+        logging.error("cannot read %sscam.json", folder_path)
+        return None
+    stats = {"folder": folder_path, "files": 0, "missing": 0, "pickle_bytes": 0, "samz_bytes": 0, "pickle_load_time": 0.0, "samz_load_time": 0.0}
+    new_paths = {}
+
+    def _convert(file_info):
+        blob = storage.get(file_info["pickle_path"])
+        if blob is None:
+            logging.warning("missing pickle %s", file_info["pickle_path"])
+            return None
+        blob.seek(0)
+        data = blob.read()
+        start = time.perf_counter()
+        sam_res = pickle.loads(gzip.decompress(data))
+        pickle_load_time = time.perf_counter() - start
+        samz = encode_sam_masks(sam_res)
+        # the masks are all decoded, as the pickle
+        start = time.perf_counter()
+        masks = SamMasks(samz)
+        for i in range(len(masks)):
+            if not np.array_equal(masks.mask(i), sam_res[i]["segmentation"]):
+                raise ValueError("mask %d of %s changed in the conversion" % (i, file_info["pickle_path"]))
+        samz_load_time = time.perf_counter() - start
+        new_path = get_sam_masks_path(folder_path, file_info["img_path"])
+        if not dry_run:
+            storage.put(new_path, samz)
+        return file_info["pickle_path"], new_path, len(data), len(samz), pickle_load_time, samz_load_time
+
+    files = [file_info for file_info in scam_json["files"] if file_info.get("pickle_path") and not file_info["pickle_path"].endswith(".samz")]
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        for res in pool.map(_convert, files):
+            if res is None:
+                stats["missing"] += 1
+                continue
+            old_path, new_path, pickle_bytes, samz_bytes, pickle_load_time, samz_load_time = res
+            new_paths[old_path] = new_path
+            stats["files"] += 1
+            stats["pickle_bytes"] += pickle_bytes
+            stats["samz_bytes"] += samz_bytes
+            stats["pickle_load_time"] += pickle_load_time
+            stats["samz_load_time"] += samz_load_time
+    if new_paths and not dry_run:
+        for file_info in scam_json["files"]:
+            if file_info.get("pickle_path") in new_paths:
+                file_info["pickle_path"] = new_paths[file_info["pickle_path"]]
+        save_scam_json(folder_path, scam_json, storage=storage)
+        ann_index = load_ann_index(folder_path, storage)
+        if ann_index is not None:
+            arrays = dict(ann_index.arrays)
+            arrays["pickle_paths"] = np.array([new_paths.get(path, path) for path in arrays["pickle_paths"].tolist()], dtype=str)
+            save_ann_index(folder_path, arrays, storage)
+            logging.info("updated %s", get_ann_index_key(folder_path))
+    stats["pickle_load_time"] = round(stats["pickle_load_time"], 3)
+    stats["samz_load_time"] = round(stats["samz_load_time"], 3)
+    if stats["samz_bytes"]:
+        stats["size_ratio"] = round(stats["pickle_bytes"] / stats["samz_bytes"], 2)
+    if stats["samz_load_time"]:
+        stats["load_speedup"] = round(stats["pickle_load_time"] / stats["samz_load_time"], 2)
+    return stats
+
+def main():
+    from storage import get_storage
+    parser = argparse.ArgumentParser(description="convert the gzipped SAM pickles of folders into .samz containers")
+    parser.add_argument("folders", nargs="+", help="folder paths, as in the csv of scam_preprocess.py")
+    parser.add_argument("--storage", default="s3", help="where scam.json and the pickles are, see storage.py (default: s3)")
+    parser.add_argument("--workers", type=int, default=4, metavar="N", help="number of pickles converted in parallel (default: 4)")
+    parser.add_argument("--dry-run", action="store_true", help="only report the gains, don't write anything")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    storage = get_storage(args.storage)
+    for folder_path in args.folders:
+        if not folder_path.endswith("/"):
+            folder_path += "/"
+        stats = convert_folder(folder_path, storage, max_workers=args.workers, dry_run=args.dry_run)
+        if stats is not None:
+            print(json.dumps(stats))
+
+if __name__ == "__main__":
+    main()
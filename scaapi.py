@@ -1,29 +1,35 @@
 from datetime import datetime
 from flask import Flask, json, request, make_response, send_file
-import pickle
-import gzip
-from utils import upload_to_s3, gets3blob
-from sam_annotation_utils import add_scam_results
+import os
+from sam_annotation_utils import get_ann_infos, select_scam_results
+from ann_index import load_ann_index
+from sam_masks import load_sam_annotations
 import logging
 from flask_cachecontrol import cache
 from flask_cors import CORS
-from utils import VERSION, save_scam_json, get_scam_json
+from utils import VERSION, BUCKET_NAME, save_scam_json, get_scam_json
+from storage import get_storage
 
 api = Flask("SCAM-QC")
 CORS(api)
 
+# where scam.json, the thumbnails and the pickles are, can be set to a local directory with file://
+STORAGE = get_storage(os.environ.get("SCAM_STORAGE", "s3://%s/" % BUCKET_NAME))
+
 def get_gz_pickle(pickle_path):
-    blob = gets3blob(pickle_path)
+    blob = STORAGE.get(pickle_path)
     if blob is None:
         return
     blob.seek(0)
-    return pickle.loads(gzip.decompress(blob.read()))
+    return load_sam_annotations(blob.read())
 
 def get_thumbnail_bytesio(thumbnail_path):
     """
     returns the bytes of the thumbnail
     """
-    blob = gets3blob(thumbnail_path)
+    blob = STORAGE.get(thumbnail_path)
+    if blob is None:
+        return None
     blob.seek(0)
     return blob
 
@@ -45,6 +51,18 @@ DEFAULT_SCAM_OPTIONS = {
     "cut_at_fixed": False
 }
 
+def get_ann_list(file_info, scam_options, ann_index=None):
+    """
+    returns the annotations of a file, from the index of the folder when it has them
+    (see ann_index.py), from the pickle otherwise
+    """
+    if ann_index is not None:
+        ann_list = ann_index.get_annotations(file_info, min_area_ratio=scam_options["area_ratio_range"][0])
+        if ann_list is not None:
+            return ann_list
+    sam_anns = get_gz_pickle(file_info["pickle_path"])
+    return get_ann_infos(file_info, sam_anns)
+
 def run_scam_folder(folder_path, scam_json, scam_options = DEFAULT_SCAM_OPTIONS):
     """
     runs scam on a complete scam.json file
@@ -55,17 +73,17 @@ def run_scam_folder(folder_path, scam_json, scam_options = DEFAULT_SCAM_OPTIONS)
         "version": VERSION,
         "scam_options": scam_options
     })
+    ann_index = load_ann_index(folder_path, STORAGE)
     for file_info in scam_json["files"]:
         if file_info.get("checked") and not scam_options["alter_checked"]:
             continue
         logging.info("run sam on %s" % file_info["img_path"])
-        sam_anns = get_gz_pickle(file_info["pickle_path"])
-        add_scam_results(file_info, sam_anns, scam_options)
+        select_scam_results(file_info, get_ann_list(file_info, scam_options, ann_index), scam_options)
     return scam_json
 
 def run_scam_image(folder_path, file_info, scam_options):
-    sam_anns = get_gz_pickle(file_info["pickle_path"])
-    add_scam_results(file_info, sam_anns, scam_options)
+    ann_index = load_ann_index(folder_path, STORAGE)
+    select_scam_results(file_info, get_ann_list(file_info, scam_options, ann_index), scam_options)
     return file_info
 
 @api.route('/save_scam_json', methods=['POST'])
@@ -73,7 +91,7 @@ def save_scam_json_api():
     data = request.json
     folder_path = data.get('folder_path')
     scam_json_obj = data.get('scam_json_obj')
-    return save_scam_json(folder_path, scam_json_obj)
+    return save_scam_json(folder_path, scam_json_obj, storage=STORAGE)
 
 @api.route('/get_thumbnail_bytes', methods=['GET'])
 @cache(max_age=86400, public=True, no_cache=None)
@@ -91,7 +109,7 @@ def get_thumbnail_bytes_api_get():
 def get_scam_json_api():
     data = request.json
     folder_path = data.get('folder_path')
-    res = get_scam_json(folder_path)
+    res = get_scam_json(folder_path, storage=STORAGE)
     if not res:
         return "could not find json", 404
     return res
@@ -1,23 +1,31 @@
 import argparse
 import csv
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
 from contextlib import contextmanager
+from multiprocessing import resource_tracker, shared_memory
+import multiprocessing
+import io
 import sys
 import os
 import logging
 import threading
+import time
 import mozjpeg_lossless_optimization
 from PIL import Image
 from tqdm import tqdm
-from img_utils import encode_img_uncompressed, encode_img_compressed_simple, encode_img_jxl, rotate_warp_affine, get_bounding_box, sanitize_for_postprocessing, apply_scale_factors_pil, get_linear_factors, sRGB_inverse_gamma, rotate_mar
+from img_utils import encode_img_uncompressed, encode_img_compressed_simple, encode_img_jxl, rotate_warp_affine, rotate_warp_affine_cv2, get_bounding_box, sanitize_for_postprocessing, apply_scale_factors_pil, get_linear_factors, sRGB_inverse_gamma, rotate_mar
 from image_decode import decode_blob_to_pil
-from utils import upload_to_s3, gets3blob, get_sha256, get_scam_json, S3Prefetcher
-from raw_utils import register_raw_opener, is_likely_raw, get_np_from_raw, get_factors_from_raw
+from utils import gets3blob, get_sha256, get_scam_json, S3Prefetcher, S3Uploader, set_s3_concurrency, set_disk_cache, get_disk_cache, reset_s3_stats, get_s3_stats
+from storage import get_storage
+from raw_utils import register_raw_opener, is_likely_raw, get_np_from_raw
+from raw_context import RawContext, RawContextCache
+from raw_service import RawDecodeService, SharedArray
+from memory_budget import MemoryBudget, get_physical_memory
+from worker_controller import WorkerController, get_memory_ceiling
 from natsort import natsort_keygen, natsorted, ns
 import numpy as np
 import cv2
 import exifread
-import rawpy
 from datetime import datetime
 import json
 from functools import cmp_to_key
@@ -66,8 +74,9 @@ def _append_scam_log_entry(scam_log_json, entry, log_lock=None):
 
 DEFAULT_POSTPROCESS_OPTIONS = {
     "rotation_in_derivation": True, # derive tiffs with the small rotation
-    "src_storage": "s3", # s3 or local
-    "dst_storage": "s3", # s3 or local
+    "src_storage": "auto", # auto (source_url of scam.json if present, s3 otherwise), s3, local (in local_src_folder) or a storage url (see storage.get_storage)
+    "dst_storage": "s3", # s3, local (in local_dst_folder) or a storage url
+    "json_storage": "s3", # where scam.json is read and scam_log.json is written, s3 or a storage url
     "skip_folder_local_output": False, # 
     "skip_folder_local_input": True, # 
     "local_src_folder": "./",
@@ -89,6 +98,20 @@ DEFAULT_POSTPROCESS_OPTIONS = {
     "try_grayscale": False,
     "compress_output": False, # if True, output JPEG at quality 85 run through mozjpeg (binary images remain G4 TIFF)
     "output_jxl": False, # if True, output lossless JPEG-XL via libvips (non-binary only, uncompressed path)
+    "prefetch_max_bytes": 2*1024*1024*1024, # maximum number of source bytes held by the prefetcher before get() hands them back, None for no limit
+    "prefetch_max_objects": None, # maximum number of source files held by the prefetcher, None for 2 per worker
+    "upload_workers": 4, # number of threads uploading the derived images in the background
+    "upload_queue_size": 16, # maximum number of encoded images waiting for an upload thread
+    "raw_context_cache_size": 2, # maximum number of raw images with a color card kept (read and parsed) from the corrections until they are postprocessed
+    "raw_decode_processes": 0, # number of processes demosaicing the raw images (see raw_service.py), 0 to demosaic in the postprocessing threads
+    "raw_quality": "best", # demosaicing of the processes: "draft" (half size), "fast", "normal" or "best" (same as in the threads)
+    "raw_max_buffers": None, # maximum number of raw images being demosaiced or waiting to be derived by the processes, None for 2 per process
+    "executor": "thread", # "thread" to derive the files in threads, "process" to derive them in worker processes (see derive_file_in_process)
+    "memory_budget": "auto", # maximum of the estimated working sets (see estimate_working_set) of the files derived at the same time in bytes, "auto" for half of the physical memory, None for no limit
+    "largest_first": True, # derive the files with the largest working set first, so that they don't set the tail of the folder
+    "auto_max_workers": None, # with workers="auto", maximum number of active workers (see worker_controller.py), None for the number of cpus
+    "auto_interval": 15, # with workers="auto", seconds between two adjustments of the number of active workers
+    "auto_memory_ceiling": "auto", # with workers="auto", RSS in bytes above which workers are removed, "auto" for 3/4 of the physical memory, None for no ceiling
 }
 
 # pages are 
@@ -330,12 +353,44 @@ def can_simple_copy(file_info, pages):
         return False
     return len(pages) == 0
 
-def derive_from_file(scam_json, scam_log_json, file_info, postprocess_options, prefixes, correction, prefetcher=None, log_lock=None):
+def get_src_storage(scam_json, postprocess_options):
+    if postprocess_options["src_storage"] == "auto":
+        # folders preprocessed directly from an archive mount
+        return get_storage(scam_json.get("source_url") or "s3")
+    if postprocess_options["src_storage"] == "local":
+        return get_storage(postprocess_options["local_src_folder"] or "local")
+    return get_storage(postprocess_options["src_storage"])
+
+def get_src_prefix(scam_json, postprocess_options):
+    """
+    returns the prefix of the keys of the images of a folder in the source storage
+    """
+    if postprocess_options["src_storage"] == "auto" and scam_json.get("source_url"):
+        return ""
+    if postprocess_options["src_storage"] == "local" and postprocess_options["skip_folder_local_input"]:
+        return ""
+    return scam_json["folder_path"]
+
+def get_dst_storage(postprocess_options):
+    if postprocess_options["dst_storage"] == "local":
+        return get_storage(postprocess_options["local_dst_folder"] or "local")
+    return get_storage(postprocess_options["dst_storage"])
+
+def get_dst_prefix(folder_path, postprocess_options):
+    """
+    returns the prefix of the keys of the derived images of a folder in the destination storage
+    """
+    if postprocess_options["dst_storage"] == "local":
+        return "" if postprocess_options["skip_folder_local_output"] else folder_path
+    return "scam_cropped/"+folder_path
+
+def derive_from_file(scam_json, scam_log_json, file_info, postprocess_options, prefixes, correction, prefetcher=None, log_lock=None, uploader=None, raw_contexts=None, raw_service=None):
     pages = get_output_pages(file_info)
     if pages is None:
         logging.info("do not derive from hidden image %s" % file_info["img_path"])
         return
     pil_img = None
+    shared = None
     img_bytes = None
     img_ext = None
     output_file_info = {
@@ -350,52 +405,79 @@ def derive_from_file(scam_json, scam_log_json, file_info, postprocess_options, p
     try_simple_copy = can_simple_copy(file_info, pages) and not postprocess_options.get("output_jxl")
     with capture_image_warnings() as warnings:
         try:
-            if postprocess_options["src_storage"] == "s3":
-                if not postprocess_options["dryrun"]:
-                    pil_img, img_bytes, img_ext = get_postprocess_pil_img(
-                        scam_json["folder_path"], file_info["img_path"], correction,
-                        postprocess_options, output_file_info, try_simple_copy,
-                        prefetcher=prefetcher,
-                    )
-            else:
-                local_path = postprocess_options["local_src_folder"]
-                if not postprocess_options["skip_folder_local_input"]:
-                    local_path += scam_json["folder_path"]
-                local_path += file_info["img_path"]
-                if not postprocess_options["dryrun"]:
-                    # TODO: this is wrong
-                    pil_img = Image.open(local_path)
+            if not postprocess_options["dryrun"]:
+                # the prefetcher reads from the source storage
+                pil_img, img_bytes, img_ext = get_postprocess_pil_img(
+                    get_src_prefix(scam_json, postprocess_options), file_info["img_path"], correction,
+                    postprocess_options, output_file_info, try_simple_copy,
+                    prefetcher=prefetcher,
+                    raw_context=raw_contexts.pop(file_info["img_path"]) if raw_contexts is not None else None,
+                    raw_service=raw_service,
+                )
+            if isinstance(pil_img, SharedArray):
+                # demosaiced by the raw service, the pages are derived from the shared memory
+                shared = pil_img
+                pil_img = shared.array
             if file_info["rotation"] != 0:
                 logging.info("rotate %s by %d", file_info["img_path"], file_info["rotation"])
                 if not postprocess_options["dryrun"]:
-                    pil_img = pil_img.rotate(file_info["rotation"], expand=True)
+                    pil_img = rotate_img(pil_img, file_info["rotation"])
         except Exception as e:
             logging.error("exception trying to open %s: %s", file_info["img_path"], e, exc_info=True)
             output_file_info["error"] = "exception trying to open: %s" % e
             if warnings:
                 output_file_info["warnings"] = list(warnings)
             _append_scam_log_entry(scam_log_json, output_file_info, log_lock)
+            if shared is not None:
+                shared.close()
             return
     if warnings:
         output_file_info["warnings"] = list(warnings)
-    if len(pages) == 0:
-        _append_scam_log_entry(scam_log_json, output_file_info, log_lock)
-        derive_from_page(scam_json, output_file_info, file_info, pil_img, img_bytes, img_ext, None, 1, postprocess_options, None if prefixes is None else prefixes[0])
-        return
-    for i, page in enumerate(pages):
-        ofi_p = output_file_info.copy()
-        if "warnings" in ofi_p:
-            ofi_p["warnings"] = list(ofi_p["warnings"])
-        _append_scam_log_entry(scam_log_json, ofi_p, log_lock)
-        derive_from_page(scam_json, ofi_p, file_info, pil_img, img_bytes, img_ext, page, i+1, postprocess_options, None if prefixes is None else prefixes[i])
-
-def derive_from_page(scam_json, output_file_info, file_info, pil_img, img_bytes, img_ext, page_info, page_position, postprocess_options, prefix=None):
+    try:
+        if len(pages) == 0:
+            _append_scam_log_entry(scam_log_json, output_file_info, log_lock)
+            derive_from_page(scam_json, output_file_info, file_info, pil_img, img_bytes, img_ext, None, 1, postprocess_options, None if prefixes is None else prefixes[0], uploader=uploader)
+            return
+        for i, page in enumerate(pages):
+            ofi_p = output_file_info.copy()
+            if "warnings" in ofi_p:
+                ofi_p["warnings"] = list(ofi_p["warnings"])
+            _append_scam_log_entry(scam_log_json, ofi_p, log_lock)
+            derive_from_page(scam_json, ofi_p, file_info, pil_img, img_bytes, img_ext, page, i+1, postprocess_options, None if prefixes is None else prefixes[i], uploader=uploader)
+    finally:
+        if shared is not None:
+            pil_img = None
+            shared.close()
+
+def _record_upload_error(output_file_info, future):
+    e = future.exception()
+    if e is not None:
+        output_file_info["error"] = "upload failed: %s" % e
+
+def rotate_img(img, rotation):
+    """
+    rotates a PIL image or a numpy array counter clockwise, a numpy array is rotated
+    by a multiple of 90 degrees without copy
+    """
+    if isinstance(img, np.ndarray):
+        if rotation % 90 == 0:
+            return np.rot90(img, rotation // 90)
+        img = Image.fromarray(img)
+    return img.rotate(rotation, expand=True)
+
+def derive_from_page(scam_json, output_file_info, file_info, pil_img, img_bytes, img_ext, page_info, page_position, postprocess_options, prefix=None, uploader=None):
     # page_info is None means we take the whole image
     # page_position starts at 1
+    # pil_img can also be a numpy array (see raw_service.py), only the extract is copied into a PIL image
     suffix_letter = chr(96+page_position)
-    extract = pil_img
+    np_img = pil_img if isinstance(pil_img, np.ndarray) else None
+    if np_img is not None:
+        pil_img = None
+        extract = Image.fromarray(np_img) if page_info is None and not postprocess_options["dryrun"] else None
+    else:
+        extract = pil_img
     if img_ext is None:
-        if postprocess_options.get("output_jxl") and extract is not None and extract.mode != "1":
+        if postprocess_options.get("output_jxl") and (np_img is not None or (extract is not None and extract.mode != "1")):
             img_ext = ".jxl"
         elif postprocess_options.get("compress_output") and (pil_img is None or pil_img.mode != "1"):
             img_ext = ".jpg"
@@ -405,102 +487,417 @@ def derive_from_page(scam_json, output_file_info, file_info, pil_img, img_bytes,
     output_file_info["page_in_file"] = page_position
     try:
         if page_info is not None:
-            original_img_w = pil_img.height if file_info["rotation"] in ["-90", "90", "-270", "270"] else pil_img.width
-            original_img_h = pil_img.width if file_info["rotation"] in ["-90", "90", "-270", "270"] else pil_img.height
+            img_w, img_h = (np_img.shape[1], np_img.shape[0]) if np_img is not None else pil_img.size
+            original_img_w = img_h if file_info["rotation"] in ["-90", "90", "-270", "270"] else img_w
+            original_img_h = img_w if file_info["rotation"] in ["-90", "90", "-270", "270"] else img_h
             mar = get_scaled_mar(file_info, page_info, original_img_w, original_img_h)
             if not postprocess_options["rotation_in_derivation"]:
-                bbox = get_bounding_box(mar, pil_img.width, pil_img.height)
+                bbox = get_bounding_box(mar, img_w, img_h)
                 output_file_info["crop_bbox"] = bbox
                 logging.info("  extract with no rotation (%d, %d, %d, %d)", bbox[0], bbox[1], bbox[0]+bbox[2], bbox[1]+bbox[3])
                 if not postprocess_options["dryrun"]:
-                    extract = pil_img.crop((bbox[0], bbox[1], bbox[0]+bbox[2], bbox[1]+bbox[3]))
+                    if np_img is not None:
+                        extract = Image.fromarray(np.ascontiguousarray(np_img[bbox[1]:bbox[1]+bbox[3], bbox[0]:bbox[0]+bbox[2]]))
+                    else:
+                        extract = pil_img.crop((bbox[0], bbox[1], bbox[0]+bbox[2], bbox[1]+bbox[3]))
             else:
                 logging.info("  extract with rotation ((%f, %f), (%f, %f), %f)", mar[0][0], mar[0][1], mar[1][0], mar[1][1], mar[2])
                 output_file_info["crop_rect"] = [mar[0][0], mar[0][1], mar[1][0], mar[1][1], mar[2]]
                 if not postprocess_options["dryrun"]:
-                    extract = rotate_warp_affine(pil_img, mar)
+                    if np_img is not None:
+                        extract = Image.fromarray(rotate_warp_affine_cv2(np_img, mar))
+                    else:
+                        extract = rotate_warp_affine(pil_img, mar)
         output_path = None
-        if postprocess_options["dst_storage"] == "s3":
-            s3key = "scam_cropped/"+scam_json["folder_path"]
-            img_path = file_info["img_path"].replace(" ", "_").replace("'", "v").replace('"', "")
-            if prefix is None:
-                output_path = os.path.splitext(img_path)[0]+suffix_letter+img_ext
-                s3key += output_path
-            else:
-                base = ("%04d_" % prefix) + img_path.replace("/", "_")
-                output_path = os.path.splitext(base)[0]+suffix_letter+img_ext
-                s3key += output_path
-            logging.info("  write to s3 key %s", s3key)
-            if not postprocess_options["dryrun"]:
-                with capture_image_warnings() as encode_warnings:
-                    if img_bytes is None:
-                        if postprocess_options.get("output_jxl") and extract.mode != "1":
-                            img_bytes, img_ext = encode_img_jxl(extract, postprocess_options["try_grayscale"])
-                        elif postprocess_options.get("compress_output"):
-                            img_bytes, img_ext = encode_img_compressed_simple(extract, postprocess_options["try_grayscale"])
-                        else:
-                            img_bytes, img_ext = encode_img_uncompressed(extract, postprocess_options["try_grayscale"])
-                if encode_warnings:
-                    output_file_info.setdefault("warnings", []).extend(encode_warnings)
-                if img_bytes is None:
-                    output_file_info["error"] = "could not encode image"
-                    logging.error(" got no resulting image for %s", json.dumps(page_info))
-                    return
-                sha256 = get_sha256(img_bytes)
-                output_file_info["sha256"] = sha256
-                upload_to_s3(img_bytes, s3key)
+        dst_key = get_dst_prefix(scam_json["folder_path"], postprocess_options)
+        img_path = file_info["img_path"]
+        if postprocess_options["dst_storage"] != "local":
+            img_path = img_path.replace(" ", "_").replace("'", "v").replace('"', "")
+        if prefix is None:
+            output_path = os.path.splitext(img_path)[0]+suffix_letter+img_ext
         else:
-            local_path = postprocess_options["local_dst_folder"]
-            if not postprocess_options["skip_folder_local_output"]:
-                local_path += scam_json["folder_path"]
-            if prefix is None:
-                output_path = os.path.splitext(file_info["img_path"])[0]+suffix_letter+img_ext
-                local_path += output_path
-            else:
-                base = ("%04d_" % prefix) + file_info["img_path"].replace("/", "_")
-                output_path = os.path.splitext(base)[0]+suffix_letter+img_ext
-                local_path += output_path
-            logging.info("  write to local file %s", local_path)
-            if not postprocess_options["dryrun"]:
-                os.makedirs(os.path.dirname(local_path), exist_ok=True)
-                with capture_image_warnings() as encode_warnings:
+            base = ("%04d_" % prefix) + img_path.replace("/", "_")
+            output_path = os.path.splitext(base)[0]+suffix_letter+img_ext
+        dst_key += output_path
+        logging.info("  write to %s", dst_key)
+        if not postprocess_options["dryrun"]:
+            with capture_image_warnings() as encode_warnings:
+                if img_bytes is None:
                     if postprocess_options.get("output_jxl") and extract.mode != "1":
-                        b, ext = encode_img_jxl(extract, postprocess_options["try_grayscale"])
+                        img_bytes, img_ext = encode_img_jxl(extract, postprocess_options["try_grayscale"])
                     elif postprocess_options.get("compress_output"):
-                        b, ext = encode_img_compressed_simple(extract, postprocess_options["try_grayscale"])
+                        img_bytes, img_ext = encode_img_compressed_simple(extract, postprocess_options["try_grayscale"])
                     else:
-                        b, ext = encode_img_uncompressed(extract)
-                if encode_warnings:
-                    output_file_info.setdefault("warnings", []).extend(encode_warnings)
-                sha256 = get_sha256(b)
-                output_file_info["sha256"] = sha256
-                with open(local_path, "wb") as binary_file:
-                    binary_file.write(b)
+                        img_bytes, img_ext = encode_img_uncompressed(extract, postprocess_options["try_grayscale"])
+            if encode_warnings:
+                output_file_info.setdefault("warnings", []).extend(encode_warnings)
+            if img_bytes is None:
+                output_file_info["error"] = "could not encode image"
+                logging.error(" got no resulting image for %s", json.dumps(page_info))
+                return
+            sha256 = get_sha256(img_bytes)
+            output_file_info["sha256"] = sha256
+            if uploader is not None:
+                # the error (if any) is recorded before the scam log is written since
+                # postprocess_folder waits for the uploads to finish
+                future = uploader.upload(img_bytes, dst_key)
+                future.add_done_callback(lambda f: _record_upload_error(output_file_info, f))
+            else:
+                get_dst_storage(postprocess_options).put(dst_key, img_bytes)
         output_file_info["output_img_path"] = output_path
     except Exception as e:
         logging.error("exception deriving page from %s: %s", file_info["img_path"], e, exc_info=True)
         output_file_info["error"] = "exception deriving page: %s" % e
 
+def order_output_files(scam_log_json, scam_json):
+    """
+    orders the entries of scam_log.json as the files in scam.json, the workers add
+    them as the files complete
+    """
+    file_index = {file_info["img_path"]: i for i, file_info in enumerate(scam_json["files"])}
+    # the sort is stable, the pages of a file stay in order
+    scam_log_json["output_files"].sort(key=lambda entry: file_index.get(entry["original_file_info"]["img_path"], len(file_index)))
+
+def _to_shared_memory(data):
+    """
+    returns a new shared memory block with data
+    """
+    shm = shared_memory.SharedMemory(create=True, size=max(1, len(data)))
+    shm.buf[:len(data)] = data
+    return shm
+
+def _from_shared_memory(name, size):
+    """
+    returns the content of a shared memory block created in another process, and unlinks it
+    """
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        return bytes(shm.buf[:size])
+    finally:
+        shm.close()
+        shm.unlink()
+
+def _unlink_shared_memory(name):
+    """
+    unlinks a shared memory block created in another process, without reading it
+    """
+    shm = shared_memory.SharedMemory(name=name)
+    shm.close()
+    shm.unlink()
+
+class _SharedMemorySource:
+    """
+    the source of a file in a worker process, used in place of the prefetcher. The
+    block is mapped and read in place, as the mmaps of the local storages.
+    """
+
+    def __init__(self, name, size):
+        self.name = name
+        self.size = size
+        self._shm = None
+
+    def get(self, key):
+        if self.name is None:
+            return None
+        if self._shm is None:
+            self._shm = shared_memory.SharedMemory(name=self.name)
+        blob = self._shm._mmap
+        if len(blob) != self.size:
+            # rounded up to the page size on some platforms
+            with self._shm.buf[:self.size] as view:
+                return io.BytesIO(view)
+        blob.seek(0)
+        return blob
+
+    def close(self):
+        if self._shm is not None:
+            try:
+                self._shm.close()
+            except BufferError:
+                # still referenced by a decoded image, unmapped when it is collected
+                pass
+            self._shm = None
+
+class _SharedMemoryOutputs:
+    """
+    collects the encoded images of a worker process in shared memory blocks, used
+    in place of the uploader. The main process uploads and unlinks the blocks.
+    """
+
+    def __init__(self):
+        self.outputs = []
+
+    def unlink(self):
+        """
+        unlinks the blocks, when they are not handed to the main process
+        """
+        for _, name, _ in self.outputs:
+            _unlink_shared_memory(name)
+        self.outputs = []
+
+    def upload(self, data, s3_key):
+        shm = _to_shared_memory(data)
+        shm.close()
+        # owned by the main process from now on
+        resource_tracker.unregister(shm._name, "shared_memory")
+        self.outputs.append((s3_key, shm.name, len(data)))
+        future = Future()
+        future.set_result(None)
+        return future
+
+def _init_process_worker(log_level):
+    logging.basicConfig(level=log_level)
+
+def new_process_pool(workers):
+    """
+    returns the pool of worker processes of the process executor
+    """
+    # fork is not safe with the S3 and upload threads of the main process
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+                               initializer=_init_process_worker, initargs=(logging.getLogger().level,))
+
+def _derive_file_in_process(folder_info, file_info, postprocess_options, prefixes, correction, src_name, src_size):
+    """
+    derives a file in a worker process, returns the entries of the file in scam_log.json
+    and the (key, shared memory block name, size) of the images to upload
+    """
+    scam_log_json = {"output_files": []}
+    source = _SharedMemorySource(src_name, src_size)
+    outputs = _SharedMemoryOutputs()
+    try:
+        derive_from_file(folder_info, scam_log_json, file_info, postprocess_options, prefixes, correction,
+                         prefetcher=source, uploader=outputs)
+    except:
+        # the blocks are not tracked anymore, only the names returned to the main process are unlinked
+        outputs.unlink()
+        raise
+    finally:
+        source.close()
+    return scam_log_json["output_files"], outputs.outputs
+
+def derive_file_in_process(process_pool, scam_json, scam_log_json, file_info, postprocess_options, prefixes, correction, prefetcher, uploader, log_lock=None):
+    """
+    derives a file in a worker process of process_pool, for the stages of derive_from_file
+    that hold the GIL (exif parsing, TIFF deflate, mozjpeg, etc.)
+
+    Called from a thread of the main process, which downloads the source and uploads the
+    results: the source and the encoded images go through shared memory blocks instead of
+    being pickled. The decoded image and the pages stay in the worker process.
+    """
+    folder_info = {key: scam_json[key] for key in ("folder_path", "source_url") if key in scam_json}
+    src_shm = None
+    src_size = 0
+    try:
+        if not postprocess_options["dryrun"]:
+            blob = gets3blob(get_src_prefix(scam_json, postprocess_options)+file_info["img_path"], prefetcher=prefetcher)
+            if blob is not None:
+                # a BytesIO, or a mmap from a local storage or the disk cache
+                data = blob.getbuffer() if hasattr(blob, "getbuffer") else blob
+                src_size = len(data)
+                src_shm = _to_shared_memory(data)
+                data = blob = None
+        try:
+            entries, outputs = process_pool.submit(_derive_file_in_process, folder_info, file_info, postprocess_options, prefixes, correction,
+                                                   None if src_shm is None else src_shm.name, src_size).result()
+        except Exception as e:
+            logging.error("exception deriving %s in a worker process: %s", file_info["img_path"], e, exc_info=True)
+            entries, outputs = [{"original_file_info": file_info, "error": "exception in worker process: %s" % e}], []
+    finally:
+        if src_shm is not None:
+            src_shm.close()
+            src_shm.unlink()
+    dst_prefix = get_dst_prefix(scam_json["folder_path"], postprocess_options)
+    entry_by_key = {dst_prefix+entry["output_img_path"]: entry for entry in entries if entry.get("output_img_path")}
+    for i, (s3_key, name, size) in enumerate(outputs):
+        try:
+            upload = uploader.upload(_from_shared_memory(name, size), s3_key)
+        except:
+            # the blocks of the next images would never be unlinked
+            for _, next_name, _ in outputs[i+1:]:
+                _unlink_shared_memory(next_name)
+            raise
+        if s3_key in entry_by_key:
+            upload.add_done_callback(lambda f, entry=entry_by_key[s3_key]: _record_upload_error(entry, f))
+    for entry in entries:
+        _append_scam_log_entry(scam_log_json, entry, log_lock)
+
 class PostprocessFolderError(Exception):
     """Raised when a folder cannot be postprocessed due to missing/invalid data."""
 
 
-def postprocess_folder(folder_path, postprocess_options, workers=1):
+class FolderSource:
+    """
+    The sources of a folder, read through a prefetcher that can be shared with other
+    folders: the keys are given to the prefetcher with the storage of the folder.
+    The keys scheduled and not read yet are kept so that they can be released.
     """
-    post-processes a folder for use with the API
 
-    - download scam.json from S3
+    def __init__(self, prefetcher, storage):
+        self.prefetcher = prefetcher
+        self.storage = storage
+        self._lock = threading.Lock()
+        self._scheduled = set()
+
+    def schedule(self, keys, sizes=None):
+        sizes = {(self.storage, key): size for key, size in sizes.items()} if sizes else None
+        with self._lock:
+            self._scheduled.update(keys)
+        self.prefetcher.schedule([(self.storage, key) for key in keys], sizes=sizes)
+
+    def get(self, key):
+        with self._lock:
+            self._scheduled.discard(key)
+        return self.prefetcher.get((self.storage, key))
+
+    def release(self, keys=None):
+        """
+        releases the scheduled keys that were not read, all of them if keys is None
+        """
+        with self._lock:
+            if keys is None:
+                keys = list(self._scheduled)
+            else:
+                keys = [key for key in keys if key in self._scheduled]
+            self._scheduled.difference_update(keys)
+        if keys:
+            self.prefetcher.release([(self.storage, key) for key in keys])
+
+class FolderUploads:
+    """
+    The uploads of the derived images of a folder, on an uploader that can be shared
+    with other folders.
+    """
+
+    def __init__(self, uploader, storage):
+        self.uploader = uploader
+        self.storage = storage
+        self._lock = threading.Lock()
+        self._uploads = []
+        self.uploaded_bytes = 0
+
+    def upload(self, data, s3_key):
+        future = self.uploader.upload(data, (self.storage, s3_key))
+        with self._lock:
+            self._uploads.append((s3_key, len(data), future))
+        return future
+
+    def wait(self):
+        """
+        waits for the uploads of the folder and returns the list of failures
+        """
+        with self._lock:
+            uploads = list(self._uploads)
+        wait([future for _, _, future in uploads])
+        return self.failures()
+
+    def failures(self):
+        with self._lock:
+            return [{"s3_key": s3_key, "error": str(future.exception()), "attempts": getattr(future.exception(), "attempts", 1)}
+                    for s3_key, _, future in self._uploads if future.done() and future.exception() is not None]
+
+    def stats(self):
+        with self._lock:
+            ok = [size for _, size, future in self._uploads if future.done() and future.exception() is None]
+            return {
+                "uploaded": len(ok),
+                "failed": sum(1 for _, _, future in self._uploads if future.done() and future.exception() is not None),
+                "uploaded_bytes": sum(ok),
+            }
+
+# bytes per pixel of the decoded images
+DECODED_BYTES_PER_PIXEL = {"1": 1, "L": 1, "P": 1, "LA": 2, "I;16": 2, "RGB": 3, "YCbCr": 3, "LAB": 3, "RGBA": 4, "CMYK": 4, "I": 4, "F": 4}
+# libraw holds the raw data (16 bits) and a 4 channel 16-bit image along with the 8-bit RGB output
+RAW_BYTES_PER_PIXEL = 2 + 8 + 3
+
+def estimate_working_set(file_info):
+    """
+    returns an estimate in bytes of the memory taken by the derivation of a file: the
+    decoded image (and its rotated copy) and the extracted and encoded pages. Computed
+    from the dimensions and pages in file_info and from its mode ("mode" and "bit_depth"
+    if the file_info has them, RGB otherwise).
+    """
+    pages = get_output_pages(file_info)
+    if pages is None:
+        return 0
+    pixels = file_info.get("width", 0) * file_info.get("height", 0)
+    if is_likely_raw(file_info["img_path"]):
+        bpp = 3
+        decoded = pixels * RAW_BYTES_PER_PIXEL
+    else:
+        bpp = DECODED_BYTES_PER_PIXEL.get(file_info.get("mode"), 3)
+        if (file_info.get("bit_depth") or 8) > 8:
+            bpp *= 2
+        decoded = pixels * bpp
+    if file_info.get("rotation"):
+        decoded += pixels * bpp
+    if pages:
+        page_pixels = sum(min(pixels, int(page["minAreaRect"][2] * page["minAreaRect"][3])) for page in pages)
+    else:
+        page_pixels = pixels
+    # the extract and its encoding
+    return decoded + 2 * page_pixels * bpp
+
+def get_memory_budget(postprocess_options):
+    """
+    returns the memory budget in bytes of postprocess_options, or None
+    """
+    budget = postprocess_options.get("memory_budget", "auto")
+    if budget == "auto":
+        physical_memory = get_physical_memory()
+        return physical_memory // 2 if physical_memory else None
+    return budget
+
+class FolderJob:
+    """
+    A folder being postprocessed: its scam.json, its files to derive (tasks, a list of
+    (file_info, prefixes, correction)) and its scam_log.json. source and uploads are
+    its FolderSource and FolderUploads.
+    """
+
+    def __init__(self, folder_path, postprocess_options):
+        self.folder_path = folder_path
+        self.postprocess_options = postprocess_options
+        self.scam_log_json = {
+            "folder_path": folder_path,
+            "timestamp": str(datetime.now().isoformat()),
+            "postprocess_options": postprocess_options,
+            "output_files": []
+            }
+        self.json_storage = get_storage(postprocess_options.get("json_storage", "s3"))
+        self.scam_json = None
+        self.tasks = []
+        self.src_prefix = None
+        self.source = None
+        self.uploads = None
+        self.raw_contexts = None
+        self.log_lock = threading.Lock()
+        self.working_sets = {}
+        self.file_stats = {}
+
+    def close(self):
+        if self.raw_contexts is not None:
+            self.raw_contexts.close()
+            self.raw_contexts = None
+        if self.source is not None:
+            # the sources that were not read (failed files) must not hold the budget of the prefetcher
+            self.source.release()
+
+def has_color_card(file_info):
+    """
+    True if a page of the file is tagged as a color card (T1), see get_white_patch_corrections()
+    """
+    return any("tags" in p and "T1" in p["tags"] for p in file_info.get("pages") or [])
+
+def prepare_folder(job, prefetcher, uploader):
+    """
+    reads scam.json, schedules the download of the sources on prefetcher, computes the
+    corrections (white patches) and the sequence of the files of a folder and fills job.tasks
 
     Raises PostprocessFolderError for data problems (missing scam.json, etc.).
     """
-    scam_log_json = { 
-        "folder_path": folder_path,
-        "timestamp": str(datetime.now().isoformat()),
-        "postprocess_options": postprocess_options,
-        "output_files": []
-        }
-    logging.info("postprocess %s" % folder_path)
-    scam_json = get_scam_json(folder_path)
+    folder_path = job.folder_path
+    postprocess_options = job.postprocess_options
+    scam_json = get_scam_json(folder_path, storage=job.json_storage)
     if scam_json is None:
         raise PostprocessFolderError(
             "missing or unreadable scam.json on S3 (key=%sscam.json) — folder skipped"
@@ -511,69 +908,413 @@ def postprocess_folder(folder_path, postprocess_options, workers=1):
             "scam.json has no usable 'files' list (key=%sscam.json) — folder skipped"
             % folder_path
         )
+    job.scam_json = scam_json
+    src_storage = get_src_storage(scam_json, postprocess_options)
+    job.src_prefix = get_src_prefix(scam_json, postprocess_options)
+    if "source_url" in scam_json:
+        logging.info("read sources from %s", scam_json["source_url"])
+    job.source = FolderSource(prefetcher, src_storage)
+    job.uploads = FolderUploads(uploader, get_dst_storage(postprocess_options))
+    try:
+        _prepare_tasks(job, src_storage)
+    except:
+        job.close()
+        raise
+    return job
+
+def _prepare_tasks(job, src_storage):
+    postprocess_options = job.postprocess_options
+    scam_json = job.scam_json
+    scam_log_json = job.scam_log_json
+    src_prefix = job.src_prefix
+    # the processes decode the files themselves
+    if postprocess_options.get("executor", "thread") != "process":
+        job.raw_contexts = RawContextCache(postprocess_options.get("raw_context_cache_size", 2))
     img_path_to_corr = {}
     img_paths = [file_info["img_path"] for file_info in scam_json["files"]]
     img_paths = natsorted(img_paths, alg=ns.IC|ns.INT)
-    prefetcher = S3Prefetcher(max_workers=max(3, workers))
-    try:
-        prefetch_keys = [folder_path + img_path for img_path in img_paths]
-        prefetcher.schedule(prefetch_keys)
-        if postprocess_options["rgb_correction"] == "auto":
-            corrs = get_white_patch_corrections(scam_json, postprocess_options, prefetcher=prefetcher)
-            if len(corrs) > 0:
-                scam_log_json["found_rgb_corrections"] = {}
-                for img_path, corr in corrs.items():
-                    wb_factors, exp_shift, _ = corr
-                    scam_log_json["found_rgb_corrections"][img_path] = { "wb_factors": wb_factors, "exp_shift": exp_shift }
-                # we potentially use the first correction for images that are
-                # before the first image with a color card
-                curr_corr = None
-                # just looking for the first color card
-                for img_path in img_paths:
-                    if img_path in corrs:
-                        cur_corr = corrs[img_path]
-                        break
-                # then actually fill the corrections
-                for img_path in img_paths:
-                    if img_path in corrs:
-                        cur_corr = corrs[img_path]
-                    img_path_to_corr[img_path] = cur_corr
-        if len(img_path_to_corr) == 0:
-            for img_path in img_paths:
-                img_path_to_corr[img_path] = postprocess_options["rgb_correction_default"]
-        if not scam_json["checked"]:
-            logging.warning("warning: processing unchecked json %s" % folder_path)
-        add_prefix = postprocess_options["add_prefix"]
-        sequence_info = None
-        if add_prefix == "auto" and not postprocess_options["resequence"]:
+    if not scam_json["checked"]:
+        logging.warning("warning: processing unchecked json %s" % job.folder_path)
+    add_prefix = postprocess_options["add_prefix"]
+    sequence_info = None
+    if add_prefix == "auto" and not postprocess_options["resequence"]:
+        add_prefix = False
+    if add_prefix: # "auto" or True
+        sequence_info, resequenced = get_sequence_info(scam_json, postprocess_options["resequence"])
+        if postprocess_options["resequence"] == "auto" and not resequenced and add_prefix == "auto":
             add_prefix = False
-        if add_prefix: # "auto" or True
-            sequence_info, resequenced = get_sequence_info(scam_json, postprocess_options["resequence"])
-            if postprocess_options["resequence"] == "auto" and not resequenced and add_prefix == "auto":
-                add_prefix = False
-            else:
-                add_prefix = True
-        log_lock = threading.Lock() if workers > 1 else None
-
-        def _process(file_info):
+        else:
+            add_prefix = True
+    task_files = []
+    for file_info in scam_json["files"]:
+        if not add_prefix or file_info["img_path"] in sequence_info:
             prefixes = None if not add_prefix else sequence_info.get(file_info["img_path"])
-            if not add_prefix or file_info["img_path"] in sequence_info:
-                derive_from_file(scam_json, scam_log_json, file_info, postprocess_options, prefixes, img_path_to_corr[file_info["img_path"]], prefetcher=prefetcher, log_lock=log_lock)
-
-        if workers > 1:
-            with ThreadPoolExecutor(max_workers=workers) as pool:
-                futures = {pool.submit(_process, fi): fi for fi in scam_json["files"]}
-                for future in tqdm(as_completed(futures), total=len(futures)):
-                    future.result()  # re-raise any exception from the worker
+            task_files.append((file_info, prefixes))
+            job.working_sets[file_info["img_path"]] = estimate_working_set(file_info)
+    if postprocess_options.get("largest_first", True):
+        # the sort is stable, files of the same size stay in order
+        task_files.sort(key=lambda task_file: -job.working_sets[task_file[0]["img_path"]])
+    # only the files that are read are prefetched, in the order they are read: the color
+    # cards for the corrections, then the files that are derived (not the hidden ones).
+    # One listing gives the sizes of all the files, avoiding a HEAD request per file
+    src_sizes = {obj["Key"]: obj["Size"] for obj in src_storage.list(src_prefix)}
+    if postprocess_options["rgb_correction"] == "auto":
+        color_card_paths = [file_info["img_path"] for file_info in scam_json["files"] if has_color_card(file_info)]
+        job.source.schedule([src_prefix + img_path for img_path in color_card_paths], sizes=src_sizes)
+        corrs = get_white_patch_corrections(scam_json, postprocess_options, prefetcher=job.source, raw_contexts=job.raw_contexts)
+        job.source.release([src_prefix + img_path for img_path in color_card_paths])
+        if len(corrs) > 0:
+            scam_log_json["found_rgb_corrections"] = {}
+            for img_path, corr in corrs.items():
+                wb_factors, exp_shift, _ = corr
+                scam_log_json["found_rgb_corrections"][img_path] = { "wb_factors": wb_factors, "exp_shift": exp_shift }
+            # we potentially use the first correction for images that are
+            # before the first image with a color card
+            curr_corr = None
+            # just looking for the first color card
+            for img_path in img_paths:
+                if img_path in corrs:
+                    cur_corr = corrs[img_path]
+                    break
+            # then actually fill the corrections
+            for img_path in img_paths:
+                if img_path in corrs:
+                    cur_corr = corrs[img_path]
+                img_path_to_corr[img_path] = cur_corr
+    if len(img_path_to_corr) == 0:
+        for img_path in img_paths:
+            img_path_to_corr[img_path] = postprocess_options["rgb_correction_default"]
+    if not postprocess_options["dryrun"]:
+        # the color cards that are derived are scheduled again at their place in the tasks,
+        # except the raw ones kept in job.raw_contexts, which are not read again
+        job.source.schedule([src_prefix + file_info["img_path"] for file_info, _ in task_files
+                             if get_output_pages(file_info) is not None and (job.raw_contexts is None or file_info["img_path"] not in job.raw_contexts)],
+                            sizes=src_sizes)
+    for file_info, prefixes in task_files:
+        job.tasks.append((file_info, prefixes, img_path_to_corr[file_info["img_path"]]))
+
+def derive_task(job, task, raw_service=None, process_pool=None):
+    """
+    derives a file of job.tasks, in a worker process if process_pool is given
+    """
+    file_info, prefixes, correction = task
+    try:
+        if process_pool is not None:
+            derive_file_in_process(process_pool, job.scam_json, job.scam_log_json, file_info, job.postprocess_options, prefixes, correction, job.source, job.uploads, log_lock=job.log_lock)
         else:
-            for file_info in tqdm(scam_json["files"]):
-                _process(file_info)
+            derive_from_file(job.scam_json, job.scam_log_json, file_info, job.postprocess_options, prefixes, correction, prefetcher=job.source, log_lock=job.log_lock, uploader=job.uploads, raw_contexts=job.raw_contexts, raw_service=raw_service)
     finally:
-        prefetcher.close()
-    scam_log_s3_key = "scam_logs/"+scam_json["folder_path"]+"scam_log.json"
+        # the source was not read if the file failed early or was rendered from a raw context
+        job.source.release([job.src_prefix + file_info["img_path"]])
+
+def task_pages(task):
+    """
+    returns the number of pages of a file of job.tasks, the unit of the throughput of the worker controller
+    """
+    return max(1, len(task[0].get("pages") or []))
+
+def submit_task(pool, budget, job, task, raw_service=None, process_pool=None, controller=None):
+    """
+    submits a file of job.tasks to pool once a worker is available in controller (a
+    WorkerController, if given) and its working set is admitted by budget (a MemoryBudget),
+    returns the future. The time waiting for the admission and for a thread are recorded
+    in job.file_stats.
+    """
+    img_path = task[0]["img_path"]
+    size = job.working_sets.get(img_path, 0)
+    if controller is not None:
+        controller.acquire()
+    try:
+        admission_wait = budget.acquire(size)
+    except:
+        if controller is not None:
+            controller.release(0)
+        raise
+    admitted = time.monotonic()
+
+    def _run():
+        job.file_stats[img_path] = {
+            "working_set": size,
+            "admission_wait": round(admission_wait, 3),
+            "queue_wait": round(time.monotonic() - admitted, 3),
+        }
+        derive_task(job, task, raw_service, process_pool)
+
+    def _release(future=None):
+        budget.release(size)
+        if controller is not None:
+            controller.release(task_pages(task) if future is not None and future.exception() is None else 0)
+
+    try:
+        future = pool.submit(_run)
+    except:
+        _release()
+        raise
+    future.add_done_callback(_release)
+    return future
+
+def finish_folder(job, stats):
+    """
+    waits for the uploads of a folder and writes its scam_log.json, with the entries in
+    the order of the files and stats (a dict) added
+    """
+    job.close()
+    folder_path = job.folder_path
+    scam_log_json = job.scam_log_json
+    # the folder is only done once all the derived images are on S3
+    upload_failures = job.uploads.wait()
+    if upload_failures:
+        logging.error("%d uploads failed for %s", len(upload_failures), folder_path)
+        scam_log_json["upload_failures"] = upload_failures
+    scam_log_json["upload_stats"] = job.uploads.stats()
+    scam_log_json.update(stats)
+    scam_log_json["file_stats"] = job.file_stats
+    # the stats shared by the folders of a csv are the totals of the run so far (see PostprocessScheduler)
+    totals = stats.get("run_stats", stats)
+    if "prefetch_stats" in totals:
+        logging.info("prefetch stats after %s: %s", folder_path, json.dumps(totals["prefetch_stats"]))
+    if "disk_cache_stats" in totals:
+        logging.info("disk cache stats after %s: %s", folder_path, json.dumps(totals["disk_cache_stats"]))
+    if totals.get("s3_stats", {}).get("throttles"):
+        logging.warning("S3 stats after %s: %s", folder_path, json.dumps(totals["s3_stats"]))
+    order_output_files(scam_log_json, job.scam_json)
+    scam_log_s3_key = "scam_logs/"+job.scam_json["folder_path"]+"scam_log.json"
     logging.info("write scam log on %s", scam_log_s3_key)
     scam_log_json_str = json.dumps(scam_log_json, indent=2)
-    upload_to_s3(scam_log_json_str.encode('utf-8'), scam_log_s3_key)
+    job.json_storage.put(scam_log_s3_key, scam_log_json_str.encode('utf-8'))
+
+def _task_threads(postprocess_options, workers):
+    # with processes, each worker has one file being derived and one waiting in shared memory
+    if postprocess_options.get("executor", "thread") == "process":
+        return 2 * workers
+    return workers
+
+def get_max_workers(postprocess_options, workers):
+    """
+    returns the number of workers of the pools, the maximum number of active workers when workers is "auto"
+    """
+    if workers == "auto":
+        return postprocess_options.get("auto_max_workers") or os.cpu_count() or 1
+    return workers
+
+def new_worker_controller(postprocess_options, workers, prefetcher):
+    """
+    returns a started WorkerController adjusting the number of active workers when workers is "auto", None otherwise
+    """
+    if workers != "auto":
+        return None
+    max_workers = get_max_workers(postprocess_options, workers)
+    ceiling = get_memory_ceiling(postprocess_options.get("auto_memory_ceiling", "auto"))
+    return WorkerController("postprocess", max_workers, start_workers=max(1, max_workers // 2), memory_ceiling=ceiling,
+                            s3_wait=lambda: prefetcher.wait_time, interval=postprocess_options.get("auto_interval", 15)).start()
+
+def _new_raw_service(postprocess_options):
+    if postprocess_options.get("raw_decode_processes") and not postprocess_options["dryrun"] and postprocess_options.get("executor", "thread") != "process":
+        return RawDecodeService(postprocess_options["raw_decode_processes"], quality=postprocess_options.get("raw_quality", "best"), max_buffers=postprocess_options.get("raw_max_buffers"))
+    return None
+
+def _new_prefetcher(postprocess_options, workers):
+    prefetch_max_objects = postprocess_options.get("prefetch_max_objects") or 2 * max(3, workers)
+    return S3Prefetcher(max_workers=max(3, workers), max_bytes=postprocess_options.get("prefetch_max_bytes"), max_objects=prefetch_max_objects)
+
+def _new_uploader(postprocess_options):
+    return S3Uploader(max_workers=postprocess_options["upload_workers"], max_queued=postprocess_options["upload_queue_size"])
+
+def _run_stats(prefetcher, raw_service, budget, controller=None):
+    stats = {"prefetch_stats": prefetcher.stats(), "memory_stats": budget.stats()}
+    if controller is not None:
+        stats["worker_controller_stats"] = controller.stats()
+    if raw_service is not None:
+        stats["raw_decode_stats"] = raw_service.stats()
+    disk_cache = get_disk_cache()
+    if disk_cache is not None:
+        stats["disk_cache_stats"] = disk_cache.stats()
+    stats["s3_stats"] = get_s3_stats()
+    return stats
+
+def postprocess_folder(folder_path, postprocess_options, workers=1):
+    """
+    post-processes a folder for use with the API
+
+    - download scam.json from S3
+
+    workers is the number of workers, or "auto" to adjust it while the folder is
+    derived (see worker_controller.py).
+
+    Raises PostprocessFolderError for data problems (missing scam.json, etc.).
+    """
+    logging.info("postprocess %s" % folder_path)
+    disk_cache = get_disk_cache()
+    if disk_cache is not None:
+        disk_cache.reset_stats()
+    reset_s3_stats()
+    job = FolderJob(folder_path, postprocess_options)
+    controller = None
+    max_workers = get_max_workers(postprocess_options, workers)
+    prefetcher = _new_prefetcher(postprocess_options, max_workers)
+    uploader = _new_uploader(postprocess_options)
+    raw_service = _new_raw_service(postprocess_options)
+    process_pool = new_process_pool(max_workers) if postprocess_options.get("executor", "thread") == "process" else None
+    budget = MemoryBudget(get_memory_budget(postprocess_options))
+    try:
+        prepare_folder(job, prefetcher, uploader)
+        controller = new_worker_controller(postprocess_options, workers, prefetcher)
+        with ThreadPoolExecutor(max_workers=max(1, _task_threads(postprocess_options, max_workers))) as pool, tqdm(total=len(job.tasks)) as progress:
+            futures = []
+            for task in job.tasks:
+                future = submit_task(pool, budget, job, task, raw_service, process_pool, controller)
+                future.add_done_callback(lambda f: progress.update(1))
+                futures.append(future)
+            for future in futures:
+                future.result()  # re-raise any exception from the worker
+    finally:
+        job.close()
+        if controller is not None:
+            controller.stop()
+        if raw_service is not None:
+            raw_service.close()
+        if process_pool is not None:
+            process_pool.shutdown()
+        prefetcher.close()
+        uploader.close()
+    finish_folder(job, _run_stats(prefetcher, raw_service, budget, controller))
+
+class PostprocessScheduler:
+    """
+    Postprocesses the folders of a csv with one pool of workers, one prefetcher and
+    one uploader for all the folders.
+
+    The folders are prepared (scam.json, white patch corrections, sequence) up to
+    prepare_ahead folders in advance on their own threads, and their files are fed
+    to the pool in the order of the csv: the files of the next folders fill the pool
+    while the last files of a folder are derived. At most max_inflight files are
+    derived or waiting for a worker, their working sets are admitted against one
+    memory budget (see submit_task) and the budget of the prefetcher bounds the
+    memory of the sources of all the folders. With workers="auto", the number of
+    active workers is adjusted during the run (see worker_controller.py).
+
+    The scam_log.json of a folder is written as soon as its files are derived and
+    uploaded. The prefetcher, the pools, S3 and the disk cache are shared by folders
+    that overlap, their stats are recorded under run_stats: the totals of the run
+    when the folder was done.
+    """
+
+    def __init__(self, postprocess_options, workers=1, prepare_ahead=2, max_inflight=None):
+        self.workers = workers
+        max_workers = get_max_workers(postprocess_options, workers)
+        self.prepare_ahead = max(1, prepare_ahead)
+        threads = max(1, _task_threads(postprocess_options, max_workers))
+        self.max_inflight = max_inflight or 2 * threads
+        self.prefetcher = _new_prefetcher(postprocess_options, max_workers)
+        self.uploader = _new_uploader(postprocess_options)
+        self.raw_service = _new_raw_service(postprocess_options)
+        self.process_pool = new_process_pool(max_workers) if postprocess_options.get("executor", "thread") == "process" else None
+        self.budget = MemoryBudget(get_memory_budget(postprocess_options))
+        self.controller = new_worker_controller(postprocess_options, workers, self.prefetcher)
+        self._pool = ThreadPoolExecutor(max_workers=threads)
+        self._prepare_pool = ThreadPoolExecutor(max_workers=self.prepare_ahead)
+        self._finish_pool = ThreadPoolExecutor(max_workers=1)
+        self._slots = threading.BoundedSemaphore(self.max_inflight)
+        self._lock = threading.Lock()
+        self._progress = None
+
+    def run(self, folders):
+        """
+        postprocesses folders, a list of (folder_path, postprocess_options). Returns the
+        list of the folders done and the list of (folder_path, reason) of the folders
+        that failed.
+        """
+        ok_folders = []
+        failed_folders = []
+        prepared = {}
+        dispatched = []
+        # the run_stats of the folders are totals since the start of the run
+        disk_cache = get_disk_cache()
+        if disk_cache is not None:
+            disk_cache.reset_stats()
+        reset_s3_stats()
+
+        def _prepare(i):
+            prepared[i] = self._prepare_pool.submit(prepare_folder, FolderJob(*folders[i]), self.prefetcher, self.uploader)
+
+        for i in range(min(self.prepare_ahead, len(folders))):
+            _prepare(i)
+        with tqdm(total=0) as self._progress:
+            for i, (folder_path, _) in enumerate(folders):
+                if i + self.prepare_ahead < len(folders):
+                    _prepare(i + self.prepare_ahead)
+                try:
+                    job = prepared.pop(i).result()
+                except PostprocessFolderError as e:
+                    logging.error("SKIP FOLDER %s: %s", folder_path, e)
+                    failed_folders.append((folder_path, str(e)))
+                    continue
+                except Exception as e:
+                    logging.error("SKIP FOLDER %s: unexpected error: %s", folder_path, e, exc_info=True)
+                    failed_folders.append((folder_path, "unexpected error: %s" % e))
+                    continue
+                logging.info("postprocess %s" % folder_path)
+                dispatched.append(job)
+                self._dispatch(job)
+            for job in dispatched:
+                try:
+                    job.done.result()
+                    ok_folders.append(job.folder_path)
+                except Exception as e:
+                    logging.error("SKIP FOLDER %s: unexpected error: %s", job.folder_path, e, exc_info=(type(e), e, e.__traceback__))
+                    failed_folders.append((job.folder_path, "unexpected error: %s" % e))
+        self._progress = None
+        return ok_folders, failed_folders
+
+    def _dispatch(self, job):
+        job.done = Future()
+        job.error = None
+        job.remaining = len(job.tasks)
+        self._progress.total += len(job.tasks)
+        self._progress.refresh()
+        if not job.tasks:
+            self._finish_pool.submit(self._finish, job)
+            return
+        for task in job.tasks:
+            # blocks while max_inflight files are in the pool, while all the active workers are busy (auto mode)
+            # or while the file doesn't fit in the memory budget
+            self._slots.acquire()
+            future = submit_task(self._pool, self.budget, job, task, self.raw_service, self.process_pool, self.controller)
+            future.add_done_callback(lambda f, job=job: self._task_done(job, f))
+
+    def _task_done(self, job, future):
+        self._slots.release()
+        with self._lock:
+            if future.exception() is not None and job.error is None:
+                job.error = future.exception()
+            job.remaining -= 1
+            last = job.remaining == 0
+            self._progress.update(1)
+        if last:
+            self._finish_pool.submit(self._finish, job)
+
+    def _finish(self, job):
+        try:
+            if job.error is not None:
+                job.close()
+                raise job.error
+            finish_folder(job, {"run_stats": _run_stats(self.prefetcher, self.raw_service, self.budget, self.controller)})
+            job.done.set_result(None)
+        except Exception as e:
+            job.done.set_exception(e)
+
+    def close(self):
+        self._pool.shutdown()
+        self._prepare_pool.shutdown()
+        self._finish_pool.shutdown()
+        if self.controller is not None:
+            self.controller.stop()
+        if self.raw_service is not None:
+            self.raw_service.close()
+        if self.process_pool is not None:
+            self.process_pool.shutdown()
+        self.prefetcher.close()
+        self.uploader.close()
 
 def get_bbox(page_info, file_info, img_w, img_h, add_file_info_rotation=False):
     # TODO: test rotation stuff
@@ -584,27 +1325,31 @@ def get_bbox(page_info, file_info, img_w, img_h, add_file_info_rotation=False):
         mar = rotate_mar(mar, file_info["rotation"], img_w, img_h)
     return get_bounding_box(mar, img_w, img_h)
 
-def get_raw_corrections(folder_path, img_path, page_info, file_info, postprocess_options, prefetcher=None):
+def get_raw_corrections(folder_path, img_path, page_info, file_info, postprocess_options, prefetcher=None, raw_contexts=None):
     """
     returns the corrections for a raw file
+
+    if raw_contexts (a RawContextCache) is given, the file (read and parsed) is kept
+    in it for the postprocessing of the file
     """
     blob = gets3blob(folder_path+img_path, prefetcher=prefetcher)
     if blob is None:
         logging.error("cannot find %s", (folder_path+img_path))
         return
-    blob.seek(0)
-    tags = exifread.process_file(blob, details=False)
-    blob.seek(0)
     try:
-        raw = rawpy.imread(blob)
-    except:
+        raw_context = RawContext(blob)
+    except TypeError:
         logging.error("could not read "+img_path+" for raw corrections")
         return None
-    bbox = get_bbox(page_info, file_info, raw.sizes.width, raw.sizes.height, add_file_info_rotation=True)
+    bbox = get_bbox(page_info, file_info, raw_context.sizes.width, raw_context.sizes.height, add_file_info_rotation=True)
     logging.error("getting correction factors from %s" % img_path)
     target_lnsrgb_mean = sRGB_inverse_gamma(postprocess_options["wb_patch_nsrgb_target"][0])
-    wb_factors, exp_shift = get_factors_from_raw(raw, bbox, target_lnsrgb_mean)
-    return wb_factors, exp_shift, tags
+    wb_factors, exp_shift = raw_context.get_factors(bbox, target_lnsrgb_mean)
+    if raw_contexts is not None and get_output_pages(file_info) is not None:
+        raw_contexts.put(img_path, raw_context)
+    else:
+        raw_context.close()
+    return wb_factors, exp_shift, raw_context.exif
 
 def get_cv2_corrections(folder_path, img_path, page_info, file_info, postprocess_options, prefetcher=None):
     blob = gets3blob(folder_path+img_path, prefetcher=prefetcher)
@@ -665,20 +1410,39 @@ def get_adjusted_correction(orig_corrections, dest_exif):
         return wb_factors, new_exp_shift, original_exif
     return orig_corrections
 
-def get_postprocess_pil_img(folder_path, img_path, params, postprocess_options, output_file_info, try_simple_copy=False, prefetcher=None):
-    blob = gets3blob(folder_path+img_path, prefetcher=prefetcher)
-    if blob is None:
-        logging.error("cannot find %s", (folder_path+img_path))
-    blob.seek(0)
-    exif = exifread.process_file(blob, details=False)
-    blob.seek(0)
+def get_postprocess_pil_img(folder_path, img_path, params, postprocess_options, output_file_info, try_simple_copy=False, prefetcher=None, raw_context=None, raw_service=None):
+    """
+    raw_context is the RawContext of the file if it was read for the corrections,
+    it is then used instead of reading and parsing the file again
+
+    if raw_service (a RawDecodeService) is given, the other raw files are demosaiced by
+    its processes and a raw_service.SharedArray is returned instead of a PIL image
+    """
+    if raw_context is not None:
+        blob = raw_context.blob
+        exif = raw_context.exif
+    else:
+        blob = gets3blob(folder_path+img_path, prefetcher=prefetcher)
+        if blob is None:
+            logging.error("cannot find %s", (folder_path+img_path))
+        blob.seek(0)
+        exif = exifread.process_file(blob, details=False)
+        blob.seek(0)
     if params and params != "auto":
         params = get_adjusted_correction(params, exif)
         wb_factors, exp_shift, exif = params
         output_file_info["wb_factors"] = wb_factors
         output_file_info["exp_shift"] = exp_shift
     if is_likely_raw(img_path):
-        np_img = get_np_from_raw(blob, params, False)
+        if raw_context is not None:
+            try:
+                np_img = raw_context.render(params, False)
+            finally:
+                raw_context.close()
+        elif raw_service is not None:
+            return raw_service.decode(blob, params, False), None, None
+        else:
+            np_img = get_np_from_raw(blob, params, False)
         return Image.fromarray(np_img), None, None
     else:
         ext = img_path[-4:].lower()
@@ -733,7 +1497,7 @@ def get_scaled_mar(file_info, page_info, img_w, img_h):
     scale_factor_y = img_h / fi_height
     return ((c_x*scale_factor_x, c_y*scale_factor_y), (w*scale_factor_x, h*scale_factor_y), a)
 
-def get_white_patch_corrections(scam_json, postprocess_options, prefetcher=None):
+def get_white_patch_corrections(scam_json, postprocess_options, prefetcher=None, raw_contexts=None):
     """
     returns an object with the keys being file paths and values being a set with:
             - wb correction factors derived from white patch annotations. These are not normalized so that the green channel is 1 and thus include some exposure compensation
@@ -747,25 +1511,66 @@ def get_white_patch_corrections(scam_json, postprocess_options, prefetcher=None)
         for p in file_info["pages"]:
             if "tags" in p and "T1" in p["tags"]:
                 if is_likely_raw(file_info["img_path"]):
-                    corrs = get_raw_corrections(scam_json["folder_path"], file_info["img_path"], p, file_info, postprocess_options, prefetcher=prefetcher)
+                    corrs = get_raw_corrections(get_src_prefix(scam_json, postprocess_options), file_info["img_path"], p, file_info, postprocess_options, prefetcher=prefetcher, raw_contexts=raw_contexts)
                 else:
-                    corrs = get_cv2_corrections(scam_json["folder_path"], file_info["img_path"], p, file_info, postprocess_options, prefetcher=prefetcher)
+                    corrs = get_cv2_corrections(get_src_prefix(scam_json, postprocess_options), file_info["img_path"], p, file_info, postprocess_options, prefetcher=prefetcher)
                 if corrs is not None:
                     res[img_path] = corrs
                     break
     return res
 
+def _workers_arg(value):
+    if value == "auto":
+        return value
+    try:
+        return int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError("must be a number or auto")
+
 def postprocess_csv():
     parser = argparse.ArgumentParser(description="SCAM postprocessor")
     parser.add_argument("csv", help="path to the CSV file listing folders to process")
     parser.add_argument("--compress", action="store_true", help="output JPEG at quality 85 run through mozjpeg (binary images stay G4 TIFF)")
     parser.add_argument("--jxl", action="store_true", help="output lossless JPEG-XL for non-binary images (uncompressed path only)")
-    parser.add_argument("--workers", type=int, default=1, metavar="N", help="number of parallel worker threads (default: 1)")
+    parser.add_argument("--workers", type=_workers_arg, default=1, metavar="N", help="number of parallel worker threads, or auto to adjust it to the throughput, CPU, S3 waits and memory of the run (default: 1)")
+    parser.add_argument("--auto-max-workers", type=int, default=None, metavar="N", help="maximum number of workers with --workers auto (default: number of cpus)")
+    parser.add_argument("--upload-workers", type=int, default=None, metavar="N", help="number of background upload threads (default: 4)")
+    parser.add_argument("--cache-dir", default=None, metavar="DIR", help="keep the source files in a persistent local cache in DIR (default: $SCAM_CACHE_DIR if set, no cache otherwise)")
+    parser.add_argument("--cache-max-gb", type=float, default=50, metavar="GB", help="maximum size of the local cache (default: 50)")
+    parser.add_argument("--prefetch-mb", type=int, default=None, metavar="MB", help="maximum MB of source files held in memory by the prefetcher (default: 2048)")
+    parser.add_argument("--memory-budget-gb", type=float, default=None, metavar="GB", help="maximum estimated memory of the files derived at the same time (default: half of the physical memory)")
+    parser.add_argument("--prepare-ahead", type=int, default=2, metavar="N", help="number of folders prepared (scam.json, color card corrections) while the previous ones are derived (default: 2)")
+    parser.add_argument("--executor", choices=["thread", "process"], default="thread", help="derive the files in --workers threads or worker processes (default: thread)")
+    parser.add_argument("--raw-processes", type=int, default=0, metavar="N", help="demosaic the RAW files in N processes, --workers is raised to N if lower (default: 0, demosaic in the worker threads)")
+    parser.add_argument("--raw-quality", choices=["draft", "fast", "normal", "best"], default="best", help="demosaicing quality of the RAW processes, draft is half size (default: best)")
+    parser.add_argument("--raw-max-buffers", type=int, default=None, metavar="N", help="maximum number of RAW files demosaiced or waiting to be derived at once (default: 2 per RAW process)")
     args = parser.parse_args()
+    base_options = DEFAULT_POSTPROCESS_OPTIONS.copy()
+    base_options["auto_max_workers"] = args.auto_max_workers
+    if args.workers != "auto":
+        # the worker threads wait for the raw processes
+        args.workers = max(args.workers, args.raw_processes)
+    if args.cache_dir:
+        set_disk_cache(args.cache_dir, int(args.cache_max_gb * 1024*1024*1024))
+    upload_workers = args.upload_workers or DEFAULT_POSTPROCESS_OPTIONS["upload_workers"]
+    # prefetcher and uploader threads all share the same S3 client
+    set_s3_concurrency(max(3, get_max_workers(base_options, args.workers)) + upload_workers)
 
-    ok_folders = []
-    failed_folders = []  # list of (folder, reason)
+    if args.compress:
+        base_options["compress_output"] = True
+    if args.jxl:
+        base_options["output_jxl"] = True
+    base_options["upload_workers"] = upload_workers
+    if args.prefetch_mb is not None:
+        base_options["prefetch_max_bytes"] = args.prefetch_mb * 1024 * 1024
+    base_options["executor"] = args.executor
+    if args.memory_budget_gb is not None:
+        base_options["memory_budget"] = int(args.memory_budget_gb * 1024*1024*1024)
+    base_options["raw_decode_processes"] = args.raw_processes
+    base_options["raw_quality"] = args.raw_quality
+    base_options["raw_max_buffers"] = args.raw_max_buffers
 
+    folders = []  # list of (folder, postprocess_options)
     with open(args.csv, newline='') as csvfile:
         reader = csv.reader(csvfile)
         for row in reader:
@@ -774,24 +1579,17 @@ def postprocess_csv():
             folder = row[0].strip()
             if not folder.endswith('/'):
                 folder += "/"
-            postprocess_options = DEFAULT_POSTPROCESS_OPTIONS.copy()
+            postprocess_options = base_options.copy()
             if len(row) > 1 and "keep in order" in row[1]:
                 postprocess_options["resequence"] = False
-            if args.compress:
-                postprocess_options["compress_output"] = True
-            if args.jxl:
-                postprocess_options["output_jxl"] = True
-            try:
-                postprocess_folder(folder, postprocess_options, workers=args.workers)
-                ok_folders.append(folder)
-            except PostprocessFolderError as e:
-                logging.error("SKIP FOLDER %s: %s", folder, e)
-                failed_folders.append((folder, str(e)))
-            except Exception as e:
-                logging.error(
-                    "SKIP FOLDER %s: unexpected error: %s", folder, e, exc_info=True
-                )
-                failed_folders.append((folder, "unexpected error: %s" % e))
+            folders.append((folder, postprocess_options))
+
+    # the files of all the folders go through the same workers, prefetcher and uploader
+    scheduler = PostprocessScheduler(base_options, workers=args.workers, prepare_ahead=args.prepare_ahead)
+    try:
+        ok_folders, failed_folders = scheduler.run(folders)
+    finally:
+        scheduler.close()
 
     print("")
     print("=" * 72)
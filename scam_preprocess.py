@@ -1,57 +1,103 @@
+import io
+import os
 import csv
 import sys
-from utils import list_img_keys, gets3blob, upload_to_s3, get_gzip_picked_bytes, VERSION, save_scam_json, S3Prefetcher
-from datetime import datetime
+import time
+import queue
 import logging
+import threading
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from utils import is_img, gets3blob, upload_to_s3, get_gzip_picked_bytes, VERSION, save_scam_json, S3Prefetcher, S3Uploader, get_disk_cache, reset_s3_stats, get_s3_stats
+from datetime import datetime
 from PIL import Image
-from image_decode import decode_blob_to_pil, get_image_size_from_blob
-#from cal_sam_pickles import get_sam_output
-from img_utils import apply_exif_rotation, encode_thumbnail_img, get_best_mode, apply_icc
+from image_decode import decode_blob_to_pil, decode_pyramid
+from img_utils import encode_thumbnail_img, get_best_mode, apply_icc
 from tqdm import tqdm
-from raw_utils import register_raw_opener
+from raw_utils import register_raw_opener, is_likely_raw
+from image_probe import probe_folder
 from natsort import natsorted
+from storage import get_storage
+from stage_stats import StageStats, pipeline_stats
+from worker_controller import WorkerController, get_memory_ceiling
+from ann_index import build_ann_index, get_image_features, save_ann_index, ANN_INDEX_NAME
+from sam_masks import encode_sam_masks, get_sam_masks_path
 
 DEFAULT_PREPROCESS_OPTIONS = {
     "pps": 8,
     "sam_resize": 1024,
     "thumbnail_resize": 512,
     "pre_rotate": 0,
+    "sam_min_area_ratio": 0.01, # SAM annotations with a bbox smaller than this ratio of the image are not stored, must be below the smallest area_ratio_range used in scam
+    "sam_max_masks": None, # maximum number of SAM annotations stored per image (the largest ones), None for no maximum
+    "sam_nms_iou": None, # SAM annotations with a bbox iou above this with a larger one are not stored, None to keep them
+    "sam_format": "samz", # format of the SAM results, "samz" for the containers of sam_masks.py, "pickle_gz" for gzipped pickles
     "run_sam": False,
     "use_exif_rotation": True,
-    "grayscale_thumbnail": False
+    "grayscale_thumbnail": False,
+    "fetch_workers": 3, # number of threads reading the images ahead of the decoding
+    "decode_workers": 2, # number of processes decoding images and encoding thumbnails (0 to decode in the main process, "auto" to adjust it during the run, see worker_controller.py)
+    "encode_workers": 2, # number of threads compressing the SAM pickles
+    "upload_workers": 4, # number of threads uploading thumbnails and pickles in the background
+    "queue_size": 8, # maximum number of images waiting between two stages of the pipeline
+    "probe_headers": True, # read the image dimensions from the headers with ranged GETs
+    "auto_max_workers": None, # with decode_workers="auto", maximum number of decoding processes, None for the number of cpus
+    "auto_interval": 15, # with decode_workers="auto", seconds between two adjustments of the number of decoding processes
+    "auto_memory_ceiling": "auto", # with decode_workers="auto", RSS in bytes above which decoding processes are removed, "auto" for 3/4 of the physical memory, None for no ceiling
 }
 
 def run_sam(pil_img, preprocess_options):
-    return get_sam_output(pil_img, max_size=preprocess_options["sam_resize"], points_per_side=preprocess_options["pps"])
+    # imported here so that the decoding processes don't load torch
+    from cal_sam_pickles import get_sam_output
+    return get_sam_output(pil_img, max_size=preprocess_options["sam_resize"], points_per_side=preprocess_options["pps"],
+                          min_area_ratio=preprocess_options.get("sam_min_area_ratio"), max_masks=preprocess_options.get("sam_max_masks"),
+                          nms_iou=preprocess_options.get("sam_nms_iou"))
 
-def save_sam_pickle(pickle_path, sam_res):
-    pickle_bytes = get_gzip_picked_bytes(sam_res)
-    upload_to_s3(pickle_bytes, pickle_path)
+def upload(data, s3_key, uploader=None):
+    if uploader is not None:
+        return uploader.upload(data, s3_key)
+    return upload_to_s3(data, s3_key)
+
+def save_sam_pickle(pickle_path, sam_res, uploader=None):
+    if pickle_path.endswith(".samz"):
+        pickle_bytes = encode_sam_masks(sam_res)
+    else:
+        pickle_bytes = get_gzip_picked_bytes(sam_res)
+    upload(pickle_bytes, pickle_path, uploader)
 
-def get_pickle_path(folder_path, img_path):
+def get_pickle_path(folder_path, img_path, sam_format="samz"):
+    if sam_format == "samz":
+        return get_sam_masks_path(folder_path, img_path)
     return "sam_pickle_gz/"+folder_path+img_path+"_sam_pickle.gz"
 
-def get_all_img_paths(folder_path):
+def get_all_img_paths(folder_path, storage=None):
     img_keys = []
-    for img_full_key in natsorted(list_img_keys(folder_path)):
+    storage = get_storage(storage)
+    for img_full_key in natsorted(obj["Key"] for obj in storage.list(folder_path) if is_img(obj["Key"])):
         if "_cropped_uncompressed/" in img_full_key:
             continue
         img_keys.append(img_full_key[len(folder_path):])
     return img_keys
 
 RAW_OPENER_REGISTERED = False
-def get_pil_img(folder_path, img_path, prefetcher=None, max_dimension=None):
+def ensure_raw_opener(img_path):
     global RAW_OPENER_REGISTERED
+    if not RAW_OPENER_REGISTERED and is_likely_raw(img_path):
+        logging.info("register raw opener")
+        register_raw_opener()
+        RAW_OPENER_REGISTERED = True
+
+def get_pil_img(folder_path, img_path, prefetcher=None, max_dimension=None):
     blob = gets3blob(folder_path+img_path, prefetcher=prefetcher)
     if blob is None:
         logging.error("cannot find %s", (folder_path+img_path))
-    if not RAW_OPENER_REGISTERED and img_path[-4:].lower() in [".nef", ".cr2", ".dng", ".arw", ".cr3"]:
-        print("register raw opener")
-        register_raw_opener()
-        RAW_OPENER_REGISTERED = True
+    ensure_raw_opener(img_path)
     return decode_blob_to_pil(blob, max_dimension=max_dimension, img_path=img_path)
 
-def save_thumbnail(folder_path, img_path, pil_img, preprocess_options):
+def make_thumbnail(folder_path, img_path, pil_img, preprocess_options):
+    """
+    returns the path, the encoded bytes (None on error), the width and the height of the thumbnail
+    """
     max_dim = preprocess_options["thumbnail_resize"]
     if max(pil_img.width, pil_img.height) > max_dim:
         ratio = min(max_dim / pil_img.width, max_dim / pil_img.height)
@@ -63,28 +109,322 @@ def save_thumbnail(folder_path, img_path, pil_img, preprocess_options):
         new_height = pil_img.height
     ext = ".png" if get_best_mode(pil_img) == "1" else ".jpg"
     path = "thumbnails/"+folder_path+img_path+ext
+    byts = None
     try:
         byts, ext = encode_thumbnail_img(pil_img, mozjpeg_optimize=True)
-        upload_to_s3(byts, path)
     except Exception as e:
-        logging.error("error saving %s" % (folder_path+img_path))
+        logging.error("error encoding thumbnail of %s" % (folder_path+img_path))
         logging.error(e)
+    return path, byts, new_width, new_height
+
+def save_thumbnail(folder_path, img_path, pil_img, preprocess_options, uploader=None):
+    path, byts, new_width, new_height = make_thumbnail(folder_path, img_path, pil_img, preprocess_options)
+    if byts is not None:
+        try:
+            upload(byts, path, uploader)
+        except Exception as e:
+            logging.error("error saving %s" % (folder_path+img_path))
+            logging.error(e)
     return path, new_width, new_height
 
 def sanitize_for_preprocessing(pil_img):
     pil_img = apply_icc(pil_img)
     return pil_img.convert('RGB')
 
-def preprocess_folder(folder_path, preprocess_options=DEFAULT_PREPROCESS_OPTIONS):
+def _blob_to_bytes(blob):
+    if hasattr(blob, "getvalue"):
+        return blob.getvalue()
+    # mmap from a local storage or the disk cache
+    data = blob[:]
+    blob.close()
+    return data
+
+def decode_for_preprocess(data, folder_path, img_path, probe, preprocess_options):
+    """
+    decode stage of the pipeline, runs in a worker process: returns the dimensions,
+    the encoded thumbnail, the exif rotation and the image to give to SAM (if run_sam)
+    """
+    start = time.monotonic()
+    ensure_raw_opener(img_path)
+    sizes = {"thumbnail": preprocess_options["thumbnail_resize"]}
+    if preprocess_options["run_sam"]:
+        sizes["sam"] = preprocess_options["sam_resize"]
+    # one decode for the size, the thumbnail and the SAM input
+    pyramid = decode_pyramid(io.BytesIO(data), img_path=img_path, sizes=sizes)
+    if probe.get("width") and not is_likely_raw(img_path):
+        orig_width, orig_height = probe["width"], probe["height"]
+    else:
+        # the header dimensions of raw files can differ a bit from the demosaiced image
+        orig_width, orig_height = pyramid.original_size
+    # the thumbnail is not rotated, the rotation is recorded in scam.json
+    thumbnail_path, thumbnail_bytes, thumbnail_w, thumbnail_h = make_thumbnail(folder_path, img_path, pyramid.get("thumbnail", oriented=False), preprocess_options)
+    rotation = pyramid.rotation if preprocess_options["use_exif_rotation"] else 0
+    # TODO: handle preprocess_options["pre_rotate]
+    #pil_img = sanitize_for_preprocessing(pil_img)
+    sam_img = None
+    if preprocess_options["run_sam"]:
+        sam_img = pyramid.get("sam", oriented=preprocess_options["use_exif_rotation"])
+    return {
+        "width": orig_width,
+        "height": orig_height,
+        "rotation": rotation,
+        "thumbnail_path": thumbnail_path,
+        "thumbnail_bytes": thumbnail_bytes,
+        "thumbnail_w": thumbnail_w,
+        "thumbnail_h": thumbnail_h,
+        "sam_img": sam_img,
+        "decode_time": time.monotonic() - start,
+    }
+
+def _run_inline(fn, *args):
+    future = Future()
+    try:
+        future.set_result(fn(*args))
+    except Exception as e:
+        future.set_exception(e)
+    return future
+
+def run_preprocess_pipeline(folder_path, img_paths, src_prefix, src_storage, storage, probes, preprocess_options, run_info):
+    """
+    runs the preprocessing of the images as a pipeline of stages connected by bounded queues:
+
+    - fetch: the blobs are read by the threads of a prefetcher
+    - decode: decoding and thumbnail encoding on a pool of processes
+    - sam: one thread owning the model, the queue in front of it is kept full
+      so that the GPU is never waiting for the decoding
+    - upload: pickles are compressed and uploaded (as well as thumbnails) on threads
+
+    returns ({img_path: file entry of scam.json}, upload failures, {img_path: features
+    of the annotations for the index, see ann_index.py}) and writes the stats of the
+    stages in run_info["pipeline"]
+
+    With decode_workers="auto", the pool has auto_max_workers processes and a
+    WorkerController sets how many images are decoded at the same time.
+    """
+    queue_size = preprocess_options.get("queue_size", 8)
+    decode_workers = preprocess_options.get("decode_workers", 2)
+    auto = decode_workers == "auto"
+    if auto:
+        decode_workers = preprocess_options.get("auto_max_workers") or os.cpu_count() or 1
+    fetch_stats = StageStats("fetch")
+    decode_stats = StageStats("decode")
+    sam_stats = StageStats("sam")
+    upload_stats = StageStats("upload")
+    files_by_path = {}
+    features_by_path = {}
+    errors = []
+    # decoded and sam queues only hold (img_path, future / image), the fetch
+    # stage is blocked by decode_slots when queue_size images are being decoded
+    decode_slots = threading.BoundedSemaphore(queue_size)
+    decoded_queue = queue.Queue()
+    sam_queue = queue.Queue(maxsize=queue_size)
+    encode_slots = threading.BoundedSemaphore(queue_size)
+    stop = threading.Event()
+    pending_encodes = [0]
+    pending_lock = threading.Lock()
+    prefetcher = S3Prefetcher(max_workers=preprocess_options.get("fetch_workers", 3), storage=src_storage)
+    uploader = S3Uploader(max_workers=preprocess_options.get("upload_workers", 4), storage=storage)
+    decode_pool = None
+    if decode_workers > 0:
+        # spawn rather than fork, the parent has many threads (prefetcher, uploader, boto3)
+        decode_pool = ProcessPoolExecutor(max_workers=decode_workers, mp_context=multiprocessing.get_context("spawn"))
+    controller = None
+    if auto:
+        controller = WorkerController("preprocess decode", decode_workers, start_workers=max(1, decode_workers // 2),
+                                      memory_ceiling=get_memory_ceiling(preprocess_options.get("auto_memory_ceiling", "auto")),
+                                      s3_wait=lambda: prefetcher.wait_time, interval=preprocess_options.get("auto_interval", 15)).start()
+    encode_pool = ThreadPoolExecutor(max_workers=preprocess_options.get("encode_workers", 2))
+
+    def fetch():
+        s3_keys = [src_prefix + img_path for img_path in img_paths]
+        prefetcher.schedule(s3_keys[:queue_size])
+        try:
+            for i, img_path in enumerate(img_paths):
+                if i + queue_size < len(s3_keys):
+                    prefetcher.prefetch(s3_keys[i + queue_size])
+                start = time.monotonic()
+                while not decode_slots.acquire(timeout=1):
+                    if stop.is_set():
+                        return
+                fetch_stats.record_idle(time.monotonic() - start)
+                start = time.monotonic()
+                try:
+                    blob = prefetcher.get(s3_keys[i])
+                    if blob is None:
+                        raise FileNotFoundError(s3_keys[i])
+                    data = _blob_to_bytes(blob)
+                except Exception as e:
+                    fetch_stats.record(time.monotonic() - start, error=True)
+                    future = Future()
+                    future.set_exception(e)
+                    decoded_queue.put((img_path, future))
+                    continue
+                fetch_stats.record(time.monotonic() - start)
+                args = (data, folder_path, img_path, probes.get(img_path, {}), preprocess_options)
+                if controller is not None:
+                    controller.acquire()
+                    future = decode_pool.submit(decode_for_preprocess, *args)
+                    future.add_done_callback(lambda f: controller.release(1 if f.exception() is None else 0))
+                elif decode_pool is not None:
+                    future = decode_pool.submit(decode_for_preprocess, *args)
+                else:
+                    future = _run_inline(decode_for_preprocess, *args)
+                decode_stats.sample_depth(decoded_queue.qsize())
+                decoded_queue.put((img_path, future))
+        finally:
+            decoded_queue.put(None)
+
+    def encode_pickle(img_path, sam_res):
+        start = time.monotonic()
+        try:
+            features_by_path[img_path] = get_image_features(files_by_path[img_path], sam_res)
+        except Exception as e:
+            logging.error("error indexing the annotations of %s%s: %s", folder_path, img_path, e)
+        try:
+            save_sam_pickle(get_pickle_path(folder_path, img_path, preprocess_options.get("sam_format", "samz")), sam_res, uploader)
+            upload_stats.record(time.monotonic() - start)
+        except Exception as e:
+            logging.error("error saving the pickle of %s%s: %s", folder_path, img_path, e)
+            upload_stats.record(time.monotonic() - start, error=True)
+        finally:
+            with pending_lock:
+                pending_encodes[0] -= 1
+            encode_slots.release()
+
+    def sam():
+        while True:
+            start = time.monotonic()
+            item = sam_queue.get()
+            sam_stats.record_idle(time.monotonic() - start)
+            if item is None:
+                return
+            img_path, sam_img = item
+            start = time.monotonic()
+            try:
+                sam_res = run_sam(sam_img, preprocess_options)
+            except Exception as e:
+                logging.error("error running sam on %s%s: %s", folder_path, img_path, e)
+                sam_stats.record(time.monotonic() - start, error=True)
+                continue
+            sam_stats.record(time.monotonic() - start)
+            if not sam_res:
+                continue
+            # set before the upload, scam.json is only written once all uploads are done
+            files_by_path[img_path]["pickle_path"] = get_pickle_path(folder_path, img_path, preprocess_options.get("sam_format", "samz"))
+            encode_slots.acquire()
+            with pending_lock:
+                upload_stats.sample_depth(pending_encodes[0])
+                pending_encodes[0] += 1
+            encode_pool.submit(encode_pickle, img_path, sam_res)
+
+    def run_thread(fn):
+        def target():
+            try:
+                fn()
+            except Exception as e:
+                logging.exception("preprocess pipeline error")
+                errors.append(e)
+        thread = threading.Thread(target=target, daemon=True)
+        thread.start()
+        return thread
+
+    fetch_thread = run_thread(fetch)
+    sam_thread = run_thread(sam) if preprocess_options["run_sam"] else None
+    try:
+        with tqdm(total=len(img_paths)) as pbar:
+            # results of the decoding, in order
+            while True:
+                item = decoded_queue.get()
+                if item is None:
+                    break
+                img_path, future = item
+                pbar.update(1)
+                try:
+                    res = future.result()
+                except Exception as e:
+                    logging.error("error on %s%s: %s", folder_path, img_path, e)
+                    decode_stats.record(0, error=True)
+                    continue
+                finally:
+                    decode_slots.release()
+                decode_stats.record(res["decode_time"])
+                if res["thumbnail_bytes"] is not None:
+                    start = time.monotonic()
+                    upload(res["thumbnail_bytes"], res["thumbnail_path"], uploader)
+                    upload_stats.record(time.monotonic() - start)
+                files_by_path[img_path] = {
+                    "img_path": img_path,
+                    "pickle_path": None,
+                    "width": res["width"],
+                    "height": res["height"],
+                    "rotation": res["rotation"], # can be modified by users
+                    "thumbnail_path": res["thumbnail_path"],
+                    "thumbnail_info": {
+                        "width": res["thumbnail_w"],
+                        "height": res["thumbnail_h"],
+                        "rotation": 0
+                    }
+                }
+                if res["sam_img"] is not None and sam_thread is not None:
+                    sam_stats.sample_depth(sam_queue.qsize())
+                    sam_queue.put((img_path, res["sam_img"]))
+    except BaseException:
+        stop.set()
+        raise
+    finally:
+        if sam_thread is not None:
+            sam_queue.put(None)
+            sam_thread.join()
+        fetch_thread.join()
+        if controller is not None:
+            controller.stop()
+        encode_pool.shutdown(wait=True)
+        if decode_pool is not None:
+            decode_pool.shutdown(wait=True)
+        prefetcher.close()
+        # scam.json must only be written once thumbnails and pickles are uploaded
+        uploader.close()
+    if errors:
+        raise errors[0]
+    run_info["pipeline"] = {
+        "stages": pipeline_stats([fetch_stats, decode_stats, sam_stats, upload_stats]),
+        "queue_size": queue_size,
+        "decode_workers": decode_workers,
+        "prefetcher": prefetcher.stats(),
+        "uploader": uploader.stats(),
+    }
+    if controller is not None:
+        run_info["pipeline"]["worker_controller"] = controller.stats()
+    return files_by_path, uploader.failures(), features_by_path
+
+def preprocess_folder(folder_path, preprocess_options=DEFAULT_PREPROCESS_OPTIONS, src_storage=None, storage=None, src_url=None):
     """
     pre-processes a folder for use with the API
 
     - run SAM and save pickles
     - generates and writes thumbnails
     - writes scam.json in the directory
+
+    The images are read from src_storage and the results are written in storage,
+    both are storages or urls (see storage.get_storage) and default to S3.
+
+    src_url is the url of a directory containing the images (typically on an
+    archive mount, file:///mnt/...), they are then read from there directly
+    and postprocess will also read them from there.
     """
+    if src_url is not None:
+        src_storage = get_storage(src_url)
+        src_prefix = ""
+    else:
+        src_storage = get_storage(src_storage)
+        src_prefix = folder_path
+    storage = get_storage(storage)
     logging.info("preprocess %s" % folder_path)
-    img_paths = get_all_img_paths(folder_path)
+    disk_cache = get_disk_cache()
+    if disk_cache is not None:
+        disk_cache.reset_stats()
+    reset_s3_stats()
+    img_paths = get_all_img_paths(src_prefix, src_storage)
     logging.info("found %d images" % len(img_paths))
     scam_json = {
         "preprocess_run": {
@@ -97,72 +437,44 @@ def preprocess_folder(folder_path, preprocess_options=DEFAULT_PREPROCESS_OPTIONS
         "scam_runs": [],
         "files": []
     }
+    if preprocess_options["run_sam"]:
+        # the SAM annotations discarded before being stored, see filter_sam_annotations()
+        scam_json["preprocess_run"]["sam_filter"] = {
+            "min_area_ratio": preprocess_options.get("sam_min_area_ratio"),
+            "max_masks": preprocess_options.get("sam_max_masks"),
+            "nms_iou": preprocess_options.get("sam_nms_iou"),
+        }
+    if src_url is not None:
+        scam_json["source_url"] = src_url
     files = scam_json["files"]
-    prefetcher = S3Prefetcher(max_workers=3)
-    lookahead = 3
-    try:
-        s3_keys = [folder_path + img_path for img_path in img_paths]
-        for i in range(min(lookahead, len(s3_keys))):
-            prefetcher.prefetch(s3_keys[i])
-        for i, img_path in enumerate(tqdm(img_paths)):
-            if i + lookahead < len(s3_keys):
-                prefetcher.prefetch(s3_keys[i + lookahead])
-            # pil_img is not rotated
-            pil_img = None
-            sam_res = None
-            rotation = 0
-            orig_height = None
-            orig_width = None
-            thumbnail_path = None
-            thumbnail_w = None
-            thumbnail_h = None
-            try:
-                s3_key = folder_path + img_path
-                blob = prefetcher.get(s3_key)
-                orig_width, orig_height = get_image_size_from_blob(blob, img_path=img_path)
-                pil_img = decode_blob_to_pil(
-                    blob,
-                    max_dimension=preprocess_options["thumbnail_resize"],
-                    img_path=img_path,
-                )
-                thumbnail_path, thumbnail_w, thumbnail_h = save_thumbnail(folder_path, img_path, pil_img, preprocess_options)
-                if preprocess_options["use_exif_rotation"]:
-                    pil_img, rotation = apply_exif_rotation(pil_img)
-                # TODO: handle preprocess_options["pre_rotate]
-                #pil_img = sanitize_for_preprocessing(pil_img)
-                if preprocess_options["run_sam"]:
-                    sam_img = decode_blob_to_pil(
-                        blob,
-                        max_dimension=preprocess_options["sam_resize"],
-                        img_path=img_path,
-                    )
-                    if preprocess_options["use_exif_rotation"]:
-                        sam_img, _ = apply_exif_rotation(sam_img)
-                    sam_res = run_sam(sam_img, preprocess_options)
-            except Exception as e:
-                logging.error("error on %s/%s" % (folder_path, img_path), e)
-                continue
-            pickle_path = get_pickle_path(folder_path, img_path)
-            if sam_res:
-                save_sam_pickle(pickle_path, sam_res)
-            # thumbnail will get rotated
-            
-            files.append({
-                "img_path": img_path,
-                "pickle_path": pickle_path if sam_res else None,
-                "width": orig_width,
-                "height": orig_height,
-                "rotation": rotation, # can be modified by users
-                "thumbnail_path": thumbnail_path,
-                "thumbnail_info": {
-                    "width": thumbnail_w,
-                    "height": thumbnail_h,
-                    "rotation": 0
-                }
-            })
-    finally:
-        prefetcher.close()
-    save_scam_json(folder_path, scam_json)
+    # header-only probe (cached in scam_probe.json), avoids reading the size from the full blob
+    probes = {}
+    if preprocess_options.get("probe_headers", True):
+        try:
+            probes = probe_folder(folder_path, src_storage=src_storage, dst_storage=storage, src_prefix=src_prefix)
+        except Exception as e:
+            logging.warning("could not probe %s: %s", folder_path, e)
+    files_by_path, upload_failures, features_by_path = run_preprocess_pipeline(folder_path, img_paths, src_prefix, src_storage, storage, probes, preprocess_options, scam_json["preprocess_run"])
+    # the files are listed in the order of the images, whatever the order in which they were processed
+    for img_path in img_paths:
+        if img_path in files_by_path:
+            files.append(files_by_path[img_path])
+    if upload_failures:
+        logging.error("%d uploads failed for %s", len(upload_failures), folder_path)
+        scam_json["preprocess_run"]["upload_failures"] = upload_failures
+    if disk_cache is not None:
+        logging.info("disk cache stats for %s: %s", folder_path, str(disk_cache.stats()))
+    if features_by_path:
+        # the geometry of the annotations, so that scam can run without the pickles
+        ann_index = build_ann_index(files, features_by_path)
+        save_ann_index(folder_path, ann_index, storage)
+        scam_json["preprocess_run"]["ann_index"] = {
+            "path": folder_path + ANN_INDEX_NAME,
+            "images": len(ann_index["img_paths"]),
+            "annotations": len(ann_index["contour_area"]),
+        }
+    scam_json["preprocess_run"]["s3_stats"] = get_s3_stats()
+    save_scam_json(folder_path, scam_json, storage=storage)
 
 
 def preprocess_csv():
@@ -175,7 +487,13 @@ def preprocess_csv():
             folder = row[0]
             if not folder.endswith('/'):
                 folder += "/"
-            preprocess_folder(folder)
+            # optional second column: local directory of the sources (ex: on an archive mount)
+            src_url = None
+            if len(row) > 1 and row[1].strip():
+                src_url = row[1].strip()
+                if not src_url.endswith('/'):
+                    src_url += "/"
+            preprocess_folder(folder, src_url=src_url)
 
 if __name__ == '__main__':
     preprocess_csv()
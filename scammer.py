@@ -1,21 +1,21 @@
 from pathlib import Path
 
-from utils import split_s3_path, is_img, get_gzip_picked_bytes, list_img_keys, list_img_local
+from utils import split_s3_path, is_img, get_gzip_picked_bytes, list_img_local, get_s3_client, s3_call, reset_s3_stats, get_s3_stats, list_existing_keys
+from storage import S3Storage, LocalStorage
 from cal_sam_pickles import get_sam_output
-from img_utils import apply_exif_rotation, apply_icc, extract_img, encode_img_uncompressed, encode_img, get_debug_img_bytes
+from img_utils import apply_icc, extract_img, encode_img_uncompressed, encode_img, get_debug_img_bytes
 import os
-import boto3
 import io
-import gzip
-import pickle
 import botocore
 import tqdm
 from sam_annotation_utils import get_image_ann_list, find_anomalies
+from sam_masks import load_sam_annotations
 from PIL import Image
 import cv2
 import sys
 import csv
-from raw_opener import register_raw_opener
+from raw_utils import register_raw_opener, is_likely_raw
+from image_decode import decode_pyramid
 import statistics
 
 OUTPUT_QC = False
@@ -68,11 +68,16 @@ class BatchRunner:
         self.pre_rotate = pre_rotate
         self.rotate = rotate
         self.images_prefix = None
+        # {dirname: {key: etag}} of the S3 destination folders, listed once
+        self.existing_keys = {}
         self.analyze_read_path()
         self.analyze_write_path()
         if aws_profile is not None:
-            SESSION = boto3.Session(profile_name=aws_profile)
-            self.S3 = SESSION.client('s3')
+            self.S3 = get_s3_client(aws_profile)
+        else:
+            self.S3 = get_s3_client()
+        self.read_storage = S3Storage(self.read_bucket, self.S3) if self.read_mode == "S3" else LocalStorage()
+        self.write_storage = S3Storage(self.write_bucket, self.S3) if self.write_mode == "S3" else LocalStorage()
         self.img_mode = img_mode
         self.output_compressed = output_compressed
         self.output_uncompressed = output_uncompressed
@@ -107,22 +112,7 @@ class BatchRunner:
                 self.dest_path = self.dest_path[7:]
 
     def list_obj_keys(self, prefix):
-        obj_keys = []
-        continuation_token = None
-        while True:
-            if continuation_token:
-                response = self.S3.list_objects_v2(Bucket=self.read_bucket, Prefix=prefix,
-                                                   ContinuationToken=continuation_token)
-            else:
-                response = self.S3.list_objects_v2(Bucket=self.read_bucket, Prefix=prefix)
-            if 'Contents' in response and response['Contents']:
-                for obj in response['Contents']:
-                    obj_key = obj['Key']
-                    obj_keys.append(obj_key)
-            continuation_token = response.get("NextContinuationToken")
-            if not continuation_token:
-                break
-        return obj_keys
+        return [obj["Key"] for obj in self.read_storage.list(prefix)]
 
     def list_img_keys(self, prefix):
         obj_keys = self.list_obj_keys(prefix)
@@ -130,15 +120,7 @@ class BatchRunner:
         return filter(is_img, obj_keys)
 
     def gets3blob(self, s3Key: str) -> io.BytesIO:
-        try:
-            f = io.BytesIO()
-            self.S3.download_fileobj(self.read_bucket, s3Key, f)
-            return f
-        except botocore.exceptions.ClientError as e:
-            if e.response['Error']['Code'] == '404':
-                return None
-            else:
-                raise
+        return self.read_storage.get(s3Key)
 
     def get_files_bytes(self, blob_source: str) -> io.BytesIO:
         if not os.path.exists(blob_source):
@@ -146,16 +128,24 @@ class BatchRunner:
         with open(blob_source, "rb") as fh:
             return io.BytesIO(fh.read())
 
+    def storage_key(self, mode, dirname, fname):
+        if mode == "S3":
+            return dirname + fname
+        return str(Path(dirname, fname))
+
     def read_bytes(self, dirname, fname):
-        if self.read_mode == "S3":
-            return self.gets3blob(dirname+fname)
-        else:
-            return self.get_files_bytes(Path(dirname, fname))
+        return self.read_storage.get(self.storage_key(self.read_mode, dirname, fname))
+
+    def read_output_bytes(self, dirname, fname):
+        """
+        reads a file written by save_file (ex: a pickle)
+        """
+        return self.write_storage.get(self.storage_key(self.write_mode, dirname, fname))
 
 
     def s3key_exists(self, s3Key):
         try:
-            self.S3.head_object(Bucket=self.read_bucket, Key=s3Key)
+            s3_call(self.S3.head_object, Bucket=self.read_bucket, Key=s3Key)
             return True
         except botocore.exceptions.ClientError as e:
             if e.response['Error']['Code'] == '404':
@@ -165,7 +155,7 @@ class BatchRunner:
 
     def upload_to_s3(self, data, s3_key):
         if not self.dryrun:
-            self.S3.put_object(Bucket=self.write_bucket, Key=s3_key, Body=data)
+            s3_call(self.S3.put_object, Bucket=self.write_bucket, Key=s3_key, Body=data)
 
     def img_path_to_prefixed_path(self, img_path, prefix):
         other_dir = False
@@ -219,7 +209,7 @@ class BatchRunner:
     def list_img_paths(self, source_path):
         img_keys = []
         if self.read_mode == "S3":
-            for img_full_key in sorted(list_img_keys(self.images_path)):
+            for img_full_key in sorted(self.list_img_keys(self.images_path)):
                 # This is fragile,depending on how S3 or files interpret the trailing slash
                 # img_keys.append(img_full_key[len(self.images_path):])
                 img_keys.append(img_full_key[len(self.images_path):])
@@ -231,19 +221,28 @@ class BatchRunner:
     def save_file(self, dirname, fname, data):
         self.log_str += "   save %s\n" % (dirname + fname)
         if self.write_mode == "S3":
-            return self.upload_to_s3(data, dirname + fname)
-        if self.write_mode == "local":
-            with open(Path(dirname, fname), "wb") as outf:
-                outf.write(data)
+            if self.dryrun:
+                return
+            if dirname in self.existing_keys:
+                self.existing_keys[dirname][dirname + fname] = None
+        return self.write_storage.put(self.storage_key(self.write_mode, dirname, fname), data)
 
     def file_exists(self, dirname, fname):
         """
         Original didn't return a value to test
         """
         if self.write_mode == "S3":
-            return self.s3key_exists(dirname + fname)
-        if self.write_mode == "local":
-            return os.path.exists(Path(dirname, fname))
+            return dirname + fname in self.list_existing_keys(dirname)
+        return self.write_storage.exists(self.storage_key(self.write_mode, dirname, fname))
+
+    def list_existing_keys(self, dirname):
+        """
+        returns {key: etag} for the objects in dirname, listed once per folder
+        instead of a HEAD request per object
+        """
+        if dirname not in self.existing_keys:
+            self.existing_keys[dirname] = list_existing_keys(dirname, self.write_bucket, client=self.S3)
+        return self.existing_keys[dirname]
 
     def mkdir(self, dirname):
         if self.write_mode == "S3":
@@ -251,14 +250,14 @@ class BatchRunner:
         if self.write_mode == "local":
             os.makedirs(Path(dirname), exist_ok=True)
 
-    def get_save_sam(self, img_path, img_orig, points_per_side):
+    def get_save_sam(self, img_path, sam_img, points_per_side):
         pickle_dirname, pickle_fname = self.img_path_to_pickle_path(self.images_path + img_path, points_per_side)
         if self.skip_if_exists and self.file_exists(pickle_dirname, pickle_fname):
-            blob = self.read_bytes(pickle_dirname, pickle_fname)
+            blob = self.read_output_bytes(pickle_dirname, pickle_fname)
             blob.seek(0)
-            return pickle.loads(gzip.decompress(blob.read()))
+            return load_sam_annotations(blob.read())
         self.log_str += "   generate SAM results for %s , pps: %d\n" % (img_path, points_per_side)
-        sam_results = get_sam_output(img_orig, max_size=self.sam_resize, points_per_side=points_per_side)
+        sam_results = get_sam_output(sam_img, max_size=self.sam_resize, points_per_side=points_per_side)
         gzipped_pickled_bytes = get_gzip_picked_bytes(sam_results)
         self.mkdir(pickle_dirname)
         self.save_file(pickle_dirname, pickle_fname, gzipped_pickled_bytes)
@@ -275,7 +274,7 @@ class BatchRunner:
                                              debug_base_fname=os.path.basename(img_path),
                                              expected_nb_pages=self.expected_nb_pages,
                                              min_area_ratio=self.min_area_ratio,
-                                             expected_ratio_range=self.expected_ratio_range
+                                             expected_ratio_range=self.expected_ratio_range,
                                              direction=self.direction)
         if len(image_ann_infos) != self.expected_nb_pages:
             if not save_if_fail:
@@ -325,29 +324,31 @@ class BatchRunner:
     def get_sam_results(self, img_path, points_per_side):
         pickle_dirname, pickle_fname = self.img_path_to_pickle_path(self.images_path + img_path, points_per_side)
         self.log_str += "   getting SAM results from %s\n" % (pickle_dirname + pickle_fname)
-        blob = self.read_bytes(pickle_dirname, pickle_fname)
+        blob = self.read_output_bytes(pickle_dirname, pickle_fname)
         if blob is None:
             self.log_str += "  error! no %s" % (pickle_dirname + pickle_fname)
             return
         blob.seek(0)
-        return pickle.loads(gzip.decompress(blob.read()))
+        return load_sam_annotations(blob.read())
 
     def process_img_path(self, img_path, img_dir_info="", derived_img_to_stats = {}):
         self.log_str += " looking at %s\n" % img_path
         img_orig = None
-        if img_path.lower().endswith("cr2") or img_path.lower().endswith("nef"):
+        if is_likely_raw(img_path):
             register_raw_opener()
         try:
-            img_orig = Image.open(self.read_bytes(self.images_path, img_path))
+            # one decode for the original, used for cropping and as the SAM input: get_sam_output
+            # resizes it so that its short side is sam_resize, a level of the pyramid would be
+            # fitted on its long side and upscaled
+            pyramid = decode_pyramid(self.read_bytes(self.images_path, img_path), img_path=img_path,
+                                     sizes={}, keep_original=True)
         except KeyboardInterrupt:
             raise
         except:
             self.log_str += "   ERROR: PIL cannot open %s" % img_path
             #print("   PIL cannot open %s" % img_path)
             return
-        img_orig = apply_icc(img_orig)  # maybe icc shouldn't be applied to archive images?
-        if self.apply_exif_rotation:
-            img_orig = apply_exif_rotation(img_orig)
+        img_orig = apply_icc(pyramid.get("original", oriented=self.apply_exif_rotation))  # maybe icc shouldn't be applied to archive images?
         if self.pre_rotate:
             img_orig = img_orig.rotate(self.pre_rotate, expand=True)
         sam_results = None
@@ -394,11 +395,13 @@ class BatchRunner:
 
     def process_dir(self):
         self.log_str += "process dir %s" % self.images_path
+        reset_s3_stats()
         img_paths = self.list_img_paths(self.images_path)
         derived_img_to_stats = {}
         for i, img_path in enumerate(tqdm.tqdm(img_paths)):
             self.process_img_path(img_path, "%d/%d" % (i + 1, len(img_paths)), derived_img_to_stats = derived_img_to_stats)
         self.log_anomalies(derived_img_to_stats)
+        self.log_str += "S3 stats: %s\n" % get_s3_stats()
 
 
 def main():
@@ -0,0 +1,58 @@
+import time
+import threading
+
+
+class StageStats:
+    """
+    Latency and input queue depth of a stage of a pipeline. The latency is the
+    time spent processing an item, the idle time is the time the stage spent
+    waiting for its input (a saturated stage has a low idle time).
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._lock = threading.Lock()
+        self.count = 0
+        self.errors = 0
+        self.busy_time = 0.0
+        self.max_latency = 0.0
+        self.idle_time = 0.0
+        self.depth_samples = 0
+        self.depth_sum = 0
+        self.max_depth = 0
+        self.start = time.monotonic()
+
+    def record(self, latency, error=False):
+        with self._lock:
+            self.count += 1
+            self.errors += int(error)
+            self.busy_time += latency
+            self.max_latency = max(self.max_latency, latency)
+
+    def record_idle(self, duration):
+        with self._lock:
+            self.idle_time += duration
+
+    def sample_depth(self, depth):
+        with self._lock:
+            self.depth_samples += 1
+            self.depth_sum += depth
+            self.max_depth = max(self.max_depth, depth)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "count": self.count,
+                "errors": self.errors,
+                "busy_time": round(self.busy_time, 3),
+                "idle_time": round(self.idle_time, 3),
+                "mean_latency": round(self.busy_time / self.count, 4) if self.count else None,
+                "max_latency": round(self.max_latency, 4),
+                "mean_queue_depth": round(self.depth_sum / self.depth_samples, 2) if self.depth_samples else None,
+                "max_queue_depth": self.max_depth,
+                "wall_time": round(time.monotonic() - self.start, 3),
+            }
+
+
+def pipeline_stats(stages):
+    return {stage.name: stage.stats() for stage in stages}
@@ -0,0 +1,331 @@
+"""
+Storage backends: the pipelines read and write objects through one interface
+whether they live on S3, in a local (or NFS-mounted) directory, or in memory
+(for tests and throughput measurements without network).
+
+Keys are strings with "/" separators, as on S3. Objects are returned as
+file-like objects supporting seek() and the buffer protocol (BytesIO or a
+read-only mmap).
+"""
+import io
+import os
+import mmap
+import time
+import threading
+from hashlib import md5
+from concurrent.futures import ThreadPoolExecutor
+
+import botocore
+
+import utils
+from utils import BUCKET_NAME, download_blob, s3_call, list_objs, list_existing_keys
+
+
+class Storage:
+    """
+    Base class, the batched variants run the single-object methods on a thread pool
+    """
+
+    max_workers = 8
+
+    def get(self, key):
+        """
+        returns the object as a file-like object, or None if it doesn't exist
+        """
+        raise NotImplementedError
+
+    def get_range(self, key, start, end):
+        """
+        returns the bytes start to end (excluded) of the object, less at the end of the object,
+        raises an exception if the object doesn't exist
+        """
+        raise NotImplementedError
+
+    def put(self, key, data):
+        """
+        writes data (bytes or any buffer), returns a dict describing the write
+        """
+        raise NotImplementedError
+
+    def list(self, prefix):
+        """
+        returns the objects under prefix as a list of dicts with Key, Size, ETag
+        and LastModified (in seconds since epoch), sorted by key
+        """
+        raise NotImplementedError
+
+    def stat(self, key):
+        """
+        returns a dict with Size, ETag and LastModified, or None if the object doesn't exist
+        """
+        raise NotImplementedError
+
+    def exists(self, key):
+        return self.stat(key) is not None
+
+    def _map(self, fn, args_list):
+        args_list = list(args_list)
+        if len(args_list) <= 1:
+            return [fn(*args) for args in args_list]
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            return list(pool.map(lambda args: fn(*args), args_list))
+
+    def get_many(self, keys):
+        """
+        returns {key: object or None}
+        """
+        keys = list(keys)
+        return dict(zip(keys, self._map(self.get, [(k,) for k in keys])))
+
+    def get_range_many(self, ranges):
+        """
+        ranges is a list of (key, start, end), returns the list of the bytes
+        """
+        return self._map(self.get_range, ranges)
+
+    def put_many(self, items):
+        """
+        items is a dict or a list of (key, data)
+        """
+        if isinstance(items, dict):
+            items = items.items()
+        self._map(self.put, items)
+
+    def list_many(self, prefixes):
+        """
+        returns {prefix: objects}
+        """
+        prefixes = list(prefixes)
+        return dict(zip(prefixes, self._map(self.list, [(p,) for p in prefixes])))
+
+    def stat_many(self, keys):
+        """
+        returns {key: stat or None}
+        """
+        keys = list(keys)
+        return dict(zip(keys, self._map(self.stat, [(k,) for k in keys])))
+
+    def exists_many(self, keys):
+        """
+        returns the set of the keys that exist
+        """
+        return {k for k, st in self.stat_many(keys).items() if st is not None}
+
+
+class S3Storage(Storage):
+
+    max_workers = 16
+
+    def __init__(self, bucket=BUCKET_NAME, client=None):
+        self.bucket = bucket
+        self.client = client
+
+    def _client(self):
+        return self.client if self.client is not None else utils.S3
+
+    def get(self, key):
+        return download_blob(key, self.bucket, client=self.client)
+
+    def get_range(self, key, start, end):
+        def _get_range():
+            response = self._client().get_object(Bucket=self.bucket, Key=key, Range="bytes=%d-%d" % (start, end - 1))
+            return response['Body'].read()
+        try:
+            return s3_call(_get_range)
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] == 'InvalidRange':
+                return b""
+            raise
+
+    def put(self, key, data):
+        return s3_call(self._client().put_object, Bucket=self.bucket, Key=key, Body=data)
+
+    def list(self, prefix):
+        return list_objs(prefix, self.bucket, client=self.client)
+
+    def stat(self, key):
+        try:
+            response = s3_call(self._client().head_object, Bucket=self.bucket, Key=key)
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] in ['404', 'NoSuchKey']:
+                return None
+            raise
+        return {"Size": response["ContentLength"], "ETag": response["ETag"], "LastModified": int(response["LastModified"].timestamp())}
+
+    @staticmethod
+    def _dirnames(keys):
+        """
+        returns the folders to list for keys, without the folders of a folder that is
+        listed (the listings are recursive). The keys at the root of the bucket are not
+        in a folder, listing the whole bucket for them is not an option.
+        """
+        dirnames = []
+        for dirname in sorted({k[:k.rfind("/") + 1] for k in keys if "/" in k}):
+            # the folders under a folder come right after it in the sorted order
+            if not dirnames or not dirname.startswith(dirnames[-1]):
+                dirnames.append(dirname)
+        return dirnames
+
+    def stat_many(self, keys):
+        # one listing per folder instead of a HEAD request per object
+        keys = list(keys)
+        objs = {}
+        for dirname in self._dirnames(keys):
+            for obj in list_objs(dirname, self.bucket, use_manifest=False, client=self.client):
+                objs[obj["Key"]] = obj
+        res = {k: ({"Size": objs[k]["Size"], "ETag": objs[k]["ETag"], "LastModified": objs[k]["LastModified"]} if k in objs else None) for k in keys if "/" in k}
+        # a HEAD request for the keys at the root
+        res.update(super().stat_many([k for k in keys if "/" not in k]))
+        return res
+
+    def exists_many(self, keys):
+        keys = list(keys)
+        existing = {}
+        for dirname in self._dirnames(keys):
+            existing.update(list_existing_keys(dirname, self.bucket, client=self.client))
+        res = {k for k in keys if k in existing}
+        res.update(super().exists_many([k for k in keys if "/" not in k]))
+        return res
+
+
+def _local_etag(st):
+    return '"%d-%d"' % (st.st_mtime_ns, st.st_size)
+
+class LocalStorage(Storage):
+    """
+    Objects are the files under root (keys are paths relative to root, or paths
+    if root is empty). Objects are read through read-only mmaps so that large
+    files on local disks or NFS mounts are not copied in memory.
+    """
+
+    def __init__(self, root=""):
+        self.root = root
+
+    def _path(self, key):
+        return os.path.join(self.root, key) if self.root else key
+
+    def get(self, key):
+        try:
+            with open(self._path(key), "rb") as f:
+                if os.fstat(f.fileno()).st_size == 0:
+                    return io.BytesIO()
+                return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (FileNotFoundError, IsADirectoryError):
+            return None
+
+    def get_range(self, key, start, end):
+        with open(self._path(key), "rb") as f:
+            f.seek(start)
+            return f.read(end - start)
+
+    def put(self, key, data):
+        path = self._path(key)
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        tmp_path = "%s.%d.%d.tmp" % (path, os.getpid(), threading.get_ident())
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        return {"Key": key}
+
+    def list(self, prefix):
+        # the directory of the prefix is walked, the keys are then filtered on the full prefix
+        key_dir = prefix[:prefix.rfind("/") + 1]
+        base = self._path(key_dir) if key_dir else (self.root or ".")
+        res = []
+        for dirpath, _, filenames in os.walk(base):
+            rel_dir = os.path.relpath(dirpath, base)
+            rel_dir = "" if rel_dir == "." else rel_dir.replace(os.sep, "/") + "/"
+            for filename in filenames:
+                key = key_dir + rel_dir + filename
+                if not key.startswith(prefix) or filename.endswith(".tmp"):
+                    continue
+                try:
+                    st = os.stat(os.path.join(dirpath, filename))
+                except FileNotFoundError:
+                    continue
+                res.append({"Key": key, "Size": st.st_size, "ETag": _local_etag(st), "LastModified": int(st.st_mtime)})
+        res.sort(key=lambda obj: obj["Key"])
+        return res
+
+    def stat(self, key):
+        try:
+            st = os.stat(self._path(key))
+        except FileNotFoundError:
+            return None
+        return {"Size": st.st_size, "ETag": _local_etag(st), "LastModified": int(st.st_mtime)}
+
+
+class MemoryStorage(Storage):
+    """
+    Objects kept in a dict, for tests and for measuring the throughput of the pipelines
+    """
+
+    def __init__(self, objects=None):
+        self._lock = threading.Lock()
+        self._objects = {}
+        for key, data in (objects or {}).items():
+            self.put(key, data)
+
+    def get(self, key):
+        with self._lock:
+            obj = self._objects.get(key)
+        return io.BytesIO(obj[0]) if obj is not None else None
+
+    def get_range(self, key, start, end):
+        with self._lock:
+            obj = self._objects.get(key)
+        if obj is None:
+            raise FileNotFoundError(key)
+        return obj[0][start:end]
+
+    def put(self, key, data):
+        data = bytes(data)
+        with self._lock:
+            self._objects[key] = (data, '"%s"' % md5(data).hexdigest(), int(time.time()))
+        return {"Key": key}
+
+    def list(self, prefix):
+        with self._lock:
+            return [{"Key": k, "Size": len(d), "ETag": e, "LastModified": m}
+                    for k, (d, e, m) in sorted(self._objects.items()) if k.startswith(prefix)]
+
+    def stat(self, key):
+        with self._lock:
+            obj = self._objects.get(key)
+        if obj is None:
+            return None
+        return {"Size": len(obj[0]), "ETag": obj[1], "LastModified": obj[2]}
+
+
+_MEMORY_STORAGES = {}
+_STORAGES_LOCK = threading.Lock()
+# S3Storage by bucket, they only hold the name of the bucket and use the shared client
+_S3_STORAGES = {}
+
+def get_storage(url):
+    """
+    returns a storage from a url:
+    - s3://bucket/ (or "s3" for the default bucket)
+    - file:///path/to/root/ , a local path (or "local" for the current directory)
+    - mem://name , the same named in-memory storage is returned for the same name
+    """
+    if isinstance(url, Storage):
+        return url
+    if url is None or url == "s3" or url.startswith("s3://"):
+        bucket = BUCKET_NAME if url is None or url == "s3" else url[5:].split("/")[0]
+        with _STORAGES_LOCK:
+            if bucket not in _S3_STORAGES:
+                _S3_STORAGES[bucket] = S3Storage(bucket)
+            return _S3_STORAGES[bucket]
+    if url.startswith("mem://"):
+        with _STORAGES_LOCK:
+            if url not in _MEMORY_STORAGES:
+                _MEMORY_STORAGES[url] = MemoryStorage()
+            return _MEMORY_STORAGES[url]
+    if url == "local":
+        return LocalStorage("")
+    if url.startswith("file://"):
+        url = url[7:]
+    return LocalStorage(url)
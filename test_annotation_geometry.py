@@ -0,0 +1,80 @@
+"""Regression test: the geometry of AnnotationInfo must match the one of the mask resized to the original image."""
+import sys
+
+import cv2
+import numpy as np
+
+import sam_annotation_utils
+from sam_annotation_utils import AnnotationInfo
+
+sam_annotation_utils.DEBUG = False
+
+
+def _full_resolution_geometry(mask, width, height, rotation):
+    """
+    the geometry as computed before, on the mask rotated and resized to the original image
+    """
+    mask = (255*mask.astype(np.uint8)).astype('uint8')
+    if rotation == 90:
+        mask = cv2.rotate(mask, cv2.ROTATE_90_COUNTERCLOCKWISE)
+    elif rotation == 270:
+        mask = cv2.rotate(mask, cv2.ROTATE_90_CLOCKWISE)
+    elif rotation == 180:
+        mask = cv2.rotate(mask, cv2.ROTATE_180)
+    if rotation in (90, 270):
+        width, height = height, width
+    mask = cv2.resize(mask, (width, height), interpolation=cv2.INTER_NEAREST)
+    contours, _ = cv2.findContours(mask, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
+    areas = [cv2.contourArea(c) for c in contours]
+    contour = contours[np.argmax(areas)]
+    return max(areas), cv2.boundingRect(contour), cv2.minAreaRect(contour), mask.shape
+
+
+def _random_mask(rng, mask_w, mask_h, kind):
+    mask = np.zeros((mask_h, mask_w), np.uint8)
+    cx, cy = rng.uniform(0.2, 0.8) * mask_w, rng.uniform(0.2, 0.8) * mask_h
+    if kind == 0:
+        box = cv2.boxPoints(((cx, cy), (rng.uniform(50, mask_w*0.6), rng.uniform(50, mask_h*0.6)), rng.uniform(-20, 20)))
+        cv2.fillPoly(mask, [box.astype(np.int32)], 1)
+    elif kind == 1:
+        cv2.ellipse(mask, (int(cx), int(cy)), (int(rng.uniform(20, 300)), int(rng.uniform(20, 300))), rng.uniform(0, 180), 0, 360, 1, -1)
+    else:
+        points = np.stack([cx + rng.uniform(-200, 200, 12), cy + rng.uniform(-200, 200, 12)], 1).astype(np.int32)
+        cv2.fillPoly(mask, [cv2.convexHull(points)], 1)
+        # a few holes and notches
+        mask[int(cy):int(cy)+20, :] &= (rng.random(mask_w) > 0.02).astype(np.uint8)
+    return mask.astype(bool)
+
+
+def test_geometry():
+    rng = np.random.default_rng(0)
+    failures = 0
+    for i in range(40):
+        mask_w, mask_h = (1024, 683) if i % 2 else (768, 1024)
+        width = (6000 if mask_w > mask_h else 4000) + int(rng.integers(0, 50))
+        height = (4000 if mask_w > mask_h else 5333) + int(rng.integers(0, 50))
+        mask = _random_mask(rng, mask_w, mask_h, i % 3)
+        if i % 5 == 0:
+            # touches an edge
+            mask[:, :30] = True
+        rotation = [0, 90, 180, 270][i % 4]
+        area, bbox, rect, shape = _full_resolution_geometry(mask, width, height, rotation)
+        ann = AnnotationInfo({"segmentation": mask}, width, height, rotation)
+        (cx, cy), (w, h), angle = rect
+        if angle > 45:
+            angle, w, h = angle - 90, h, w
+        ok = (ann.bbox == bbox and (ann.img_h, ann.img_w) == shape
+              and abs(ann.contour_area - area) <= 1e-6 * area
+              and np.allclose(np.ravel(ann.minAreaRect[:2]), [cx, cy, w, h], atol=1e-3)
+              and abs(ann.minAreaRect[2] - angle) < 1e-3)
+        if not ok:
+            failures += 1
+            print("FAIL", i, "rotation", rotation, ann.bbox, bbox, ann.contour_area, area, ann.minAreaRect, rect)
+    if failures:
+        print(f"{failures} failures")
+    assert failures == 0
+    print("all annotation geometry tests passed")
+
+
+if __name__ == "__main__":
+    sys.exit(test_geometry())
@@ -0,0 +1,95 @@
+"""Regression test: vectorized white patch statistics must match the per-pixel / two-demosaic versions."""
+import io
+import statistics
+
+import numpy as np
+import rawpy
+from PIL import Image, TiffImagePlugin
+
+import color_card
+from raw_utils import get_median_cam_rgb2, get_wb_factors_from_median_cam_rgb, get_exposure_factor, get_visible_cam_rgb, cam_rgb_to_nrgb
+
+BBOXES = [(100, 200, 300, 200), (1401, 903, 321, 157), (0, 0, 64, 64)]
+
+
+def _rational(values):
+    return tuple(TiffImagePlugin.IFDRational(int(v * 10000), 10000) for v in values)
+
+
+def _make_dng(width=1800, height=1200):
+    """
+    minimal DNG with an RGGB bayer pattern and gradients in each channel
+    """
+    rng = np.random.default_rng(0)
+    y, x = np.mgrid[0:height, 0:width]
+    cfa = (x / width * 2500 + y / height * 500 + 300 + rng.normal(0, 20, (height, width))).astype(np.uint16)
+    cfa[0::2, 1::2] = (cfa[0::2, 1::2] * 0.8).astype(np.uint16)
+    cfa[1::2, 0::2] = (cfa[1::2, 0::2] * 0.8).astype(np.uint16)
+    cfa[1::2, 1::2] = (cfa[1::2, 1::2] * 0.6).astype(np.uint16)
+    ifd = TiffImagePlugin.ImageFileDirectory_v2()
+    for tag, tagtype, value in [
+        (262, 3, 32803),  # PhotometricInterpretation: CFA
+        (33421, 3, (2, 2)),  # CFARepeatPatternDim
+        (33422, 1, b"\x00\x01\x01\x02"),  # CFAPattern
+        (50706, 1, b"\x01\x04\x00\x00"),  # DNGVersion
+        (50708, 2, "Test camera"),
+        (50717, 3, 4095),  # WhiteLevel
+        (50721, 10, _rational([0.9, -0.2, -0.1, -0.3, 1.2, 0.1, 0.0, 0.1, 0.8])),  # ColorMatrix1
+        (50778, 3, 21),  # CalibrationIlluminant1: D65
+        (50728, 5, _rational([0.5, 1.0, 0.6])),  # AsShotNeutral
+    ]:
+        ifd.tagtype[tag] = tagtype
+        ifd[tag] = value
+    output = io.BytesIO()
+    Image.frombuffer("I;16", (width, height), cfa.tobytes(), "raw", "I;16", 0, 1).save(output, format="TIFF", tiffinfo=ifd)
+    return output.getvalue()
+
+
+def _median_cam_nrgb_per_pixel(raw, bbox):
+    # the original per-pixel implementation
+    x_0, y_0, w, h = bbox
+    vals_per_c = [[], [], [], []]
+    for x in range(x_0, x_0+w):
+        for y in range(y_0, y_0+h):
+            vals_per_c[raw.raw_color(y, x)].append(get_visible_cam_rgb(raw, x, y))
+    return [cam_rgb_to_nrgb(raw, statistics.median(vs), c) for c, vs in enumerate(vals_per_c)]
+
+
+def test_median_cam_nrgb():
+    raw = rawpy.imread(io.BytesIO(_make_dng()))
+    for bbox in BBOXES:
+        assert np.allclose(color_card.get_median_cam_nrgb(raw, bbox), _median_cam_nrgb_per_pixel(raw, bbox))
+
+
+def test_factors_from_raw():
+    dng = _make_dng()
+    for bbox in BBOXES:
+        raw = rawpy.imread(io.BytesIO(dng))
+        # the original version, with two full demosaicings on 8-bit values
+        medians_ref = get_median_cam_rgb2(raw, bbox)
+        wb_ref = get_wb_factors_from_median_cam_rgb(medians_ref)
+        exp_ref = get_exposure_factor(raw, wb_ref, bbox)
+        raw = rawpy.imread(io.BytesIO(dng))
+        linear = color_card.demosaic_linear(raw)
+        linear_patch = linear[bbox[1]:bbox[1]+bbox[3], bbox[0]:bbox[0]+bbox[2]]
+        # the medians are the same up to the 8-bit quantization of the original version
+        assert np.allclose(color_card.get_median_cam_rgb(linear_patch), medians_ref, atol=1.0)
+        assert np.isclose(color_card.get_exposure_factor(raw, linear_patch, wb_ref), exp_ref, rtol=0.01)
+        wb, exp_shift = color_card.get_factors_from_raw(raw, bbox, linear=linear)
+        assert np.allclose(wb, get_wb_factors_from_median_cam_rgb(color_card.get_median_cam_rgb(linear_patch)))
+        assert np.isclose(exp_shift, color_card.get_exposure_factor(raw, linear_patch, wb))
+
+
+def test_factors_from_cfa():
+    dng = _make_dng()
+    for bbox in BBOXES:
+        raw = rawpy.imread(io.BytesIO(dng))
+        wb_ref = get_wb_factors_from_median_cam_rgb(get_median_cam_rgb2(raw, bbox))
+        exp_ref = get_exposure_factor(raw, wb_ref, bbox)
+        wb_linear, _ = color_card.get_factors_from_raw(raw, bbox)
+        wb, exp_shift = color_card.get_factors_from_cfa(raw, bbox)
+        # no demosaicing: the medians of the bayer channels instead of the ones of the 16-bit image
+        assert np.allclose(wb, wb_linear, rtol=0.01), (wb, wb_linear)
+        assert np.allclose(wb, wb_ref, rtol=0.05), (wb, wb_ref)
+        # the same exposure as the full size postprocessing of the original version
+        assert np.isclose(exp_shift, exp_ref, rtol=0.01), (exp_shift, exp_ref)
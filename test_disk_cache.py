@@ -0,0 +1,39 @@
+"""Size accounting of DiskCache when objects are written again."""
+import os
+import sys
+import tempfile
+
+from disk_cache import DiskCache
+
+
+def _files_size(cache_dir):
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(cache_dir) for name in names)
+
+
+def test_size():
+    with tempfile.TemporaryDirectory() as cache_dir:
+        cache = DiskCache(cache_dir, max_bytes=10000, min_size=10)
+        cache.put("bucket", "a", '"e1"', b"x" * 1000)
+        # the same version written again, as by two concurrent misses
+        cache.put("bucket", "a", '"e1"', b"x" * 1000)
+        assert cache.stats()["size"] == 1000
+        # a new version replaces the previous one
+        cache.put("bucket", "a", '"e2"', b"y" * 1500)
+        assert cache.stats()["size"] == 1500 == _files_size(cache_dir)
+        assert cache.get_etag("bucket", "a") == '"e2"'
+        # rewriting doesn't trigger an early eviction
+        cache.put("bucket", "b", '"e1"', b"z" * 4000)
+        for _ in range(5):
+            cache.put("bucket", "b", '"e1"', b"z" * 4000)
+        stats = cache.stats()
+        assert stats["evictions"] == 0 and stats["size"] == 5500 == _files_size(cache_dir), stats
+        mm = cache.open("bucket", "b", '"e1"')
+        assert mm[:] == b"z" * 4000
+        mm.close()
+        # a reopened cache finds the same size
+        assert DiskCache(cache_dir, max_bytes=10000, min_size=10).stats()["size"] == 5500
+    print("all disk cache tests passed")
+
+
+if __name__ == "__main__":
+    sys.exit(test_size())
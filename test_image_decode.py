@@ -0,0 +1,48 @@
+"""16-bit TIFF sources are reduced to 8 bits (their high byte) before the postprocessing."""
+import io
+import sys
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from scam_postprocess import DEFAULT_POSTPROCESS_OPTIONS, get_postprocess_pil_img
+
+
+class _Source:
+    """
+    a prefetcher of one file
+    """
+
+    def __init__(self, data):
+        self.data = data
+
+    def get(self, key):
+        return io.BytesIO(self.data)
+
+
+def _postprocess(data):
+    options = dict(DEFAULT_POSTPROCESS_OPTIONS)
+    pil_img, _, _ = get_postprocess_pil_img("f/", "img.tif", None, options, {}, prefetcher=_Source(data))
+    return pil_img
+
+
+def test_16bit_tiff():
+    rng = np.random.default_rng(0)
+    rgb = rng.integers(0, 65536, (40, 60, 3), dtype=np.uint16)
+    data = cv2.imencode(".tiff", rgb[..., ::-1])[1].tobytes()
+    pil_img = _postprocess(data)
+    assert pil_img.mode == "RGB"
+    assert np.array_equal(np.array(pil_img), (rgb >> 8).astype(np.uint8))
+    # as Pillow decodes them
+    assert np.array_equal(np.array(pil_img), np.array(Image.open(io.BytesIO(data))))
+    gray = rgb[..., 0]
+    pil_img = _postprocess(cv2.imencode(".tiff", gray)[1].tobytes())
+    assert pil_img.mode == "L"
+    assert np.array_equal(np.array(pil_img), (gray >> 8).astype(np.uint8))
+
+
+if __name__ == "__main__":
+    test_16bit_tiff()
+    print("all image decode tests passed")
+    sys.exit(0)
@@ -0,0 +1,97 @@
+"""Admission of jobs by MemoryBudget: in order, within the budget, oversize jobs alone."""
+import sys
+import threading
+import time
+
+from memory_budget import MemoryBudget
+
+
+def _acquire_async(budget, size, admitted):
+    thread = threading.Thread(target=lambda: (budget.acquire(size), admitted.append(size)))
+    thread.start()
+    return thread
+
+
+def _wait_until(cond, timeout=5):
+    end = time.monotonic() + timeout
+    while not cond() and time.monotonic() < end:
+        time.sleep(0.01)
+    return cond()
+
+
+def test_admission():
+    budget = MemoryBudget(100)
+    budget.acquire(60)
+    budget.acquire(40)
+    admitted = []
+    thread = _acquire_async(budget, 30, admitted)
+    time.sleep(0.1)
+    # the budget is full
+    assert admitted == []
+    budget.release(40)
+    assert _wait_until(lambda: admitted == [30])
+    thread.join()
+    stats = budget.stats()
+    assert stats["admitted"] == 3 and stats["waits"] == 1, stats
+    assert stats["peak_bytes"] == 100 and stats["wait_time"] >= 0.1, stats
+    assert budget._in_use == 90 and budget._running == 2
+
+
+def test_order():
+    budget = MemoryBudget(100)
+    budget.acquire(80)
+    admitted = []
+    # the large job waits, the small one that would fit waits behind it
+    threads = [_acquire_async(budget, 50, admitted)]
+    assert _wait_until(lambda: budget._next_ticket == 2)
+    threads.append(_acquire_async(budget, 10, admitted))
+    time.sleep(0.1)
+    assert admitted == []
+    budget.release(80)
+    assert _wait_until(lambda: len(admitted) == 2)
+    assert admitted == [50, 10]
+    for thread in threads:
+        thread.join()
+
+
+def test_oversize():
+    budget = MemoryBudget(100)
+    # admitted alone
+    assert budget.acquire(500) == 0 or budget.stats()["waits"] == 0
+    admitted = []
+    thread = _acquire_async(budget, 10, admitted)
+    time.sleep(0.1)
+    assert admitted == []
+    budget.release(500)
+    assert _wait_until(lambda: admitted == [10])
+    thread.join()
+    # waits for the running jobs to be done
+    thread = _acquire_async(budget, 500, admitted)
+    time.sleep(0.1)
+    assert admitted == [10]
+    budget.release(10)
+    assert _wait_until(lambda: admitted == [10, 500])
+    thread.join()
+    budget.release(500)
+    assert budget._in_use == 0 and budget._running == 0
+    assert budget.stats()["peak_bytes"] == 500
+
+
+def test_unlimited():
+    budget = MemoryBudget(None)
+    for _ in range(10):
+        budget.acquire(1 << 40)
+    stats = budget.stats()
+    assert stats["admitted"] == 10 and stats["waits"] == 0 and stats["peak_bytes"] == 10 << 40, stats
+    for _ in range(10):
+        budget.release(1 << 40)
+    assert budget._in_use == 0 and budget.stats()["peak_rss"] > 0
+
+
+if __name__ == "__main__":
+    test_admission()
+    test_order()
+    test_oversize()
+    test_unlimited()
+    print("all memory budget tests passed")
+    sys.exit(0)
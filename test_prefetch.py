@@ -0,0 +1,169 @@
+"""Budget of S3Prefetcher: keys that are never read must not block the admission of the others."""
+import sys
+import time
+
+import pytest
+
+import scam_postprocess
+from scam_postprocess import DEFAULT_POSTPROCESS_OPTIONS, FolderJob, get_output_pages, prepare_folder
+from storage import MemoryStorage, get_storage
+from utils import S3Prefetcher, save_scam_json
+
+
+def test_release():
+    storage = MemoryStorage({"k%d" % i: b"x" * 10 for i in range(10)})
+    prefetcher = S3Prefetcher(max_objects=3, storage=storage)
+    keys = ["k%d" % i for i in range(10)]
+    prefetcher.schedule(keys)
+    # the first 3 are never read
+    prefetcher.release(keys[:3])
+    for key in keys[3:]:
+        assert prefetcher.get(key).read() == b"x" * 10
+    prefetcher.close()
+    stats = prefetcher.stats()
+    assert stats["misses"] == 0, stats
+    assert stats["released"] == 3, stats
+    assert stats["peak_inflight_objects"] <= 3, stats
+
+
+class _SlowStorage(MemoryStorage):
+
+    def get(self, key):
+        time.sleep(0.05)
+        return super().get(key)
+
+
+def test_miss_time():
+    # a key that is not admitted is downloaded by get(), the workers wait for S3 all the same
+    prefetcher = S3Prefetcher(max_objects=1, storage=_SlowStorage({"k0": b"x", "k1": b"y"}))
+    prefetcher.schedule(["k0"])
+    assert prefetcher.get("k1").read() == b"y"
+    prefetcher.release(["k0"])
+    prefetcher.close()
+    stats = prefetcher.stats()
+    assert stats["misses"] == 1, stats
+    assert stats["miss_time"] >= 0.05 and stats["wait_time"] >= stats["miss_time"], stats
+
+
+def _folder(name, nb_files=30, hidden=(), sizes=None, color_cards=()):
+    """
+    a folder of nb_files in memory storages, returns its postprocess options
+    """
+    storage = get_storage("mem://%s" % name)
+    files = []
+    for i in range(nb_files):
+        img_path = "img_%02d.jpg" % i
+        width, height = (sizes or {}).get(i, (400, 300))
+        storage.put("%s/%s" % (name, img_path), b"x" * 100)
+        file_info = {"img_path": img_path, "width": width, "height": height, "rotation": 0, "pages": []}
+        if i in hidden:
+            file_info["hidden"] = True
+        if i in color_cards:
+            # a card next to the page
+            file_info["pages"] = [{"minAreaRect": [width/4, height/2, width/2, height, 0]},
+                                  {"minAreaRect": [width*7/8, height/2, width/8, height/8, 0], "tags": ["T1"]}]
+        files.append(file_info)
+    save_scam_json("%s/" % name, {"folder_path": "%s/" % name, "checked": True, "files": files}, storage=storage)
+    options = dict(DEFAULT_POSTPROCESS_OPTIONS)
+    options.update({"src_storage": "mem://%s" % name, "json_storage": "mem://%s" % name, "dst_storage": "mem://%s_out" % name,
+                    "rgb_correction": "default", "add_prefix": False})
+    return options
+
+
+def _consume(job):
+    """
+    reads the sources of the tasks in order, as derive_task does
+    """
+    for file_info, _, _ in job.tasks:
+        key = job.src_prefix + file_info["img_path"]
+        if get_output_pages(file_info) is not None:
+            job.source.get(key)
+        job.source.release([key])
+
+
+def test_hidden_files():
+    options = _folder("hidden", hidden=(1, 4, 8, 9, 15, 22, 29))
+    prefetcher = S3Prefetcher(max_objects=6)
+    job = prepare_folder(FolderJob("hidden/", options), prefetcher, None)
+    _consume(job)
+    job.close()
+    prefetcher.close()
+    stats = prefetcher.stats()
+    assert stats["misses"] == 0, stats
+    assert stats["hits"] + stats["waits"] == 23, stats
+
+
+def test_largest_first():
+    # the largest files are last in the folder, they are derived (and must be prefetched) first
+    options = _folder("largest", sizes={i: (400 + 100 * i, 300 + 100 * i) for i in range(30)}, hidden=(3, 27))
+    prefetcher = S3Prefetcher(max_objects=6)
+    job = prepare_folder(FolderJob("largest/", options), prefetcher, None)
+    derived = [file_info["img_path"] for file_info, _, _ in job.tasks if not file_info.get("hidden")]
+    assert derived == ["img_%02d.jpg" % i for i in reversed(range(30)) if i not in (3, 27)]
+    _consume(job)
+    job.close()
+    prefetcher.close()
+    stats = prefetcher.stats()
+    assert stats["misses"] == 0, stats
+    assert stats["hits"] + stats["waits"] == 28, stats
+
+
+def test_color_cards(monkeypatch):
+    # the color cards are read for the corrections, then derived
+    options = _folder("cards", color_cards=(2, 10, 25), sizes={25: (4000, 3000)})
+    options["rgb_correction"] = "auto"
+
+    def corrections(scam_json, postprocess_options, prefetcher=None, raw_contexts=None):
+        for img_path in ("img_02.jpg", "img_10.jpg", "img_25.jpg"):
+            prefetcher.get("cards/" + img_path)
+        return {}
+
+    monkeypatch.setattr(scam_postprocess, "get_white_patch_corrections", corrections)
+    prefetcher = S3Prefetcher(max_objects=6)
+    job = prepare_folder(FolderJob("cards/", options), prefetcher, None)
+    _consume(job)
+    job.close()
+    prefetcher.close()
+    stats = prefetcher.stats()
+    assert stats["misses"] == 0, stats
+    assert stats["hits"] + stats["waits"] == 33, stats
+
+
+def test_unread_folder():
+    # a folder that fails (or is done) before its files are read releases them on close
+    options = _folder("unread", nb_files=10)
+    prefetcher = S3Prefetcher(max_objects=4)
+    job = prepare_folder(FolderJob("unread/", options), prefetcher, None)
+    job.source.get(job.src_prefix + "img_00.jpg")
+    job.close()
+    stats = prefetcher.stats()
+    # the admitted downloads are cancelled, the pending ones unscheduled
+    assert stats["released"] == 4, stats
+    assert not prefetcher._futures and not prefetcher._pending and prefetcher._inflight_bytes == 0
+
+
+def test_prepare_error(monkeypatch):
+    # the color cards are scheduled for the corrections
+    options = _folder("failing", nb_files=10, color_cards=(1, 4, 7))
+    options["rgb_correction"] = "auto"
+
+    def fail(*args, **kwargs):
+        raise ValueError("no white patch")
+
+    monkeypatch.setattr(scam_postprocess, "get_white_patch_corrections", fail)
+    prefetcher = S3Prefetcher(max_objects=4)
+    with pytest.raises(ValueError):
+        prepare_folder(FolderJob("failing/", options), prefetcher, None)
+    stats = prefetcher.stats()
+    assert stats["released"] == 3, stats
+    assert not prefetcher._futures and not prefetcher._pending and prefetcher._inflight_bytes == 0
+
+
+if __name__ == "__main__":
+    test_release()
+    test_miss_time()
+    test_hidden_files()
+    test_largest_first()
+    test_unread_folder()
+    print("all prefetch tests passed")
+    sys.exit(0)
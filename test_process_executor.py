@@ -0,0 +1,55 @@
+"""Shared memory of the process executor: the source is read in place, the outputs of a failed file are unlinked."""
+import mmap
+import sys
+from multiprocessing import shared_memory
+
+import pytest
+
+import scam_postprocess
+from scam_postprocess import _SharedMemorySource, _derive_file_in_process, _to_shared_memory
+
+
+def _exists(name):
+    try:
+        shared_memory.SharedMemory(name=name).close()
+        return True
+    except FileNotFoundError:
+        return False
+
+
+def test_source():
+    shm = _to_shared_memory(b"source bytes")
+    try:
+        source = _SharedMemorySource(shm.name, 12)
+        blob = source.get("key")
+        # the mapping of the block, not a copy
+        assert isinstance(blob, mmap.mmap)
+        assert blob.read() == b"source bytes"
+        blob = None
+        source.close()
+    finally:
+        shm.close()
+        shm.unlink()
+    assert _SharedMemorySource(None, 0).get("key") is None
+
+
+def test_failed_outputs(monkeypatch):
+    names = []
+
+    def derive(scam_json, scam_log_json, file_info, postprocess_options, prefixes, correction, prefetcher=None, uploader=None):
+        uploader.upload(b"page 1", "out/1.tif")
+        uploader.upload(b"page 2", "out/2.tif")
+        names.extend(name for _, name, _ in uploader.outputs)
+        raise MemoryError("page 3")
+
+    monkeypatch.setattr(scam_postprocess, "derive_from_file", derive)
+    with pytest.raises(MemoryError):
+        _derive_file_in_process({"folder_path": "f/"}, {"img_path": "a.tif"}, {}, None, None, None, 0)
+    assert len(names) == 2
+    assert not any(_exists(name) for name in names)
+
+
+if __name__ == "__main__":
+    test_source()
+    print("all process executor tests passed")
+    sys.exit(0)
@@ -0,0 +1,50 @@
+"""A RawContext gives the corrections and the output of a raw file from one read, the output as get_np_from_raw."""
+import io
+import sys
+
+import numpy as np
+
+import color_card
+from raw_context import RawContext, RawContextCache
+from raw_utils import get_np_from_raw
+from test_color_card import BBOXES, _make_dng
+
+
+def test_render():
+    dng = _make_dng()
+    context = RawContext(io.BytesIO(dng))
+    wb_factors, exp_shift = context.get_factors(BBOXES[0])
+    assert (wb_factors, exp_shift) == color_card.get_factors_from_cfa(RawContext(io.BytesIO(dng)).raw, BBOXES[0])
+    params = (wb_factors, exp_shift, context.exif)
+    # the output is the one of the threads, bit for bit
+    assert np.array_equal(context.render(params), get_np_from_raw(io.BytesIO(dng), params, False))
+    context.close()
+
+
+class _Context:
+
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+def test_cache():
+    cache = RawContextCache(max_items=2)
+    contexts = [_Context() for _ in range(3)]
+    assert cache.put("a", contexts[0]) and cache.put("b", contexts[1])
+    # full, the next ones are not kept
+    assert not cache.put("c", contexts[2]) and contexts[2].closed
+    assert "a" in cache and "c" not in cache
+    assert cache.pop("a") is contexts[0] and "a" not in cache
+    assert not contexts[0].closed
+    cache.close()
+    assert contexts[1].closed
+
+
+if __name__ == "__main__":
+    test_render()
+    test_cache()
+    print("all raw context tests passed")
+    sys.exit(0)
@@ -0,0 +1,132 @@
+"""Classification, backoff and concurrency adaptation of the S3 retry policy."""
+import sys
+
+import boto3
+import botocore.exceptions
+import pytest
+
+from s3_retry import AIMDLimiter, RetryPolicy, is_retryable_error, is_throttling_error
+
+
+def _client_error(code):
+    return botocore.exceptions.ClientError({"Error": {"Code": code, "Message": code}}, "GetObject")
+
+
+class _Flaky:
+    """
+    raises the given errors in order, then returns "ok"
+    """
+
+    def __init__(self, errors):
+        self.errors = list(errors)
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return "ok"
+
+
+def test_classification():
+    for code in ("SlowDown", "503", "Throttling", "RequestLimitExceeded", "TooManyRequests"):
+        assert is_throttling_error(_client_error(code)) and is_retryable_error(_client_error(code)), code
+    for code in ("500", "InternalError", "RequestTimeout"):
+        assert not is_throttling_error(_client_error(code)) and is_retryable_error(_client_error(code)), code
+    for code in ("404", "NoSuchKey", "403", "AccessDenied", "InvalidRange"):
+        assert not is_retryable_error(_client_error(code)), code
+    assert is_retryable_error(botocore.exceptions.ConnectTimeoutError(endpoint_url="https://s3"))
+    assert is_retryable_error(ConnectionResetError())
+    assert not is_retryable_error(ValueError())
+
+
+def test_backoff():
+    policy = RetryPolicy(base_backoff=0.2, max_backoff=1.0)
+    for attempt in range(1, 10):
+        for _ in range(50):
+            assert 0 <= policy.backoff(attempt) <= min(1.0, 0.2 * 2 ** attempt)
+
+
+def test_retries():
+    limiter = AIMDLimiter(16, cooldown=0)
+    policy = RetryPolicy(base_backoff=0, limiter=limiter)
+    fn = _Flaky([_client_error("SlowDown"), _client_error("500"), _client_error("503")])
+    assert policy.call(fn) == "ok" and fn.calls == 4
+    stats = policy.stats.stats()
+    assert (stats["requests"], stats["retries"], stats["throttles"], stats["failures"]) == (4, 3, 2, 0), stats
+    # halved on each throttle, not on the internal error
+    assert limiter.limit == 4 and stats["min_concurrency"] == 4
+    # the limiter is released after each attempt
+    assert limiter._inflight == 0
+
+
+def test_no_retry():
+    policy = RetryPolicy(base_backoff=0, limiter=AIMDLimiter(4))
+    fn = _Flaky([_client_error("NoSuchKey")])
+    with pytest.raises(botocore.exceptions.ClientError) as e:
+        policy.call(fn)
+    assert fn.calls == 1 and e.value.attempts == 1
+    stats = policy.stats.stats()
+    assert (stats["requests"], stats["retries"], stats["failures"]) == (1, 0, 0), stats
+    assert policy.limiter.limit == 4 and policy.limiter._inflight == 0
+
+
+def test_max_attempts():
+    policy = RetryPolicy(max_attempts=3, base_backoff=0)
+    fn = _Flaky([_client_error("SlowDown")] * 5)
+    with pytest.raises(botocore.exceptions.ClientError) as e:
+        policy.call(fn)
+    assert fn.calls == 3 and e.value.attempts == 3
+    stats = policy.stats.stats()
+    assert (stats["requests"], stats["retries"], stats["throttles"], stats["failures"]) == (3, 2, 3, 1), stats
+
+
+def test_aimd():
+    limiter = AIMDLimiter(8, min_limit=2, cooldown=60)
+    limiter.on_throttle()
+    assert limiter.limit == 4
+    # many requests fail at the same time, the limit is halved once per cooldown
+    limiter.on_throttle()
+    assert limiter.limit == 4
+    limiter._last_decrease -= 60
+    limiter.on_throttle()
+    limiter._last_decrease -= 60
+    limiter.on_throttle()
+    assert limiter.limit == 2
+    # grows by one after limit successes, up to max_limit
+    limiter.on_success()
+    assert limiter.limit == 2
+    limiter.on_success()
+    assert limiter.limit == 3
+    for _ in range(100):
+        limiter.on_success()
+    assert limiter.limit == 8
+    limiter.set_max_limit(5)
+    assert limiter.limit == 5
+
+
+def test_set_s3_concurrency():
+    if "image_processing" not in boto3.Session().available_profiles:
+        pytest.skip("utils needs the image_processing AWS profile")
+    import utils
+    client = utils.S3
+    utils.set_s3_concurrency(1)
+    # already large enough, the clients are kept
+    assert utils.S3 is client
+    pool_size = utils.S3_MAX_POOL_CONNECTIONS + 10
+    utils.set_s3_concurrency(pool_size - utils.TRANSFER_CONFIG.max_request_concurrency)
+    # the shared client is recreated with the larger pool, for all the code reading utils.S3
+    assert utils.S3 is not client and utils.S3 is utils.get_s3_client()
+    assert utils.S3.meta.config.max_pool_connections == pool_size
+    assert utils.S3_LIMITER.max_limit == pool_size
+
+
+if __name__ == "__main__":
+    test_classification()
+    test_backoff()
+    test_retries()
+    test_no_retry()
+    test_max_attempts()
+    test_aimd()
+    print("all S3 retry tests passed")
+    sys.exit(0)
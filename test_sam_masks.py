@@ -0,0 +1,64 @@
+"""Round trip of the SAM annotations through the container of sam_masks.py."""
+import gzip
+import pickle
+import sys
+
+import cv2
+import numpy as np
+
+import sam_masks
+from sam_masks import SamMasks, encode_sam_masks, load_sam_annotations
+
+
+def _sam_annotations(rng, mask_w=1024, mask_h=683):
+    """
+    annotations shaped like the output of SamAutomaticMaskGenerator.generate()
+    """
+    anns = []
+    for i in range(20):
+        mask = np.zeros((mask_h, mask_w), np.uint8)
+        if i == 0:
+            # empty mask
+            pass
+        elif i == 1:
+            mask[:] = 1
+        elif i % 2:
+            cv2.ellipse(mask, (int(rng.uniform(0, mask_w)), int(rng.uniform(0, mask_h))), (int(rng.uniform(1, 300)), int(rng.uniform(1, 200))), rng.uniform(0, 180), 0, 360, 1, -1)
+        else:
+            x, y = int(rng.uniform(0, mask_w - 3)), int(rng.uniform(0, mask_h - 3))
+            mask[y:y + int(rng.uniform(1, mask_h)), x:x + int(rng.uniform(1, mask_w))] = 1
+            mask[rng.random((mask_h, mask_w)) < 0.01] = 0
+        x, y, w, h = cv2.boundingRect(mask)
+        anns.append({
+            "segmentation": mask.astype(bool),
+            "area": int(mask.sum()),
+            "bbox": [x, y, w, h],
+            "predicted_iou": np.float32(rng.uniform(0.8, 1.0)).item(),
+            "point_coords": [[float(rng.uniform(0, mask_w)), float(rng.uniform(0, mask_h))]],
+            "stability_score": np.float32(rng.uniform(0.9, 1.0)).item(),
+            "crop_box": [0, 0, mask_w, mask_h],
+        })
+    return anns
+
+
+def test_round_trip():
+    anns = _sam_annotations(np.random.default_rng(0))
+    codecs = [sam_masks.CODEC_ZLIB] + ([sam_masks.CODEC_ZSTD] if sam_masks.zstandard is not None else [])
+    for codec in codecs:
+        data = encode_sam_masks(anns, codec=codec)
+        masks = load_sam_annotations(data)
+        assert isinstance(masks, SamMasks) and len(masks) == len(anns)
+        for ann, decoded in zip(anns, masks):
+            assert decoded.keys() == ann.keys()
+            assert np.array_equal(decoded["segmentation"], ann["segmentation"])
+            assert all(decoded[key] == ann[key] for key in ann if key != "segmentation")
+        assert masks[-1]["bbox"] == anns[-1]["bbox"]
+        assert masks.metadata(3)["area"] == anns[3]["area"]
+    # legacy pickles are still read
+    legacy = load_sam_annotations(gzip.compress(pickle.dumps(anns)))
+    assert np.array_equal(legacy[5]["segmentation"], anns[5]["segmentation"])
+    print("all sam masks tests passed")
+
+
+if __name__ == "__main__":
+    sys.exit(test_round_trip())
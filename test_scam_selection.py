@@ -0,0 +1,187 @@
+"""Regression test: the vectorized page selection must select the same pages as the pairwise loop it replaced."""
+import copy
+import math
+import os
+import sys
+
+import cv2
+import numpy as np
+
+import sam_annotation_utils
+from sam_annotation_utils import ann_has_duplicate_in, ann_included_in, filter_sam_annotations, get_ann_infos, select_candidates
+
+sam_annotation_utils.DEBUG = False
+
+EXAMPLE_SCAN = os.path.join(os.path.dirname(os.path.abspath(__file__)), "examples", "BSOD_NAMS_RGYAL_MTSAN_03_0059_xs.jpg")
+
+SCAM_OPTIONS = [
+    {"direction": "vertical", "squarishness_min": 0.85, "squarishness_min_warn": 0.7, "nb_pages_expected": 2, "wh_ratio_range": [3.0, 7.0], "area_ratio_range": [0.2, 0.5]},
+    {"direction": "horizontal", "squarishness_min": 0.85, "squarishness_min_warn": 0.7, "nb_pages_expected": 2, "wh_ratio_range": [2.0, 8.0], "area_ratio_range": [0.01, 0.5]},
+    {"direction": "vertical", "squarishness_min": 0.9, "squarishness_min_warn": 0.5, "nb_pages_expected": 2, "wh_ratio_range": None, "area_ratio_range": [0.001, 0.9]},
+    {"direction": "horizontal", "squarishness_min": 0.85, "squarishness_min_warn": 0.7, "nb_pages_expected": 1, "wh_ratio_range": [1.0, 10.0], "area_ratio_range": [0.05, 0.95]},
+]
+
+
+def _reference_selection(anns_by_area, total_area, scam_options):
+    """
+    the selection loop of add_scam_results before it was vectorized
+    """
+    image_anns = []
+    potential_split_anns = []
+    ref_size = None
+    for ann in anns_by_area:
+        ann_ratio = ann.bbox[2] / float(ann.bbox[3])
+        area_ratio = ann.contour_area / total_area
+        if area_ratio < scam_options["area_ratio_range"][0]:
+            break
+        if area_ratio > scam_options["area_ratio_range"][1]:
+            continue
+        if scam_options["direction"] == "vertical" and ann.touches_top_bottom():
+            continue
+        if scam_options["direction"] == "horizontal" and ann.touches_left_right():
+            continue
+        if ann.squarishness() < scam_options["squarishness_min_warn"]:
+            continue
+        if scam_options["squarishness_min"] is not None and ann.squarishness() < scam_options["squarishness_min"]:
+            ann.warns.append("squarishness")
+        if ann_has_duplicate_in(ann, image_anns) or ann_has_duplicate_in(ann, potential_split_anns):
+            continue
+        ratio_ok = not scam_options["wh_ratio_range"] or (ann_ratio >= scam_options["wh_ratio_range"][0] and ann_ratio <= scam_options["wh_ratio_range"][1])
+        if not ref_size:
+            if ratio_ok:
+                image_anns.append(ann)
+                ref_size = ann.contour_area
+            continue
+        if ann_included_in(ann, potential_split_anns):
+            continue
+        diff_factor = 0.4 if len(image_anns) < scam_options["nb_pages_expected"] else 0.15
+        if abs(ref_size - ann.contour_area) / ref_size < diff_factor and not ann_included_in(ann, image_anns):
+            if ratio_ok:
+                image_anns.append(ann)
+        elif len(image_anns) < scam_options["nb_pages_expected"] and len(potential_split_anns) < scam_options["nb_pages_expected"]:
+            potential_split_anns.append(ann)
+    return image_anns, potential_split_anns
+
+
+def _synthetic_annotations(rng, mask_w=1024, mask_h=683):
+    """
+    SAM-like annotations of a double page: the pages, both pages, the background and fragments
+    """
+    masks = []
+    for k in range(2):
+        mask = np.zeros((mask_h, mask_w), np.uint8)
+        cx = mask_w * (0.27 + 0.46 * k) + rng.uniform(-10, 10)
+        size = (mask_w * 0.4 + rng.uniform(-20, 20), mask_h * rng.uniform(0.1, 0.8))
+        cv2.fillPoly(mask, [cv2.boxPoints(((cx, mask_h / 2), size, rng.uniform(-3, 3))).astype(np.int32)], 1)
+        masks.append(mask)
+        # near duplicate of the page
+        masks.append(cv2.erode(mask, np.ones((5, 5), np.uint8)))
+    mask = np.zeros((mask_h, mask_w), np.uint8)
+    mask[int(mask_h * 0.3):int(mask_h * 0.7), int(mask_w * 0.05):int(mask_w * 0.95)] = 1
+    masks.append(mask)
+    mask = np.ones((mask_h, mask_w), np.uint8)
+    mask[int(mask_h * 0.4):int(mask_h * 0.6), :] = 0
+    masks.append(mask)
+    for _ in range(int(rng.integers(5, 60))):
+        mask = np.zeros((mask_h, mask_w), np.uint8)
+        if rng.random() < 0.5:
+            cv2.ellipse(mask, (int(rng.uniform(0, mask_w)), int(rng.uniform(0, mask_h))), (int(rng.uniform(3, 300)), int(rng.uniform(3, 200))), rng.uniform(0, 180), 0, 360, 1, -1)
+        else:
+            x, y = int(rng.uniform(0, mask_w - 20)), int(rng.uniform(0, mask_h - 20))
+            mask[y:y + int(rng.uniform(10, mask_h)), x:x + int(rng.uniform(10, mask_w / 2))] = 1
+        masks.append(mask)
+    return [{"segmentation": mask.astype(bool)} for mask in masks]
+
+
+def _scan_annotations(path=EXAMPLE_SCAN):
+    """
+    annotations of a real scan, without SAM: the connected components of the image
+    thresholded at a few levels, which overlap and nest as the masks of SAM do
+    """
+    img = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+    masks = []
+    for threshold in (70, 85, 100, 115):
+        for binary in (img > threshold, img <= threshold):
+            nb_labels, labels, stats, _ = cv2.connectedComponentsWithStats(binary.astype(np.uint8))
+            masks += [{"segmentation": labels == i} for i in range(1, nb_labels) if stats[i][cv2.CC_STAT_AREA] >= 100]
+    return masks
+
+
+def _annotation_sets():
+    rng = np.random.default_rng(0)
+    for i in range(30):
+        yield {"width": 6000, "height": 4000, "rotation": [0, 180, 90][i % 3]}, _synthetic_annotations(rng)
+    # no recorded SAM output is shipped (it needs the model), the pages of a real scan instead
+    anns = _scan_annotations()
+    mask_h, mask_w = anns[0]["segmentation"].shape
+    for rotation in (0, 180, 90):
+        yield {"width": mask_w * 4, "height": mask_h * 4, "rotation": rotation}, anns
+
+
+def _result(image_anns, split_anns):
+    return [(ann.bbox, ann.minAreaRect, ann.warns) for ann in image_anns], [ann.bbox for ann in split_anns]
+
+
+def test_selection():
+    failures = 0
+    for file_info, sam_anns in _annotation_sets():
+        anns = get_ann_infos(file_info, sam_anns)
+        total_area = float(file_info["width"] * file_info["height"])
+        for scam_options in SCAM_OPTIONS:
+            ref_anns = sorted(copy.deepcopy(anns), key=lambda x: x.contour_area, reverse=True)
+            new_anns = sorted(copy.deepcopy(anns), key=lambda x: x.contour_area, reverse=True)
+            expected = _result(*_reference_selection(ref_anns, total_area, scam_options))
+            got = _result(*select_candidates(new_anns, total_area, scam_options["area_ratio_range"], scam_options["direction"],
+                                             scam_options["squarishness_min"], scam_options["squarishness_min_warn"],
+                                             scam_options["wh_ratio_range"], scam_options["nb_pages_expected"]))
+            if got != expected:
+                failures += 1
+                print("FAIL", file_info, scam_options, got, expected)
+        # the parameters of get_image_ann_list
+        options = {"direction": "vertical", "squarishness_min": None, "squarishness_min_warn": 0.85, "nb_pages_expected": 2, "wh_ratio_range": [1.7, 20.0], "area_ratio_range": [0.01, math.inf]}
+        expected = _result(*_reference_selection(sorted(copy.deepcopy(anns), key=lambda x: x.contour_area, reverse=True), total_area, options))
+        got = _result(*select_candidates(sorted(copy.deepcopy(anns), key=lambda x: x.contour_area, reverse=True), total_area, [0.01, math.inf], "vertical", None, 0.85, [1.7, 20.0], 2))
+        if got != expected:
+            failures += 1
+            print("FAIL get_image_ann_list", file_info, got, expected)
+    if failures:
+        print(f"{failures} failures")
+    assert failures == 0
+    print("all selection tests passed")
+
+
+def test_sam_filter():
+    """
+    the annotations discarded by filter_sam_annotations(min_area_ratio=...) are never selected
+    """
+    failures = 0
+    for file_info, sam_anns in _annotation_sets():
+        for sam_ann in sam_anns:
+            if "bbox" not in sam_ann:
+                mask = sam_ann["segmentation"].astype(np.uint8)
+                sam_ann["bbox"], sam_ann["area"] = list(cv2.boundingRect(mask)), int(mask.sum())
+        filtered = filter_sam_annotations(sam_anns, min_area_ratio=0.01)
+        total_area = float(file_info["width"] * file_info["height"])
+        for scam_options in SCAM_OPTIONS:
+            if scam_options["area_ratio_range"][0] < 0.01:
+                continue
+            results = []
+            for anns in (sam_anns, filtered):
+                anns_by_area = sorted(get_ann_infos(file_info, anns), key=lambda x: x.contour_area, reverse=True)
+                results.append(_result(*select_candidates(anns_by_area, total_area, scam_options["area_ratio_range"], scam_options["direction"],
+                                                          scam_options["squarishness_min"], scam_options["squarishness_min_warn"],
+                                                          scam_options["wh_ratio_range"], scam_options["nb_pages_expected"])))
+            if results[0] != results[1]:
+                failures += 1
+                print("FAIL filter", file_info, scam_options, results[1], results[0])
+    filtered = filter_sam_annotations(sam_anns, max_masks=3, nms_iou=0.5)
+    assert len(filtered) <= 3
+    if failures:
+        print(f"{failures} failures")
+    assert failures == 0
+    print("all filter tests passed")
+
+
+if __name__ == "__main__":
+    test_sam_filter()
+    sys.exit(test_selection())
@@ -0,0 +1,117 @@
+"""Behaviour of the local and in-memory storages, which the pipelines use interchangeably with S3."""
+import sys
+import tempfile
+
+import pytest
+
+import storage as storage_module
+
+from storage import LocalStorage, MemoryStorage, S3Storage, get_storage
+
+
+def _check_storage(storage):
+    assert storage.get("a/missing") is None
+    assert storage.stat("a/missing") is None
+    assert not storage.exists("a/missing")
+    with pytest.raises(Exception):
+        storage.get_range("a/missing", 0, 10)
+    assert storage.list("nothing/") == []
+
+    storage.put("a/b/x.jpg", b"0123456789")
+    storage.put("a/y.jpg", memoryview(b"abc"))
+    storage.put("ab/z.jpg", b"")
+    blob = storage.get("a/b/x.jpg")
+    blob.seek(2)
+    assert blob.read(3) == b"234"
+    assert storage.get("ab/z.jpg").read() == b""
+    assert storage.get_range("a/b/x.jpg", 2, 5) == b"234"
+    # ranges past the end are truncated
+    assert storage.get_range("a/b/x.jpg", 8, 20) == b"89"
+    assert storage.get_range("a/b/x.jpg", 10, 20) == b""
+    assert storage.get_range("a/b/x.jpg", 30, 40) == b""
+
+    assert [obj["Key"] for obj in storage.list("a/")] == ["a/b/x.jpg", "a/y.jpg"]
+    assert [obj["Key"] for obj in storage.list("a")] == ["a/b/x.jpg", "a/y.jpg", "ab/z.jpg"]
+    assert [obj["Key"] for obj in storage.list("a/b/")] == ["a/b/x.jpg"]
+    obj = storage.list("a/y")[0]
+    assert obj["Size"] == 3 and obj["ETag"] and isinstance(obj["LastModified"], int)
+
+    st = storage.stat("a/b/x.jpg")
+    assert st["Size"] == 10
+    storage.put("a/b/x.jpg", b"new")
+    assert storage.stat("a/b/x.jpg")["Size"] == 3
+    assert storage.stat("a/b/x.jpg")["ETag"] != st["ETag"]
+
+    stats = storage.stat_many(["a/y.jpg", "a/missing", "ab/z.jpg"])
+    assert stats["a/y.jpg"]["Size"] == 3 and stats["a/missing"] is None and stats["ab/z.jpg"]["Size"] == 0
+    assert storage.exists_many(["a/y.jpg", "a/missing", "ab/z.jpg", "b/missing"]) == {"a/y.jpg", "ab/z.jpg"}
+    assert storage.exists_many([]) == set()
+    storage.put_many({"m/%d" % i: b"%d" % i for i in range(20)})
+    blobs = storage.get_many(["m/3", "m/missing"])
+    assert blobs["m/3"].read() == b"3" and blobs["m/missing"] is None
+    assert storage.get_range_many([("m/12", 0, 1), ("m/12", 1, 5)]) == [b"1", b"2"]
+
+
+def test_memory_storage():
+    _check_storage(MemoryStorage())
+
+
+def test_local_storage():
+    with tempfile.TemporaryDirectory() as root:
+        _check_storage(LocalStorage(root))
+        # the same files through a file:// url
+        assert get_storage("file://" + root).get("a/y.jpg").read() == b"abc"
+
+
+def test_get_storage():
+    assert get_storage("mem://t") is get_storage("mem://t") and get_storage("mem://t") is not get_storage("mem://u")
+    assert get_storage("s3") is get_storage(None) and isinstance(get_storage("s3"), S3Storage)
+    assert get_storage("s3://other-bucket/") is get_storage("s3://other-bucket/")
+    assert get_storage("s3://other-bucket/").bucket == "other-bucket"
+    storage = MemoryStorage()
+    assert get_storage(storage) is storage
+
+
+class _FakeS3Storage(S3Storage):
+    """
+    an S3Storage on a dict, recording the listings and the HEAD requests
+    """
+
+    def __init__(self, objects):
+        super().__init__("bucket")
+        self.objects = objects
+        self.listed = []
+        self.heads = []
+
+    def list_objs(self, prefix, bucket, use_manifest=True, client=None):
+        self.listed.append(prefix)
+        return [{"Key": k, "Size": len(v), "ETag": '"e"', "LastModified": 0} for k, v in self.objects.items() if k.startswith(prefix)]
+
+    def stat(self, key):
+        self.heads.append(key)
+        return {"Size": len(self.objects[key]), "ETag": '"e"', "LastModified": 0} if key in self.objects else None
+
+
+def test_s3_many(monkeypatch):
+    storage = _FakeS3Storage({"root.jpg": b"r", "a/x.jpg": b"x", "a/b/y.jpg": b"yy", "ab/z.jpg": b"z"})
+    monkeypatch.setattr(storage_module, "list_objs", storage.list_objs)
+    monkeypatch.setattr(storage_module, "list_existing_keys",
+                        lambda prefix, bucket, client=None: {obj["Key"]: obj["ETag"] for obj in storage.list_objs(prefix, bucket)})
+    keys = ["root.jpg", "missing.jpg", "a/x.jpg", "a/b/y.jpg", "a/b/missing.jpg", "ab/z.jpg"]
+    stats = storage.stat_many(keys)
+    assert {k for k, st in stats.items() if st is not None} == {"root.jpg", "a/x.jpg", "a/b/y.jpg", "ab/z.jpg"}
+    assert stats["a/b/y.jpg"]["Size"] == 2 and set(stats) == set(keys)
+    # a/ is listed once for a/b/ too, the root keys are not listed
+    assert sorted(storage.listed) == ["a/", "ab/"], storage.listed
+    assert sorted(storage.heads) == ["missing.jpg", "root.jpg"]
+    storage.listed, storage.heads = [], []
+    assert storage.exists_many(keys) == {"root.jpg", "a/x.jpg", "a/b/y.jpg", "ab/z.jpg"}
+    assert sorted(storage.listed) == ["a/", "ab/"] and sorted(storage.heads) == ["missing.jpg", "root.jpg"]
+
+
+if __name__ == "__main__":
+    test_memory_storage()
+    test_local_storage()
+    test_get_storage()
+    print("all storage tests passed")
+    sys.exit(0)
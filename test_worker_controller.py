@@ -0,0 +1,67 @@
+"""Decisions of WorkerController on synthetic samples: growth, undo and hold, memory ceiling."""
+import sys
+
+from worker_controller import WorkerController
+
+GB = 1024 ** 3
+
+
+def _sample(pages_per_s, cpu=0.5, s3_wait=0.0, rss=GB):
+    return {"time": 0, "workers": 0, "pages_per_s": pages_per_s, "cpu": cpu, "s3_wait": s3_wait, "rss": rss}
+
+
+def _run(controller, samples):
+    """
+    decides on each sample as _run does, returns the (limit, reason) after each one
+    """
+    res = []
+    for sample in samples:
+        limit, reason = controller._decide(sample)
+        if reason is not None:
+            controller._set_limit(limit, reason, sample)
+        res.append((controller.limit, reason))
+    return res
+
+
+def test_growth():
+    controller = WorkerController("test", max_workers=4)
+    res = _run(controller, [_sample(1.0), _sample(2.0, s3_wait=0.5, cpu=0.95), _sample(3.0), _sample(3.5), _sample(3.5)])
+    assert res == [(2, "cpus not saturated"), (3, "workers waiting for S3"), (4, "cpus not saturated"), (4, None), (4, None)], res
+    # saturated and not waiting, no growth
+    controller = WorkerController("test", max_workers=4, start_workers=2)
+    assert _run(controller, [_sample(1.0, cpu=0.95, s3_wait=0.1)]) == [(2, None)]
+
+
+def test_undo_and_hold():
+    controller = WorkerController("test", max_workers=8, start_workers=2, hold_intervals=3)
+    res = _run(controller, [_sample(2.0), _sample(1.5)])
+    # the growth lowered the throughput (more than the tolerance), it is undone
+    assert res[0] == (3, "cpus not saturated")
+    assert res[1][0] == 2 and res[1][1].startswith("throughput went down from 2.00")
+    # then held, although the CPUs are not saturated
+    assert _run(controller, [_sample(1.5)] * 3) == [(2, None)] * 3
+    assert _run(controller, [_sample(1.5)]) == [(3, "cpus not saturated")]
+    # within the tolerance the growth is kept
+    assert _run(controller, [_sample(1.45)]) == [(4, "cpus not saturated")]
+    decisions = controller.stats()["decisions"]
+    assert [(d["workers_from"], d["workers_to"]) for d in decisions] == [(2, 3), (3, 2), (2, 3), (3, 4)]
+
+
+def test_memory_ceiling():
+    controller = WorkerController("test", max_workers=8, min_workers=2, start_workers=4, memory_ceiling=10 * GB)
+    res = _run(controller, [_sample(1.0, rss=11 * GB)] * 3)
+    # shrinks down to min_workers
+    assert res == [(3, "rss above the ceiling"), (2, "rss above the ceiling"), (2, None)], res
+    # close to the ceiling, no growth
+    assert _run(controller, [_sample(1.0, rss=9 * GB)]) == [(2, None)]
+    assert _run(controller, [_sample(1.0, rss=7 * GB)]) == [(3, "cpus not saturated")]
+    # over the ceiling after a growth: the growth is not evaluated, the limit shrinks
+    assert _run(controller, [_sample(0.5, rss=11 * GB), _sample(0.5, rss=7 * GB)]) == [(2, "rss above the ceiling"), (3, "cpus not saturated")]
+
+
+if __name__ == "__main__":
+    test_growth()
+    test_undo_and_hold()
+    test_memory_ceiling()
+    print("all worker controller tests passed")
+    sys.exit(0)
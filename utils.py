@@ -3,27 +3,269 @@ from hashlib import sha256
 import boto3
 import io
 import botocore
+import botocore.config
 import gzip
 import pickle
 import json
 import threading
-from concurrent.futures import ThreadPoolExecutor
+import time
+import logging
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+from boto3.s3.transfer import TransferConfig
+from disk_cache import DiskCache
+from s3_listing import list_objects, ManifestStore
+from s3_retry import AIMDLimiter, RetryPolicy, RetryStats
 
 BUCKET_NAME = "image-processing.bdrc.io"
 
 VERSION = "0.0.1"
 
-SESSION = boto3.Session(profile_name='image_processing')
-S3 = SESSION.client('s3')
+S3_PROFILE = 'image_processing'
+# shared by all the transfers: objects larger than multipart_threshold are downloaded
+# with max_concurrency parallel ranged GETs of multipart_chunksize bytes
+TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=16*1024*1024,
+    multipart_chunksize=16*1024*1024,
+    max_concurrency=8,
+)
+# botocore's default is 10, which is too low as soon as we have more threads than that
+S3_MAX_POOL_CONNECTIONS = 32
 
-def save_scam_json(folder_path, scam_json_obj):
+_S3_CLIENTS = {}
+_S3_CLIENTS_LOCK = threading.Lock()
+_RANGE_EXECUTOR = None
+
+def get_s3_client(profile_name=S3_PROFILE):
+    """
+    returns the shared S3 client for a profile. boto3 clients are thread safe,
+    all the threads should use the same one so that they share its connection pool
+    """
+    with _S3_CLIENTS_LOCK:
+        if profile_name not in _S3_CLIENTS:
+            session = boto3.Session(profile_name=profile_name)
+            # retries are done by s3_call() so that throttling is counted and slows us down
+            config = botocore.config.Config(max_pool_connections=S3_MAX_POOL_CONNECTIONS, retries={"total_max_attempts": 1})
+            _S3_CLIENTS[profile_name] = session.client('s3', config=config)
+        return _S3_CLIENTS[profile_name]
+
+def set_s3_concurrency(concurrency):
+    """
+    sizes the connection pool of the shared clients for a number of threads
+    doing S3 requests at the same time (plus the ranged GETs of large objects).
+    A larger pool recreates the clients: code that can run after this call must
+    read utils.S3 (or call get_s3_client()) when it makes a request, a reference
+    taken before keeps the old pool.
+    """
+    global S3_MAX_POOL_CONNECTIONS
+    with _S3_CLIENTS_LOCK:
+        pool_size = concurrency + TRANSFER_CONFIG.max_request_concurrency
+        if pool_size <= S3_MAX_POOL_CONNECTIONS:
+            return
+        S3_MAX_POOL_CONNECTIONS = pool_size
+        _S3_CLIENTS.clear()
+    S3_LIMITER.set_max_limit(pool_size)
+
+def __getattr__(name):
+    # utils.S3 is the shared client of the default profile, created on first use so
+    # that the module can be imported without the credentials (local storages, tests)
+    if name == "S3":
+        return get_s3_client()
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+# all the S3 requests go through S3_RETRY: throttling (SlowDown, 503) and transient errors
+# are retried with exponential backoff and jitter, and throttling halves the number of
+# concurrent requests allowed by S3_LIMITER, which then grows back progressively
+S3_LIMITER = AIMDLimiter(S3_MAX_POOL_CONNECTIONS)
+S3_RETRY_STATS = RetryStats()
+S3_RETRY = RetryPolicy(limiter=S3_LIMITER, stats=S3_RETRY_STATS)
+
+def s3_call(fn, *args, **kwargs):
+    """
+    calls fn(*args, **kwargs), a function doing one S3 request, with the shared retry policy
+    """
+    return S3_RETRY.call(fn, *args, **kwargs)
+
+def reset_s3_stats():
+    S3_RETRY_STATS.reset()
+
+def get_s3_stats():
+    """
+    returns the number of requests, retries, throttled requests and failures since reset_s3_stats()
+    """
+    res = S3_RETRY_STATS.stats()
+    res["concurrency"] = S3_LIMITER.limit
+    return res
+
+def _get_range_executor():
+    global _RANGE_EXECUTOR
+    with _S3_CLIENTS_LOCK:
+        if _RANGE_EXECUTOR is None:
+            _RANGE_EXECUTOR = ThreadPoolExecutor(max_workers=TRANSFER_CONFIG.max_request_concurrency)
+        return _RANGE_EXECUTOR
+
+def _get_range_into(client, bucket, s3_key, etag, buf, start, end):
+    s3_call(_read_range_into, client, bucket, s3_key, etag, buf, start, end)
+
+def _read_range_into(client, bucket, s3_key, etag, buf, start, end):
+    response = client.get_object(Bucket=bucket, Key=s3_key, Range="bytes=%d-%d" % (start, end-1), IfMatch=etag)
+    pos = start
+    for chunk in response['Body'].iter_chunks(1024*1024):
+        buf[pos:pos+len(chunk)] = chunk
+        pos += len(chunk)
+    if pos != end:
+        raise IOError("incomplete range %d-%d for %s (got %d bytes)" % (start, end, s3_key, pos-start))
+
+class _NotModified(Exception):
+    pass
+
+def _get_with_body(client, **kwargs):
+    # the body is read in the same call so that errors while streaming it are retried
+    response = client.get_object(**kwargs)
+    return response, response['Body'].read()
+
+def _download_blob(client, bucket, s3_key, if_none_match=None):
+    """
+    returns the object as a BytesIO (or None if it doesn't exist) and its ETag.
+
+    The first request is a ranged GET of one chunk, which is all we need for
+    small objects. For larger objects the size is taken from its Content-Range
+    and the rest is fetched with parallel ranged GETs into one preallocated buffer.
+
+    Raises _NotModified if the ETag of the object is if_none_match.
+    """
+    chunksize = TRANSFER_CONFIG.multipart_chunksize
+    kwargs = {}
+    if if_none_match is not None:
+        kwargs["IfNoneMatch"] = if_none_match
+    try:
+        response, first = s3_call(_get_with_body, client, Bucket=bucket, Key=s3_key, Range="bytes=0-%d" % (chunksize-1), **kwargs)
+    except botocore.exceptions.ClientError as e:
+        code = e.response['Error']['Code']
+        if code in ['304', 'NotModified']:
+            raise _NotModified()
+        if code in ['404', 'NoSuchKey']:
+            return None, None
+        if code == 'InvalidRange':
+            # empty object
+            return io.BytesIO(), None
+        raise
+    etag = response.get('ETag')
+    total = len(first)
+    if 'ContentRange' in response:
+        total = int(response['ContentRange'].split("/")[-1])
+    if total <= len(first):
+        return io.BytesIO(first), etag
+    if total < TRANSFER_CONFIG.multipart_threshold:
+        # unusual configuration where chunks are smaller than the threshold
+        _, rest = s3_call(_get_with_body, client, Bucket=bucket, Key=s3_key, Range="bytes=%d-" % len(first), IfMatch=etag)
+        return io.BytesIO(first + rest), etag
+    f = io.BytesIO()
+    # allocates the buffer once at its final size
+    f.seek(total-1)
+    f.write(b"\0")
+    f.seek(0)
+    buf = f.getbuffer()
+    try:
+        buf[:len(first)] = first
+        first = None
+        executor = _get_range_executor()
+        futures = []
+        for start in range(chunksize, total, chunksize):
+            end = min(start+chunksize, total)
+            futures.append(executor.submit(_get_range_into, client, bucket, s3_key, etag, buf, start, end))
+        try:
+            for future in futures:
+                future.result()
+        finally:
+            # don't release the buffer while some parts are still being written
+            for future in futures:
+                future.cancel()
+            wait(futures)
+    finally:
+        buf.release()
+    return f, etag
+
+def download_blob(s3_key, bucket=BUCKET_NAME, client=None):
+    """
+    downloads an object, returns None if the object doesn't exist.
+
+    The result is a BytesIO, or a read-only mmap when the object is served by the
+    disk cache (see set_disk_cache()). The cache is validated with a conditional GET
+    so a hit costs one request and no transfer.
+    """
+    if client is None:
+        client = get_s3_client()
+    cache = DISK_CACHE
+    if cache is None:
+        return _download_blob(client, bucket, s3_key)[0]
+    cached_etag = cache.get_etag(bucket, s3_key)
+    if cached_etag is not None:
+        try:
+            f, etag = _download_blob(client, bucket, s3_key, if_none_match=cached_etag)
+        except _NotModified:
+            mm = cache.open(bucket, s3_key, cached_etag)
+            if mm is not None:
+                return mm
+            f, etag = _download_blob(client, bucket, s3_key)
+        else:
+            cache.record_miss()
+    else:
+        cache.record_miss()
+        f, etag = _download_blob(client, bucket, s3_key)
+    if f is not None and etag is not None:
+        with f.getbuffer() as data:
+            cache.put(bucket, s3_key, etag, data)
+    return f
+
+DISK_CACHE = None
+
+def set_disk_cache(cache_dir, max_bytes=50*1024*1024*1024):
+    """
+    enables the persistent disk cache for all the downloads of source objects
+    """
+    global DISK_CACHE
+    DISK_CACHE = DiskCache(cache_dir, max_bytes=max_bytes)
+    logging.info("using disk cache in %s (max %d bytes)", cache_dir, max_bytes)
+    return DISK_CACHE
+
+def get_disk_cache():
+    return DISK_CACHE
+
+if os.environ.get("SCAM_CACHE_DIR"):
+    set_disk_cache(os.environ["SCAM_CACHE_DIR"], int(float(os.environ.get("SCAM_CACHE_MAX_GB", "50")) * 1024*1024*1024))
+
+MANIFEST_STORE = None
+LISTING_WORKERS = 16
+
+def set_manifest_dir(manifest_dir, max_age=24*3600):
+    """
+    enables the listing manifests: listings are saved in manifest_dir and listings
+    of the same prefix or of a sub-prefix within max_age seconds are served from them
+    """
+    global MANIFEST_STORE
+    MANIFEST_STORE = ManifestStore(manifest_dir, max_age) if manifest_dir else None
+    return MANIFEST_STORE
+
+def get_manifest_store():
+    return MANIFEST_STORE
+
+if os.environ.get("SCAM_MANIFEST_DIR"):
+    set_manifest_dir(os.environ["SCAM_MANIFEST_DIR"], int(float(os.environ.get("SCAM_MANIFEST_MAX_AGE_H", "24")) * 3600))
+
+def save_scam_json(folder_path, scam_json_obj, storage=None):
+    """
+    writes scam.json in the folder, on S3 unless a storage (see storage.py) is given
+    """
     scam_json_str = json.dumps(scam_json_obj, indent=2)
     json_file_path = folder_path+"scam.json"
+    if storage is not None:
+        return storage.put(json_file_path, scam_json_str.encode('utf-8'))
     return upload_to_s3(scam_json_str.encode('utf-8'), json_file_path)
 
-def get_scam_json(folder_path):
+def get_scam_json(folder_path, storage=None):
     json_file_path = folder_path+"scam.json"
-    blob = gets3blob(json_file_path)
+    blob = storage.get(json_file_path) if storage is not None else gets3blob(json_file_path)
     if blob is None:
         return None
     blob.seek(0)
@@ -32,60 +274,291 @@ def get_scam_json(folder_path):
 def gets3blob(s3Key, bucket=BUCKET_NAME, prefetcher=None):
     if prefetcher is not None:
         return prefetcher.get(s3Key)
-    f = io.BytesIO()
-    try:
-        S3.download_fileobj(bucket, s3Key, f)
-        return f
-    except botocore.exceptions.ClientError as e:
-        if e.response['Error']['Code'] == '404':
-            return None
-        else:
-            raise
+    return download_blob(s3Key, bucket)
+
 
+def split_storage_key(s3_key, storage=None):
+    """
+    returns (storage, key) for a key of S3Prefetcher or S3Uploader, either a key
+    in storage (None for the bucket) or a (storage, key) tuple
+    """
+    if isinstance(s3_key, tuple):
+        return s3_key
+    return storage, s3_key
 
 class S3Prefetcher:
-    """Download S3 objects on background threads ahead of consumption."""
+    """
+    Download S3 objects on background threads ahead of consumption.
+
+    Downloads are admitted against a budget: at most max_bytes of downloaded
+    (or downloading) data and at most max_objects blobs that have not been
+    handed back by get() yet. Keys over budget stay in a pending queue and are
+    admitted as get() releases room. Object sizes come from the sizes passed
+    to schedule() (typically from a listing) or from a HEAD request.
+    None means no limit. Keys that won't be read must be passed to release(),
+    otherwise their downloads hold the budget until close().
 
-    def __init__(self, bucket=BUCKET_NAME, max_workers=3):
+    If storage is given (see storage.py), objects are read from it instead of the bucket.
+    Keys can also be (storage, key) tuples, so that one prefetcher and one budget are
+    shared by sources in several storages.
+    """
+
+    def __init__(self, bucket=BUCKET_NAME, max_workers=3, max_bytes=None, max_objects=None, storage=None):
         self.bucket = bucket
+        self.storage = storage
+        self.max_bytes = max_bytes
+        self.max_objects = max_objects
         self._executor = ThreadPoolExecutor(max_workers=max_workers)
         self._futures = {}
+        self._pending = OrderedDict()
+        self._sizes = {}
+        self._admitted_sizes = {}
+        self._inflight_bytes = 0
         self._lock = threading.Lock()
+        self.hits = 0
+        self.waits = 0
+        self.misses = 0
+        self.released = 0
+        # time get() was blocked on S3, including the downloads of the misses
+        self.wait_time = 0.0
+        self.miss_time = 0.0
+        self.peak_inflight_bytes = 0
+        self.peak_inflight_objects = 0
 
     def _download(self, s3_key):
-        f = io.BytesIO()
+        storage, s3_key = split_storage_key(s3_key, self.storage)
+        if storage is not None:
+            return storage.get(s3_key)
+        return download_blob(s3_key, self.bucket)
+
+    def _head_size(self, s3_key):
+        storage, s3_key = split_storage_key(s3_key, self.storage)
+        if storage is not None:
+            st = storage.stat(s3_key)
+            return st["Size"] if st is not None else 0
         try:
-            S3.download_fileobj(self.bucket, s3_key, f)
-            return f
+            return s3_call(get_s3_client().head_object, Bucket=self.bucket, Key=s3_key)["ContentLength"]
         except botocore.exceptions.ClientError as e:
             if e.response['Error']['Code'] == '404':
-                return None
+                return 0
             raise
 
-    def prefetch(self, s3_key):
+    def _fits(self, size):
+        # always admit at least one object so that objects larger than the budget can go through
+        if not self._futures:
+            return True
+        if self.max_objects is not None and len(self._futures) + 1 > self.max_objects:
+            return False
+        if self.max_bytes is not None and self._inflight_bytes + size > self.max_bytes:
+            return False
+        return True
+
+    def _submit(self, s3_key, size):
+        # must be called with the lock held
+        self._pending.pop(s3_key, None)
+        self._admitted_sizes[s3_key] = size
+        self._inflight_bytes += size
+        self._futures[s3_key] = self._executor.submit(self._download, s3_key)
+        self.peak_inflight_bytes = max(self.peak_inflight_bytes, self._inflight_bytes)
+        self.peak_inflight_objects = max(self.peak_inflight_objects, len(self._futures))
+
+    def _admit(self):
+        """
+        admit pending keys in order while they fit in the budget
+        """
+        while True:
+            with self._lock:
+                if not self._pending:
+                    return
+                s3_key = next(iter(self._pending))
+                size = self._sizes.get(s3_key)
+                if size is not None:
+                    if not self._fits(size):
+                        return
+                    self._submit(s3_key, size)
+                    continue
+            # HEAD outside of the lock, the key stays pending in the meantime
+            size = self._head_size(s3_key)
+            with self._lock:
+                self._sizes[s3_key] = size
+
+    def prefetch(self, s3_key, size=None):
         with self._lock:
+            if size is not None:
+                self._sizes[s3_key] = size
             if s3_key not in self._futures:
-                self._futures[s3_key] = self._executor.submit(self._download, s3_key)
+                self._pending[s3_key] = True
+        self._admit()
 
-    def schedule(self, s3_keys):
-        for s3_key in s3_keys:
-            self.prefetch(s3_key)
+    def schedule(self, s3_keys, sizes=None):
+        """
+        schedule a list of keys, sizes is an optional {s3_key: size} dict
+        """
+        with self._lock:
+            if sizes:
+                self._sizes.update(sizes)
+            for s3_key in s3_keys:
+                if s3_key not in self._futures:
+                    self._pending[s3_key] = True
+        self._admit()
+
+    def release(self, s3_keys):
+        """
+        drops keys that will not be passed to get(): pending keys are unscheduled and the
+        downloads of admitted keys are cancelled or discarded, freeing their budget
+        """
+        with self._lock:
+            for s3_key in s3_keys:
+                self._pending.pop(s3_key, None)
+                future = self._futures.pop(s3_key, None)
+                if future is not None:
+                    future.cancel()
+                    self._inflight_bytes -= self._admitted_sizes.pop(s3_key, 0)
+                    self.released += 1
+        self._admit()
 
     def get(self, s3_key):
         with self._lock:
-            if s3_key not in self._futures:
-                self._futures[s3_key] = self._executor.submit(self._download, s3_key)
-            future = self._futures.pop(s3_key)
-        return future.result()
+            future = self._futures.get(s3_key)
+            if future is None:
+                # not admitted yet, we download it right away and it doesn't count against the budget
+                self.misses += 1
+                self._pending.pop(s3_key, None)
+            elif future.done():
+                self.hits += 1
+            else:
+                self.waits += 1
+        start = time.monotonic()
+        if future is None:
+            try:
+                return self._download(s3_key)
+            finally:
+                with self._lock:
+                    elapsed = time.monotonic() - start
+                    self.wait_time += elapsed
+                    self.miss_time += elapsed
+        try:
+            return future.result()
+        finally:
+            with self._lock:
+                self.wait_time += time.monotonic() - start
+                # the caller now owns the blob, release its budget
+                self._futures.pop(s3_key, None)
+                self._inflight_bytes -= self._admitted_sizes.pop(s3_key, 0)
+            self._admit()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "waits": self.waits,
+                "misses": self.misses,
+                "released": self.released,
+                "wait_time": round(self.wait_time, 3),
+                "miss_time": round(self.miss_time, 3),
+                "peak_inflight_bytes": self.peak_inflight_bytes,
+                "peak_inflight_objects": self.peak_inflight_objects,
+                "max_bytes": self.max_bytes,
+                "max_objects": self.max_objects,
+            }
 
     def close(self):
+        with self._lock:
+            self._pending.clear()
+            for future in self._futures.values():
+                future.cancel()
+        self._executor.shutdown(wait=True)
+
+class S3Uploader:
+    """
+    Upload objects on background threads so that workers don't wait for PUTs.
+
+    At most max_queued uploads can wait for a thread, upload() blocks when the
+    queue is full so that encoded images don't pile up in memory. Throttled and
+    failed uploads are retried with exponential backoff and jitter, sharing the
+    concurrency limit of the other S3 requests. upload() returns a future and
+    the result of each object is kept in self.results.
+
+    If storage is given (see storage.py), objects are written to it instead of
+    the bucket, with the retries of the storage. As in S3Prefetcher, keys can
+    also be (storage, key) tuples.
+    """
+
+    def __init__(self, bucket=BUCKET_NAME, max_workers=4, max_queued=16, max_attempts=4, backoff=0.5, storage=None):
+        self.bucket = bucket
+        self.storage = storage
+        self._retry = RetryPolicy(max_attempts=max_attempts, base_backoff=backoff, limiter=S3_LIMITER, stats=S3_RETRY_STATS)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._slots = threading.BoundedSemaphore(max_workers + max_queued)
+        self._futures = []
+        self._lock = threading.Lock()
+        self.results = {}
+        self.uploaded_bytes = 0
+
+    def _upload(self, data, s3_key):
+        storage, key = split_storage_key(s3_key, self.storage)
+        try:
+            if storage is not None:
+                storage.put(key, data)
+            else:
+                self._retry.call(get_s3_client().put_object, Bucket=self.bucket, Key=key, Body=data)
+        except Exception as e:
+            attempts = getattr(e, "attempts", 1)
+            logging.error("could not upload %s after %d attempts: %s", key, attempts, e)
+            with self._lock:
+                self.results[key] = {"ok": False, "attempts": attempts, "error": str(e)}
+            raise
+        with self._lock:
+            self.uploaded_bytes += len(data)
+            self.results[key] = {"ok": True}
+        return s3_key
+
+    def upload(self, data, s3_key):
+        """
+        queues an upload and returns a future, blocks if the queue is full
+        """
+        self._slots.acquire()
+        try:
+            future = self._executor.submit(self._upload, data, s3_key)
+        except:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda f: self._slots.release())
+        with self._lock:
+            self._futures.append(future)
+        return future
+
+    def wait(self):
+        """
+        waits for all the queued uploads and returns the list of failures
+        """
+        with self._lock:
+            futures = self._futures
+            self._futures = []
+        wait(futures)
+        return self.failures()
+
+    def failures(self):
+        with self._lock:
+            return [{"s3_key": k, "error": r["error"], "attempts": r["attempts"]} for k, r in self.results.items() if not r["ok"]]
+
+    def stats(self):
+        with self._lock:
+            return {
+                "uploaded": sum(1 for r in self.results.values() if r["ok"]),
+                "failed": sum(1 for r in self.results.values() if not r["ok"]),
+                "uploaded_bytes": self.uploaded_bytes,
+            }
+
+    def close(self):
+        self.wait()
         self._executor.shutdown(wait=True)
 
 def get_sha256(b):
     return sha256(b).hexdigest()
 
 def upload_to_s3(data, s3_key):
-    return S3.put_object(Bucket=BUCKET_NAME, Key=s3_key, Body=data)
+    return s3_call(get_s3_client().put_object, Bucket=BUCKET_NAME, Key=s3_key, Body=data)
 
 def get_gzip_picked_bytes(o):
     out = io.BytesIO()
@@ -95,7 +568,7 @@ def get_gzip_picked_bytes(o):
 
 def s3key_exists(s3_key):
     try:
-        S3.head_object(Bucket=BUCKET_NAME, Key=s3_key)
+        s3_call(get_s3_client().head_object, Bucket=BUCKET_NAME, Key=s3_key)
     except botocore.exceptions.ClientError as e:
         if e.response['Error']['Code'] == "404":
             return False
@@ -112,25 +585,41 @@ def is_img(path: str) -> bool:
         return False
     return end4[1].lower() in [".jpg", ".jpeg", ".tif", ".tiff", ".cr2", ".nef", ".arw", ".jp2", ".jxl"]
 
-def list_obj_keys(prefix, bucket=BUCKET_NAME):
-    obj_keys = []
-    continuation_token = None
-    while True:
-        if continuation_token:
-            response = S3.list_objects_v2(Bucket=bucket, Prefix=prefix, ContinuationToken=continuation_token)
-        else:
-            response = S3.list_objects_v2(Bucket=bucket, Prefix=prefix)
-        if 'Contents' in response and response['Contents']:
-            for obj in response['Contents']:
-                obj_key = obj['Key']
-                obj_keys.append(obj_key)
-        continuation_token = response.get("NextContinuationToken")
-        if not continuation_token:
-            break
-    return obj_keys
-
-def list_img_keys(prefix, bucket=BUCKET_NAME):
-    obj_keys = list_obj_keys(prefix, bucket)
+def list_objs(prefix, bucket=BUCKET_NAME, use_manifest=True, client=None):
+    """
+    returns the objects under prefix (dicts with Key, Size, ETag and LastModified),
+    listed in parallel on the sub-prefixes, or taken from a recent manifest if
+    the manifests are enabled (see set_manifest_dir)
+    """
+    if client is None:
+        client = get_s3_client()
+    if MANIFEST_STORE is None:
+        return list_objects(client, bucket, prefix, LISTING_WORKERS, call=s3_call)
+    if use_manifest:
+        manifest = MANIFEST_STORE.find(bucket, prefix)
+        if manifest is not None:
+            return manifest.objects(prefix)
+    manifest, _ = MANIFEST_STORE.refresh(client, bucket, prefix, LISTING_WORKERS, call=s3_call)
+    return manifest.objects()
+
+def list_obj_keys(prefix, bucket=BUCKET_NAME, use_manifest=True):
+    return [obj['Key'] for obj in list_objs(prefix, bucket, use_manifest)]
+
+def list_existing_keys(prefix, bucket=BUCKET_NAME, client=None):
+    """
+    returns {key: etag} for the objects under prefix from a fresh listing, to check
+    the existence of many objects in memory instead of a HEAD request for each
+    """
+    return {obj['Key']: obj['ETag'] for obj in list_objs(prefix, bucket, use_manifest=False, client=client)}
+
+def list_obj_sizes(prefix, bucket=BUCKET_NAME, use_manifest=True):
+    """
+    returns a {key: size} dict, typically passed to S3Prefetcher.schedule()
+    """
+    return {obj['Key']: obj['Size'] for obj in list_objs(prefix, bucket, use_manifest)}
+
+def list_img_keys(prefix, bucket=BUCKET_NAME, use_manifest=True):
+    obj_keys = list_obj_keys(prefix, bucket, use_manifest)
     obj_keys.sort()
     return filter(is_img, obj_keys)
 
@@ -0,0 +1,191 @@
+"""
+Adaptive number of active workers.
+
+A pool is created with its maximum number of workers and a WorkerController
+limits how many of them are active: the callers acquire() a slot before
+submitting a task and release() it (with the number of pages done) when the
+task is done. Every interval the controller samples the throughput, the CPU
+utilization, the time spent waiting for S3 and the RSS, and grows or shrinks
+the limit by one worker (hill climbing):
+
+- the limit shrinks when the RSS is over the memory ceiling
+- a change that lowered the throughput is undone and the limit is then held
+  for a few intervals
+- otherwise the limit grows while the CPUs are not saturated or the workers
+  wait for S3, and the RSS is not close to the ceiling
+
+The decisions are logged and kept with the mean throughput observed for each
+number of workers, to choose static defaults.
+"""
+import logging
+import os
+import threading
+import time
+
+from memory_budget import get_physical_memory, get_rss
+
+
+def get_memory_ceiling(ceiling="auto"):
+    """
+    returns a memory ceiling in bytes, "auto" is 3/4 of the physical memory
+    """
+    if ceiling == "auto":
+        physical_memory = get_physical_memory()
+        return physical_memory * 3 // 4 if physical_memory else None
+    return ceiling
+
+
+def get_cpu_time():
+    """
+    returns the CPU time (user + system) in seconds of the process and of its
+    running child processes (a pool of workers)
+    """
+    import multiprocessing
+    cpu_time = time.process_time()
+    ticks = os.sysconf("SC_CLK_TCK")
+    for child in multiprocessing.active_children():
+        try:
+            with open("/proc/%d/stat" % child.pid) as f:
+                # the fields after the command name (which can contain spaces), utime and stime are the 14th and 15th
+                fields = f.read().rsplit(")", 1)[1].split()
+            cpu_time += (int(fields[11]) + int(fields[12])) / ticks
+        except (OSError, IndexError, ValueError):
+            pass
+    return cpu_time
+
+
+class WorkerController:
+    """
+    Controls the number of active workers of a pool between min_workers and max_workers,
+    see the module documentation. s3_wait is a function returning the total time (in
+    seconds) spent waiting for S3 so far, memory_ceiling is in bytes (None for no ceiling).
+    """
+
+    def __init__(self, name, max_workers, min_workers=1, start_workers=None, memory_ceiling=None, s3_wait=None,
+                 interval=15.0, min_pages=2, tolerance=0.05, hold_intervals=3):
+        self.name = name
+        self.min_workers = max(1, min_workers)
+        self.max_workers = max(self.min_workers, max_workers)
+        self.memory_ceiling = memory_ceiling
+        self.s3_wait = s3_wait
+        self.interval = interval
+        self.min_pages = min_pages
+        self.tolerance = tolerance
+        self.hold_intervals = hold_intervals
+        self.limit = min(self.max_workers, max(self.min_workers, start_workers or self.min_workers))
+        self._cond = threading.Condition()
+        self._active = 0
+        self._pages = 0
+        self._stop = threading.Event()
+        self._thread = None
+        self._last_change = 0
+        self._throughput_before_change = None
+        self._hold = 0
+        self._throughputs = {}
+        self.decisions = []
+
+    def acquire(self):
+        """
+        blocks until less than limit workers are active
+        """
+        with self._cond:
+            while self._active >= self.limit:
+                self._cond.wait()
+            self._active += 1
+
+    def release(self, pages=1):
+        with self._cond:
+            self._active -= 1
+            self._pages += pages
+            self._cond.notify_all()
+
+    def _set_limit(self, limit, reason, sample):
+        with self._cond:
+            previous = self.limit
+            self.limit = limit
+            self._cond.notify_all()
+        logging.info("%s workers: %d -> %d (%s), %.2f pages/s, cpu %.0f%%, s3 wait %.0f%%, rss %d MB",
+                     self.name, previous, limit, reason, sample["pages_per_s"], sample["cpu"] * 100,
+                     sample["s3_wait"] * 100, sample["rss"] // (1024*1024))
+        self.decisions.append(dict(sample, workers_from=previous, workers_to=limit, reason=reason))
+
+    def _decide(self, sample):
+        """
+        returns (new limit, reason), the limit is unchanged if reason is None. Only the
+        growths are evaluated on the next sample (and undone if the throughput went down).
+        """
+        limit = self.limit
+        throughput = sample["pages_per_s"]
+        last_change, self._last_change = self._last_change, 0
+        if self.memory_ceiling is not None and sample["rss"] > self.memory_ceiling and limit > self.min_workers:
+            return limit - 1, "rss above the ceiling"
+        if last_change and throughput < self._throughput_before_change * (1 - self.tolerance):
+            self._hold = self.hold_intervals
+            return limit - last_change, "throughput went down from %.2f pages/s" % self._throughput_before_change
+        if self._hold > 0:
+            self._hold -= 1
+            return limit, None
+        near_ceiling = self.memory_ceiling is not None and sample["rss"] > 0.8 * self.memory_ceiling
+        if limit < self.max_workers and not near_ceiling:
+            reason = None
+            if sample["s3_wait"] > 0.2:
+                reason = "workers waiting for S3"
+            elif sample["cpu"] < 0.85:
+                reason = "cpus not saturated"
+            if reason is not None:
+                self._last_change = 1
+                self._throughput_before_change = throughput
+                return limit + 1, reason
+        return limit, None
+
+    def _run(self):
+        cpu_count = os.cpu_count() or 1
+        last_time = time.monotonic()
+        last_cpu = get_cpu_time()
+        last_wait = self.s3_wait() if self.s3_wait is not None else 0.0
+        while not self._stop.wait(self.interval):
+            with self._cond:
+                pages = self._pages
+            if pages < self.min_pages:
+                # not enough pages for a meaningful throughput, the interval is extended
+                continue
+            now = time.monotonic()
+            cpu = get_cpu_time()
+            wait = self.s3_wait() if self.s3_wait is not None else 0.0
+            elapsed = now - last_time
+            with self._cond:
+                self._pages -= pages
+            sample = {
+                "time": round(now, 3),
+                "workers": self.limit,
+                "pages_per_s": round(pages / elapsed, 3),
+                "cpu": round((cpu - last_cpu) / (elapsed * cpu_count), 3),
+                # share of the time of the active workers spent waiting for their sources
+                "s3_wait": round((wait - last_wait) / (elapsed * self.limit), 3),
+                "rss": get_rss(),
+            }
+            last_time, last_cpu, last_wait = now, cpu, wait
+            self._throughputs.setdefault(self.limit, []).append(sample["pages_per_s"])
+            limit, reason = self._decide(sample)
+            if reason is not None:
+                self._set_limit(limit, reason, sample)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def stats(self):
+        return {
+            "min_workers": self.min_workers,
+            "max_workers": self.max_workers,
+            "final_workers": self.limit,
+            "memory_ceiling": self.memory_ceiling,
+            "decisions": list(self.decisions),
+            "pages_per_s_by_workers": {str(workers): round(sum(values) / len(values), 3) for workers, values in sorted(self._throughputs.items())},
+        }